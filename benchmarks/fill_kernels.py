@@ -0,0 +1,52 @@
+"""Benchmark of the artefact fill kernels on the same synthetic data.
+
+Run, with the package installed (pip install -e .), with:
+
+    python benchmarks/fill_kernels.py --num-t 256 --size 512
+"""
+
+import time
+
+import click
+import numpy as np
+
+from two_photon import artefact_index, interpolate
+
+
+def synthetic_data(num_t, num_z, size, artefact_frac, seed=0):
+    """Random uint16 movie, with artefacts of 8-40 rows in a fraction of the frames."""
+    random = np.random.RandomState(seed)
+    data = random.randint(0, 4000, size=(num_t, num_z, size, size)).astype(np.uint16)
+    num_artefacts = int(artefact_frac * num_t * num_z)
+    t = random.randint(0, num_t, num_artefacts)
+    z = random.randint(0, num_z, num_artefacts)
+    row_start = random.randint(0, size - 40, num_artefacts)
+    row_stop = row_start + random.randint(8, 41, num_artefacts)
+    return data, artefact_index.ArtefactIndex.from_arrays(t, z, row_start, row_stop, num_t)
+
+
+@click.command()
+@click.option("--num-t", type=int, default=256, show_default=True, help="Number of time points.")
+@click.option("--num-z", type=int, default=3, show_default=True, help="Number of z-planes.")
+@click.option("--size", type=int, default=512, show_default=True, help="Frame height and width, in pixels.")
+@click.option("--artefact-frac", type=float, default=0.1, show_default=True, help="Fraction of frames with artefacts.")
+@click.option("--repeats", type=int, default=3, show_default=True, help="Timed runs per kernel; the best is reported.")
+def main(num_t, num_z, size, artefact_frac, repeats):
+    data, index = synthetic_data(num_t, num_z, size, artefact_frac)
+    mask = index.mask(0, num_t, num_z, size)
+    artefact_mb = mask.sum() * size * data.itemsize / 1e6
+    print(f"Data {data.shape} ({data.nbytes / 1e6:.0f} MB), {len(index)} artefacts ({artefact_mb:.1f} MB of rows)")
+
+    for name in interpolate.FILL_KERNELS:
+        elapsed = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            interpolate.fill_block(data, mask, name)
+            elapsed.append(time.perf_counter() - start)
+        best = min(elapsed)
+        data_rate, row_rate = data.nbytes / 1e6 / best, artefact_mb / best
+        print(f"{name:>8}: {best:.3f} s, {data_rate:.0f} MB/s of data, {row_rate:.1f} MB/s of artefact rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Benchmark of ROI trace extraction by sparse matrix products, against Suite2p's extraction.
+
+Run, with the package installed (pip install -e .), with:
+
+    python benchmarks/roi_traces.py --num-t 2000 --size 512 --num-rois 500
+
+Suite2p's own extract_traces is timed on the same masks if suite2p is installed.  A loop over
+ROIs, as in notebooks, is always timed as a baseline.
+"""
+
+import time
+
+import click
+import numpy as np
+
+from two_photon import traces
+
+
+def synthetic_plane(num_t, size, num_rois, seed=0):
+    """Random uint16 movie of one plane, with num_rois square ROIs of random weights."""
+    random = np.random.RandomState(seed)
+    data = random.randint(0, 4000, size=(num_t, 1, size, size)).astype(np.uint16)
+    stat = []
+    for _ in range(num_rois):
+        y0, x0 = random.randint(0, size - 10, 2)
+        ypix, xpix = [a.ravel() for a in np.mgrid[y0 : y0 + 10, x0 : x0 + 10]]
+        stat.append({"ypix": ypix, "xpix": xpix, "lam": random.rand(100), "overlap": np.zeros(100, dtype=bool)})
+    return data, np.array(stat)
+
+
+def extract_loop(data, stat, neuropil):
+    """Traces of each ROI and its neuropil in turn, by fancy indexing of the movie."""
+    f_cells = np.empty((len(stat), data.shape[0]), dtype=np.float32)
+    f_neuropil = np.empty_like(f_cells)
+    movie = data[:, 0].astype(np.float32)
+    pixels = movie.reshape(len(movie), -1)
+    for num, roi in enumerate(stat):
+        lam = roi["lam"] / roi["lam"].sum()
+        f_cells[num] = movie[:, roi["ypix"], roi["xpix"]] @ lam
+        f_neuropil[num] = pixels[:, neuropil[num].indices].mean(axis=1)
+    return f_cells, f_neuropil
+
+
+def extract_suite2p(data, cells, neuropil):
+    """Suite2p's extraction, on masks in its (pixel indices, weights) format."""
+    from suite2p.extraction.extract import extract_traces
+
+    cell_masks = [(row.indices, row.data) for row in cells]
+    neuropil_masks = [row.indices for row in neuropil]
+    return extract_traces(data[:, 0], cell_masks, neuropil_masks, batch_size=500)
+
+
+def best_time(func, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+@click.command()
+@click.option("--num-t", type=int, default=2000, show_default=True, help="Number of time points.")
+@click.option("--size", type=int, default=512, show_default=True, help="Frame height and width, in pixels.")
+@click.option("--num-rois", type=int, default=500, show_default=True, help="Number of ROIs.")
+@click.option("--repeats", type=int, default=3, show_default=True, help="Timed runs per method; the best is reported.")
+def main(num_t, size, num_rois, repeats):
+    data, stat = synthetic_plane(num_t, size, num_rois)
+    print(f"Data {data.shape} ({data.nbytes / 1e6:.0f} MB), {num_rois} ROIs")
+
+    start = time.perf_counter()
+    plane = {"cells": traces.cell_weights(stat, (size, size)), "ref": None}
+    plane["neuropil"] = traces.neuropil_weights(stat, (size, size))
+    print(f"{'masks':>8}: {time.perf_counter() - start:.3f} s")
+
+    timings = {
+        "sparse": lambda: traces.extract(data, [plane]),
+        "loop": lambda: extract_loop(data, stat, plane["neuropil"]),
+    }
+    try:
+        import suite2p  # noqa: F401
+
+        timings["suite2p"] = lambda: extract_suite2p(data, plane["cells"], plane["neuropil"])
+    except ImportError:
+        print("suite2p is not installed, so its extraction is not timed")
+
+    for name, func in timings.items():
+        best = best_time(func, repeats)
+        print(f"{name:>8}: {best:.3f} s, {data.nbytes / 1e6 / best:.0f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
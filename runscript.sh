@@ -5,6 +5,12 @@
 
 set -e
 
+# With RIP_QUEUE set, run a rip service on that queue directory instead of a single rip.  The
+# service keeps its own pool of wine prefixes and an Xvfb display, so needs neither step below.
+if [[ -n "${RIP_QUEUE}" ]]; then
+    exec 2p-rip-service --queue-dir "${RIP_QUEUE}" --pool-size "${RIP_POOL_SIZE:-2}" --xvfb-display :99
+fi
+
 # USE_XVFB means xvfb is already running.  If it is unset, xvfb-run should wrap commands.
 [[ -z "${USE_XVFB}" ]] && CMDPREFIX=xvfb-run
 
@@ -0,0 +1,125 @@
+"""Tests of analyze.py module, using a stub in place of Suite2p."""
+
+import pathlib
+import textwrap
+
+import h5py
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from two_photon import backup, cli, concat, layout
+
+ACQUISITION = "20210428M198/slm-001"
+
+STUB_INIT = """
+import pathlib
+
+import h5py
+import numpy as np
+
+from . import io
+
+
+def run_s2p(ops):
+    # Record the mean of each frame of the (single plane) input as the "trace".
+    (data_path,) = ops["data_path"]
+    (h5_path,) = pathlib.Path(data_path).glob("*.h5")
+    with h5py.File(h5_path, "r") as h5file:
+        data = h5file[ops["h5py_key"]][()]
+    plane_path = pathlib.Path(ops["save_path0"]) / ops.get("save_folder", "suite2p") / "plane0"
+    plane_path.mkdir(parents=True)
+    np.save(plane_path / "F.npy", data.mean(axis=(1, 2))[np.newaxis])
+    np.save(plane_path / "ops.npy", {**ops, "save_path": str(plane_path), "reg_file": str(plane_path / "data.bin")})
+"""
+
+STUB_IO = """
+import pathlib
+
+
+def combined(save_folder, save=True):
+    planes = sorted(p.name for p in pathlib.Path(save_folder).glob("plane*"))
+    (pathlib.Path(save_folder) / "combined").mkdir()
+    (pathlib.Path(save_folder) / "combined" / "planes.txt").write_text(" ".join(planes))
+"""
+
+
+@pytest.fixture
+def stub_suite2p(tmp_path, monkeypatch):
+    stub_path = tmp_path / "stub"
+    (stub_path / "suite2p").mkdir(parents=True)
+    (stub_path / "suite2p" / "__init__.py").write_text(textwrap.dedent(STUB_INIT))
+    (stub_path / "suite2p" / "io.py").write_text(textwrap.dedent(STUB_IO))
+    # Make the stub importable both here and in worker processes.
+    monkeypatch.syspath_prepend(str(stub_path))
+    monkeypatch.setenv("PYTHONPATH", str(stub_path))
+
+
+@pytest.fixture
+def data_layout(tmp_path):
+    lo = layout.Layout(pathlib.Path(tmp_path) / "data", ACQUISITION)
+    data = np.random.RandomState(0).randint(0, 1000, size=(6, 3, 4, 5)).astype(np.uint16)
+    lo.preprocess_h5_path().parent.mkdir(parents=True)
+    with h5py.File(lo.preprocess_h5_path(), "w") as h5file:
+        h5file.create_dataset("data", data=data)
+    concat.write_info(lo.preprocess_info_path(), data.shape, data.dtype, 0.03)
+    return lo, data
+
+
+def run_analyze(lo, *args):
+    result = CliRunner().invoke(
+        cli.cli, ["--base-path", str(lo.base_path), "--acquisition", lo.acquisition, "analyze"] + list(args)
+    )
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def test_analyze_plane_workers(stub_suite2p, data_layout):
+    lo, data = data_layout
+    run_analyze(lo, "--plane-workers", "2")
+
+    save_path = lo.path("analyze") / "suite2p"
+    for z in range(3):
+        ops = np.load(save_path / f"plane{z}" / "ops.npy", allow_pickle=True).item()
+        assert (ops["iplane"], ops["nplanes"]) == (z, 3)
+        assert ops["reg_file"] == str(save_path / f"plane{z}" / "data.bin")
+        F = np.load(save_path / f"plane{z}" / "F.npy")
+        np.testing.assert_allclose(F[0], data[:, z].mean(axis=(1, 2)))
+    assert (save_path / "combined" / "planes.txt").read_text() == "plane0 plane1 plane2"
+
+
+def test_analyze_single_plane_then_merge(stub_suite2p, data_layout):
+    lo, data = data_layout
+    for z in range(3):
+        run_analyze(lo, "--plane", str(z))
+    assert not (lo.path("analyze") / "suite2p" / "combined").exists()
+
+    run_analyze(lo, "--merge-planes")
+    assert (lo.path("analyze") / "suite2p" / "combined" / "planes.txt").exists()
+    F = np.load(lo.path("analyze") / "suite2p" / "plane1" / "F.npy")
+    np.testing.assert_allclose(F[0], data[:, 1].mean(axis=(1, 2)))
+
+
+def test_analyze_sbatch(data_layout):
+    lo, _ = data_layout
+    run_analyze(lo, "--sbatch")
+    script = (lo.path("analyze") / "analyze_planes.sbatch").read_text()
+    assert "#SBATCH --array=0-2" in script
+    assert "analyze --input-format h5 --plane $SLURM_ARRAY_TASK_ID" in script
+    assert "--merge-planes" in script
+
+
+def test_analyze_sbatch_leaves_stage_unfinished(data_layout, monkeypatch, tmp_path):
+    lo, _ = data_layout
+    done = []
+    monkeypatch.setattr(backup.BackgroundBackup, "stage_done", lambda self, stage: done.append(stage))
+    args = ["--base-path", str(lo.base_path), "--acquisition", lo.acquisition]
+    args += ["--async-backup-path", str(tmp_path), "--stage-root", f"analyze={tmp_path / 'scratch'}"]
+
+    result = CliRunner().invoke(cli.cli, args + ["analyze", "--sbatch"])
+
+    assert result.exit_code == 0, result.output
+    assert "analyze" not in done
+    # The script is written back, with the stage roots, for the array tasks to read.
+    script = (lo.base_path_of("analyze") / "analyze_planes.sbatch").read_text()
+    assert f"--stage-root analyze={tmp_path / 'scratch'} analyze" in script
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from two_photon import artefact_image, artefact_index, preprocess
+
+
+def make_data(num_t=60, num_z=2, num_y=32, seed=0):
+    """Noisy movie with slow bleaching, and bright artefact bands of known (t, z, row_start, row_stop)."""
+    rng = np.random.RandomState(seed)
+    data = rng.normal(1000, 20, size=(num_t, num_z, num_y, 16))
+    data *= np.linspace(1, 0.8, num_t)[:, np.newaxis, np.newaxis, np.newaxis]
+    # The stim at (10, 1) runs on from the last rows into the first rows of the next frame, (11, 0).
+    regions = [(3, 0, 5, 9), (10, 1, 26, 32), (11, 0, 0, 4), (40, 0, 12, 20), (40, 1, 2, 5)]
+    for t, z, row_start, row_stop in regions:
+        data[t, z, row_start:row_stop] += 300
+    return data.astype(np.uint16), regions
+
+
+def test_detect(monkeypatch):
+    monkeypatch.setattr(artefact_image, "BLOCK_TIMEPOINTS", 7)
+    data, regions = make_data()
+
+    df_artefacts = artefact_image.detect(data)
+
+    assert df_artefacts[["t", "z", "row_start", "row_stop"]].values.tolist() == [list(r) for r in regions]
+    assert df_artefacts["frame"].tolist() == [6, 21, 22, 80, 81]
+    assert df_artefacts["stim"].tolist() == [0, 1, 1, 2, 3]
+    np.testing.assert_allclose(df_artefacts["frac_stop"], df_artefacts["row_stop"] / 32)
+
+
+def test_detect_feeds_removal():
+    data, regions = make_data()
+    df_artefacts = artefact_image.detect(data, buffer_rows=1)
+
+    index = preprocess.artefact_index_from_df(df_artefacts, data.shape[0])
+    cleaned = preprocess.remove_artefacts_block(data, index, 0, data.shape[0])
+
+    for t, z, row_start, row_stop in regions:
+        assert abs(cleaned[t, z, row_start:row_stop].mean() - data[t - 1, z, row_start:row_stop].mean()) < 50
+    assert artefact_image.detect(cleaned).empty
+
+
+def test_detect_piezo_and_polarity():
+    data, regions = make_data()
+    data = np.iinfo(np.uint16).max - data  # Artefacts now darken rows.
+
+    assert artefact_image.detect(data).empty
+    df_artefacts = artefact_image.detect(data, polarity="dark", piezo_period_frames=5, piezo_skip_frames=3)
+    assert df_artefacts[["t", "z"]].values.tolist() == [[t, z] for t, z, _, _ in regions]
+    assert df_artefacts["frame"].tolist() == [18, 54, 58, 203, 204]
+    # Skipped frames lie between the end of plane 1 and the start of plane 0.
+    assert df_artefacts["stim"].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_artefact_mask():
+    scores = np.zeros((1, 1, 12))
+    scores[0, 0, [1, 4, 5, 9, 10, 11]] = 10
+
+    mask = artefact_image.artefact_mask(scores, threshold=5, min_rows=2, buffer_rows=1)
+
+    assert np.flatnonzero(mask[0, 0]).tolist() == [3, 4, 5, 6, 8, 9, 10, 11]
+    assert [a.tolist() for a in artefact_image.mask_regions(mask)] == [[0, 0], [0, 0], [3, 8], [7, 12]]
+
+
+def test_compare():
+    df_expected = pd.DataFrame({"t": [1, 2, 3, 5], "z": 0, "row_start": [4, 0, 10, 10], "row_stop": [8, 6, 20, 32]})
+    df_detected = pd.DataFrame({"t": [1, 2, 3, 7], "z": 0, "row_start": [6, 0, 12, 1], "row_stop": [9, 7, 21, 2]})
+
+    comparison = artefact_image.compare(df_detected, df_expected, 32)
+
+    assert comparison == {
+        "expected_frames": 4,
+        "detected_frames": 4,
+        "matched_frames": 3,
+        "missed_frames": 1,
+        "extra_frames": 1,
+        "start_offset_rows": 2.0,
+        "stop_offset_rows": 1.0,
+    }
+
+
+def test_artefacts_from_image(tmp_path, caplog):
+    data, regions = make_data()
+    df_voltage = artefact_image.detect(data)
+    df_voltage["row_start"] -= 1
+    path = tmp_path / "image_artefacts.h5"
+
+    df_artefacts = preprocess.artefacts_from_image(data, data.shape, 0.03, artefacts_path=path, df_expected=df_voltage)
+    assert "start 1.0 rows after those expected" in caplog.text
+
+    pd.testing.assert_frame_equal(artefact_index.read_table(path), df_artefacts)
+    params = artefact_index.read_params(path)
+    assert params["artefact_source"] == "image"
+    assert params["matched_frames"] == len(regions)
+    assert params["start_offset_rows"] == 1.0
+
+
+def test_artefacts_from_image_start_before(caplog):
+    data, _ = make_data()
+    df_voltage = artefact_image.detect(data)
+    df_voltage["row_start"] += 2
+
+    preprocess.artefacts_from_image(data, data.shape, 0.03, df_expected=df_voltage)
+    assert "start 2.0 rows before those expected" in caplog.text
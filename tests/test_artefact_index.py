@@ -0,0 +1,65 @@
+"""Tests of artefact_index.py module."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from two_photon import artefact_index
+
+
+def test_artefact_index_lookup_and_mask():
+    index = artefact_index.ArtefactIndex.from_arrays(
+        t=[3, 0, 3, 7], z=[1, 0, 0, 1], row_start=[2, 0, 1, 4], row_stop=[4, 1, 3, 6], num_timepoints=8
+    )
+    assert len(index) == 4
+
+    z, row_start, row_stop = index.lookup(3)
+    assert sorted(zip(z, row_start, row_stop)) == [(0, 1, 3), (1, 2, 4)]
+    assert len(index.lookup(5)[0]) == 0
+    assert len(index.lookup(100)[0]) == 0
+
+    t, _, _, _ = index.lookup_range(1, 8)
+    np.testing.assert_array_equal(t, [3, 3, 7])
+
+    mask = index.mask(2, 5, num_z=2, num_y=6)
+    expected = np.zeros((3, 2, 6), dtype=bool)
+    expected[1, 1, 2:4] = True
+    expected[1, 0, 1:3] = True
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_artefact_file_roundtrip(tmp_path):
+    df_artefacts = pd.DataFrame(
+        {"frame": [6, 0, 7], "frac_start": [0.5, 0.0, 0.25], "t": [3, 0, 3], "z": [0, 0, 1], "row_start": [2, 0, 1]}
+    )
+    df_artefacts["row_stop"] = df_artefacts["row_start"] + 2
+    df_stims = pd.DataFrame({"start": [1.5, 10.0], "stop": [2.5, 11.0]})
+    index = artefact_index.ArtefactIndex.from_arrays(
+        df_artefacts["t"], df_artefacts["z"], df_artefacts["row_start"], df_artefacts["row_stop"], num_timepoints=5
+    )
+    path = tmp_path / "artefacts.h5"
+    params = {"shift_px": 1.5, "piezo_skip_frames": None}
+    artefact_index.write(path, index, df_artefacts, df_stims=df_stims, params=params)
+
+    loaded = artefact_index.read(path)
+    assert loaded.num_timepoints == 5
+    for t in range(5):
+        for expected, actual in zip(index.lookup(t), loaded.lookup(t)):
+            np.testing.assert_array_equal(actual, expected)
+
+    pd.testing.assert_frame_equal(artefact_index.read_table(path), df_artefacts)
+    pd.testing.assert_frame_equal(artefact_index.read_table(path, "stims"), df_stims)
+    with pytest.raises(artefact_index.ArtefactIndexError):
+        artefact_index.read_table(path, "frames")
+    assert artefact_index.read_params(path) == {"shift_px": 1.5}
+
+
+def test_artefact_file_unversioned(tmp_path):
+    df_artefacts = pd.DataFrame({"t": [2, 0], "z": [1, 0], "row_start": [0, 3], "row_stop": [1, 5]})
+    path = tmp_path / "artefacts.h5"
+    df_artefacts.to_hdf(path, key="artefacts")
+
+    pd.testing.assert_frame_equal(artefact_index.read_table(path), df_artefacts)
+    z, row_start, row_stop = artefact_index.read(path).lookup(2)
+    assert list(zip(z, row_start, row_stop)) == [(1, 0, 1)]
+    assert artefact_index.read_params(path) == {}
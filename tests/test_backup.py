@@ -0,0 +1,54 @@
+import shutil
+import threading
+
+import pytest
+
+from two_photon import backup, layout
+
+
+def test_background_backup(tmp_path, monkeypatch):
+    calls = []
+    release = threading.Event()
+
+    def fake_backup_stage(layout, backup_path, stage, bwlimit=None):
+        release.wait(5)
+        calls.append((stage, bwlimit))
+
+    monkeypatch.setattr(backup, "backup_stage", fake_backup_stage)
+    lo = layout.Layout(tmp_path / "data", "acq/001")
+    uploader = backup.BackgroundBackup(lo, tmp_path / "backup", ["raw", "convert"], workers=2, bwlimit=100)
+
+    uploader.stage_done("raw")
+    uploader.stage_done("tiff")  # Not a stage to back up.
+    uploader.stage_done("convert")
+    assert not calls  # Backups run in the background until released.
+    release.set()
+    uploader.wait()
+
+    assert sorted(calls) == [("convert", 100), ("raw", 100)]
+
+
+def test_background_backup_failed(tmp_path, monkeypatch):
+    def fake_backup_stage(layout, backup_path, stage, bwlimit=None):
+        if stage == "convert":
+            raise backup.BackupError("disk full")
+
+    monkeypatch.setattr(backup, "backup_stage", fake_backup_stage)
+    uploader = backup.BackgroundBackup(layout.Layout(tmp_path, "acq"), tmp_path / "backup", ["raw", "convert"])
+    uploader.stage_done("raw")
+    uploader.stage_done("convert")
+
+    with pytest.raises(backup.BackupError, match="convert"):
+        uploader.wait()
+
+
+@pytest.mark.skipif(shutil.which("rsync") is None, reason="rsync not installed")
+def test_backup_stage_rsync(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup.platform, "system", lambda: "Linux")
+    lo = layout.Layout(tmp_path / "data", "acq/001")
+    (lo.path("convert") / "sub").mkdir(parents=True)
+    (lo.path("convert") / "sub" / "orig.h5").write_bytes(b"data")
+
+    backup.backup_stage(lo, tmp_path / "backup", "convert", bwlimit=1000)
+
+    assert (lo.backup_path(tmp_path / "backup", "convert") / "sub" / "orig.h5").read_bytes() == b"data"
@@ -0,0 +1,60 @@
+"""Tests of concat.py module."""
+
+import pathlib
+
+import h5py
+import numpy as np
+import pytest
+
+from two_photon import concat, layout
+
+XML = '<PVScan><PVStateValue key="framePeriod" value="%s" /></PVScan>'
+
+
+def write_acquisition(lo, acquisition, data, frame_period=0.033):
+    lo.preprocess_h5_path(acquisition).parent.mkdir(parents=True)
+    with h5py.File(lo.preprocess_h5_path(acquisition), "w") as h5file:
+        h5file.create_dataset("data", data=data)
+    lo.raw_xml_path(acquisition).parent.mkdir(parents=True)
+    lo.raw_xml_path(acquisition).write_text(XML % frame_period)
+
+
+def test_concat_vds(tmp_path):
+    lo = layout.Layout(pathlib.Path(tmp_path), "20210428M198/slm-001")
+    acquisitions = ["20210428M198/slm-001", "20210428M198/slm-002"]
+    data = [np.full((n, 2, 3, 4), n, dtype=np.uint16) for n in (5, 3)]
+    for acquisition, acq_data in zip(acquisitions, data):
+        write_acquisition(lo, acquisition, acq_data)
+
+    infos = [concat.read_info(lo, acquisition) for acquisition in acquisitions]
+    assert lo.preprocess_info_path(acquisitions[1]).exists()
+    assert infos[1] == {"shape": [3, 2, 3, 4], "dtype": "uint16", "frame_period": 0.033}
+
+    offsets = concat.frame_offsets(infos, acquisitions)
+    np.testing.assert_array_equal(offsets, [0, 5, 8])
+
+    sources = [lo.preprocess_h5_path(acquisition) for acquisition in acquisitions]
+    concat.write_vds(lo.concat_h5_path(), sources, infos, offsets, acquisitions)
+    with h5py.File(lo.concat_h5_path(), "r") as h5file:
+        np.testing.assert_array_equal(h5file["data"][()], np.concatenate(data))
+        np.testing.assert_array_equal(h5file["data"].attrs["frame_offsets"], offsets)
+        assert not any(pathlib.Path(vmap.file_name).is_absolute() for vmap in h5file["data"].virtual_sources())
+
+    names, stored_offsets = concat.read_offsets(lo.concat_h5_path())
+    assert names == acquisitions
+    traces = np.arange(2 * 8).reshape((2, 8))
+    parts = concat.split_traces(traces, stored_offsets)
+    np.testing.assert_array_equal(parts[1], traces[:, 5:])
+
+
+def test_concat_mismatch(tmp_path):
+    lo = layout.Layout(pathlib.Path(tmp_path), "a/x")
+    write_acquisition(lo, "a/x", np.zeros((4, 2, 3, 4), dtype=np.uint16))
+    write_acquisition(lo, "a/y", np.zeros((4, 2, 3, 4), dtype=np.uint16), frame_period=0.05)
+    write_acquisition(lo, "a/z", np.zeros((4, 1, 3, 4), dtype=np.uint16))
+    infos = {acquisition: concat.read_info(lo, acquisition) for acquisition in ["a/x", "a/y", "a/z"]}
+
+    with pytest.raises(concat.ConcatError, match="frame period"):
+        concat.frame_offsets([infos["a/x"], infos["a/y"]], ["a/x", "a/y"])
+    with pytest.raises(concat.ConcatError, match="shape"):
+        concat.frame_offsets([infos["a/x"], infos["a/z"]], ["a/x", "a/z"])
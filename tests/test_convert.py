@@ -0,0 +1,30 @@
+"""Tests of convert.py module."""
+
+import numpy as np
+import pytest
+from test_tiff_index import write_acquisition
+
+from two_photon import convert, storage, tiff_index
+
+
+@pytest.mark.parametrize("read_workers, read_ahead", [(1, 0), (4, 2)])
+def test_read_blocks_in_order(tmp_path, monkeypatch, read_workers, read_ahead):
+    monkeypatch.setattr(convert, "READ_BLOCK_TIMEPOINTS", 2)
+    data = np.arange(7 * 2 * 3 * 4, dtype=np.uint16).reshape((7, 2, 3, 4))
+    index = tiff_index.TiffIndex.from_xml(write_acquisition(tmp_path, data), channel=3)
+
+    blocks = list(convert.read_blocks(index, tmp_path, read_workers, read_ahead))
+
+    assert [(t_start, t_stop) for t_start, t_stop, _ in blocks] == [(0, 2), (2, 4), (4, 6), (6, 7)]
+    np.testing.assert_array_equal(np.concatenate([block for _, _, block in blocks]), data)
+
+
+def test_convert_indexed(tmp_path):
+    data = np.arange(5 * 2 * 3 * 4, dtype=np.uint16).reshape((5, 2, 3, 4))
+    xml_path = write_acquisition(tmp_path, data)
+    orig_path = tmp_path / "orig.h5"
+
+    convert.convert_indexed(xml_path, 3, tmp_path, orig_path, tmp_path / "tiff_index.npz", read_workers=2)
+
+    with storage.open_store(orig_path, "r") as store:
+        np.testing.assert_array_equal(store["data"][:], data)
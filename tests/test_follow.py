@@ -0,0 +1,40 @@
+"""Tests of follow.py module."""
+
+import numpy as np
+import pandas as pd
+import pytest
+from test_tiff_index import write_acquisition
+
+from two_photon import follow, preprocess, storage, tiff_index
+
+
+def test_tiff_watcher_waits_for_stable_size(tmp_path):
+    data = np.zeros((3, 2, 4, 4), dtype=np.uint16)
+    index = tiff_index.TiffIndex.from_xml(write_acquisition(tmp_path, data), channel=3)
+    watcher = follow.TiffWatcher(index, [tmp_path / "missing", tmp_path])
+
+    assert watcher.poll() == []  # Sizes are only known after the first poll.
+    assert sorted(watcher.poll()) == list(range(6))
+    assert watcher.pending == []
+    assert watcher.frames[3] == [(1, 1, 0)]
+
+
+@pytest.mark.parametrize("suffix", [".h5", ".zarr"])
+def test_run_follow(tmp_path, suffix):
+    data = np.random.RandomState(0).randint(0, 60000, size=(10, 2, 6, 4)).astype(np.uint16)
+    index = tiff_index.TiffIndex.from_xml(write_acquisition(tmp_path, data), channel=3)
+    df_artefacts = pd.DataFrame(
+        {"t": [1, 4, 5, 8], "z": [0, 1, 1, 0], "row_start": [0, 2, 1, 3], "row_stop": [2, 5, 4, 6]}
+    )
+
+    watcher = follow.TiffWatcher(index, [tmp_path])
+    orig_path, pre_path = tmp_path / ("orig" + suffix), tmp_path / ("pre" + suffix)
+    with storage.open_store(orig_path, "w") as orig_store, storage.open_store(pre_path, "w") as pre_store:
+        follow.run_follow(watcher, orig_store, pre_store, lambda shape: df_artefacts, poll_secs=0, block_timepoints=3)
+
+    expected = preprocess.remove_artefacts_block(data, preprocess.artefact_index_from_df(df_artefacts, 10), 0, 10)
+    with storage.open_store(orig_path, "r") as store:
+        np.testing.assert_array_equal(store["data"][...], data)
+    with storage.open_store(pre_path, "r") as store:
+        np.testing.assert_array_equal(store["data"][...], expected)
+        np.testing.assert_allclose(store["stats/mean"][...], expected.mean(axis=0), rtol=1e-6)
@@ -0,0 +1,89 @@
+"""Tests of frames.py module."""
+
+import io
+import pathlib
+import threading
+import urllib.request
+
+import h5py
+import numpy as np
+import pytest
+
+from two_photon import frames, layout, storage
+
+
+@pytest.fixture
+def data_layout(tmp_path):
+    lo = layout.Layout(pathlib.Path(tmp_path), "20210428M198/slm-001")
+    data = np.random.RandomState(0).randint(0, 1000, size=(10, 3, 4, 5)).astype(np.uint16)
+
+    lo.orig_h5_path().parent.mkdir(parents=True)
+    with h5py.File(lo.orig_h5_path(), "w") as h5file:
+        h5file.create_dataset("data", data=data, chunks=(2, 1, 4, 5))
+
+    lo.preprocess_h5_path().parent.mkdir(parents=True)
+    with h5py.File(lo.preprocess_h5_path(), "w") as h5file:
+        h5file.create_dataset("data", data=data + 1)  # Contiguous, i.e. unchunked.
+
+    return lo, data
+
+
+def test_frame_server(data_layout):
+    lo, data = data_layout
+    with frames.FrameServer(lo) as server:
+        assert server.shape("orig") == data.shape
+        np.testing.assert_array_equal(server.frame("orig", 3, 2), data[3, 2])
+        np.testing.assert_array_equal(server.frame("preprocess", 9, 0), data[9, 0] + 1)
+        np.testing.assert_array_equal(server.frames("orig", 2, 7, 1), data[2:7, 1])
+        np.testing.assert_array_equal(server.view("orig")[5, 1], data[5, 1])
+
+        np.testing.assert_allclose(server.projection("orig", 1, "mean"), data[:, 1].mean(axis=0), rtol=1e-6)
+        np.testing.assert_array_equal(server.projection("preprocess", 2, "max"), data[:, 2].max(axis=0) + 1)
+
+        with pytest.raises(frames.FrameServerError):
+            server.frame("orig", 10, 0)
+        assert server.frames("orig", 7, 3, 1).shape == (0, 4, 5)
+        assert server.frames("orig", 10, 12, 1).shape == (0, 4, 5)
+        np.testing.assert_array_equal(server.frames("orig", 8, 20, 1), data[8:, 1])
+        for t_start, z in [(-1, 0), (11, 0), (0, 3)]:
+            with pytest.raises(frames.FrameServerError):
+                server.frames("orig", t_start, 10, z)
+
+
+def test_frame_server_cache_bound(data_layout):
+    lo, data = data_layout
+    chunk_nbytes = 2 * 1 * 4 * 5 * data.itemsize
+    with frames.FrameServer(lo, cache_bytes=3 * chunk_nbytes) as server:
+        for t in range(10):
+            server.frame("orig", t, 0)
+        assert len(server._chunks) == 3
+        assert server._chunks_nbytes <= 3 * chunk_nbytes
+
+
+def test_frame_server_http(data_layout):
+    lo, data = data_layout
+    with frames.FrameServer(lo) as server:
+        httpd = frames.http.server.ThreadingHTTPServer(("127.0.0.1", 0), frames.make_handler(server))
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/frame/orig/4/2" % httpd.server_address[1]
+            with urllib.request.urlopen(url) as response:
+                frame = np.load(io.BytesIO(response.read()))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+    np.testing.assert_array_equal(frame, data[4, 2])
+
+
+def test_frame_server_zarr(tmp_path):
+    lo = layout.Layout(pathlib.Path(tmp_path), "20210428M198/slm-001")
+    data = np.arange(4 * 2 * 3 * 3, dtype=np.uint16).reshape((4, 2, 3, 3))
+    zarr_path = storage.with_backend(lo.orig_h5_path(), "zarr")
+    with storage.open_store(zarr_path, "w") as store:
+        store.create("data", data=data, chunks=(1, 1, 3, 3))
+
+    with frames.FrameServer(lo) as server:
+        assert server.path("orig") == zarr_path
+        np.testing.assert_array_equal(server.frame("orig", 2, 1), data[2, 1])
+        np.testing.assert_array_equal(server.projection("orig", 0, "max"), data[:, 0].max(axis=0))
@@ -55,3 +55,40 @@ def test_interpolate_nan_extrapolation_error():
     data = np.array([1.0, 2.0, np.nan]).reshape((3, 1, 1))
     with pytest.raises(ValueError):
         interpolate.interpolate_nan(data).compute()
+
+
+@pytest.mark.parametrize("kernel", sorted(interpolate.FILL_KERNELS))
+def test_fill_block_recovers_polynomials(kernel):
+    # Cubic in time, linear in y: the temporal kernels are exact (linear for runs of one frame).
+    t = np.arange(10, dtype=np.float32).reshape((10, 1, 1, 1))
+    y = np.arange(6, dtype=np.float32).reshape((1, 1, 6, 1))
+    if kernel == "cubic":
+        data = (t - 4) ** 3 + 3 * y + np.zeros((10, 2, 6, 3), dtype=np.float32)
+    else:
+        data = 2 * t + 3 * y + np.zeros((10, 2, 6, 3), dtype=np.float32)
+    mask = np.zeros((10, 2, 6), dtype=bool)
+    mask[4:6, 0, 1:3] = True
+    mask[7, 1, 4:6] = True  # Reaches the bottom of the frame.
+    if kernel == "rows":
+        data = 3 * y + np.zeros((10, 2, 6, 3), dtype=np.float32)
+        data[:, :, 4:] = data[:, :, 3:4]  # Rows below the last unaffected one are held at its value.
+
+    corrupted = data.copy()
+    corrupted[mask] = 1000
+    np.testing.assert_allclose(interpolate.fill_block(corrupted, mask, kernel), data, atol=1e-3)
+
+
+def test_fill_block_core_and_edges():
+    data = np.arange(8, dtype=np.float32).reshape((8, 1, 1, 1)) + np.zeros((8, 1, 2, 2), dtype=np.float32)
+    mask = np.zeros((8, 1, 2), dtype=bool)
+    mask[0:2, 0, 0] = True  # At the edge, outside the core.
+    mask[4, 0, 1] = True
+    corrupted = data.copy()
+    corrupted[mask] = -1
+
+    filled = interpolate.fill_block(corrupted, mask, "linear", core=(3, 6))
+    np.testing.assert_array_equal(filled[3:6], data[3:6])
+    np.testing.assert_array_equal(filled[0:2, 0, 0], -1)
+
+    filled = interpolate.fill_block(corrupted, mask, "linear")
+    np.testing.assert_array_equal(filled[0:2, 0, 0], 2)  # Held at the nearest unaffected value.
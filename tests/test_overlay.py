@@ -0,0 +1,41 @@
+"""Tests of overlay.py module."""
+
+import h5py
+import numpy as np
+
+from two_photon import artefact_index, overlay, preprocess, storage
+
+
+def test_overlay_matches_full_output(tmp_path):
+    data = np.random.RandomState(0).randint(0, 60000, size=(70, 2, 8, 3)).astype(np.uint16)
+    # Includes two runs in one frame, and rows at the top and bottom of frames.
+    index = artefact_index.ArtefactIndex.from_arrays(
+        t=[3, 3, 31, 32, 64, 69], z=[0, 0, 1, 1, 0, 1], row_start=[0, 5, 0, 2, 4, 6], row_stop=[2, 7, 4, 5, 8, 8]
+    )
+    orig_path = tmp_path / "orig.h5"
+    with storage.open_store(orig_path, "w") as store:
+        store.create("data", data=data, chunks=(1, 1, 8, 3))
+
+    out_path = tmp_path / "preprocess.h5"
+    with storage.open_store(out_path, "w") as store:
+        writer = overlay.OverlayWriter(store.root, orig_path, index, (60,) + data.shape[1:], np.uint16)
+        preprocess.remove_artefacts_parallel(orig_path, writer, out_path, index, (60,) + data.shape[1:], workers=2)
+        writer.close()
+
+    expected = preprocess.remove_artefacts_block(data[:60], index, 0, 60)
+    with h5py.File(out_path, "r") as h5file:
+        np.testing.assert_array_equal(h5file["data"][...], expected)
+        runs = overlay.read_runs(h5file)
+        # Artefacts after t=60 are beyond the time points preprocessed.
+        assert runs.tolist() == [(3, 0, 0, 2, 0), (3, 0, 5, 7, 2), (31, 1, 0, 4, 4), (32, 1, 2, 5, 8)]
+        assert h5file[overlay.ROWS_KEY].shape == (11, 3)
+        num_mappings = len(h5file["data"].virtual_sources())
+    assert num_mappings <= overlay.max_vds_mappings(index, (60,) + data.shape[1:]) == 16
+
+    # The converted data is referred to by a relative path, so both files can be moved together.
+    moved_path = tmp_path / "moved"
+    moved_path.mkdir()
+    orig_path.rename(moved_path / orig_path.name)
+    out_path.rename(moved_path / out_path.name)
+    with h5py.File(moved_path / out_path.name, "r") as h5file:
+        np.testing.assert_array_equal(h5file["data"][...], expected)
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from two_photon import placement
+
+
+@pytest.fixture
+def no_reflink(monkeypatch):
+    def fail(src, dst):
+        raise OSError("no reflinks")
+
+    monkeypatch.setattr(placement, "reflink", fail)
+
+
+def test_place_move(tmp_path):
+    (tmp_path / "a.xml").write_text("meta")
+
+    assert placement.place(tmp_path / "a.xml", tmp_path / "b.xml", move=True) == placement.RENAME
+    assert (tmp_path / "b.xml").read_text() == "meta"
+    assert not (tmp_path / "a.xml").exists()
+
+
+def test_place_hardlink(tmp_path, no_reflink):
+    (tmp_path / "a.xml").write_text("meta")
+
+    assert placement.place(tmp_path / "a.xml", tmp_path / "b.xml") == placement.HARDLINK
+    assert os.path.samefile(tmp_path / "a.xml", tmp_path / "b.xml")
+
+
+def test_place_copy(tmp_path, no_reflink):
+    data = os.urandom(1000)
+    (tmp_path / "a.tif").write_bytes(data)
+
+    assert placement.place(tmp_path / "a.tif", tmp_path / "b.tif", link=False) == placement.COPY
+    assert (tmp_path / "b.tif").read_bytes() == data
+    assert not os.path.samefile(tmp_path / "a.tif", tmp_path / "b.tif")
+
+
+def test_parallel_copy(tmp_path):
+    data = os.urandom(1000)
+    (tmp_path / "a.tif").write_bytes(data)
+
+    placement.parallel_copy(tmp_path / "a.tif", tmp_path / "b.tif", workers=3, chunk_bytes=64)
+    assert (tmp_path / "b.tif").read_bytes() == data
+
+
+def test_place_tree_move(tmp_path):
+    src = tmp_path / "acq" / "acq"
+    (src / "References").mkdir(parents=True)
+    (src / "x_000001.ome.tif").write_bytes(b"tif")
+    (src / "References" / "ref.tif").write_bytes(b"ref")
+
+    # The destination exists, so the files are moved one at a time.
+    strategies = placement.place_tree(src, tmp_path / "acq", move=True)
+    assert strategies == {placement.RENAME: 2}
+    assert (tmp_path / "acq" / "References" / "ref.tif").read_bytes() == b"ref"
+    assert not src.exists()
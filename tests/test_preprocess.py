@@ -1,8 +1,9 @@
-import pytest
-
+import click
+import numpy as np
 import pandas as pd
+import pytest
 
-from two_photon import preprocess
+from two_photon import artefact_index, interpolate, layout, preprocess, stats, storage, suite2p_binary
 
 
 @pytest.mark.parametrize("settle_ms,expected_fname", [(0, "frame_start.tsv"), (5, "frame_start_settle.tsv")])
@@ -38,3 +39,170 @@ def test_extract_stims(testdata, shift_ms, buffer_ms, expected_fname):
 
     df_stims_expected = pd.read_csv(testdata / expected_fname, sep="\t", index_col="stim")
     pd.testing.assert_frame_equal(df_stims, df_stims_expected)
+
+
+@pytest.mark.parametrize("fill_kernel", sorted(interpolate.FILL_KERNELS))
+def test_remove_artefacts_blocks_match_whole_kernels(fill_kernel):
+    data = np.random.RandomState(0).randint(0, 1000, size=(40, 2, 6, 3)).astype(np.uint16)
+    t = [5, 6, 7, 9, 19, 20, 21, 22, 30]
+    index = artefact_index.ArtefactIndex.from_arrays(t, [0] * len(t), [1] * len(t), [4] * len(t), 40)
+    halo = preprocess.artefact_halo(index, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+
+    whole = preprocess.remove_artefacts_block(data, index, 0, 40, fill_kernel=fill_kernel)
+    blocks = [
+        preprocess.remove_artefacts_block(data, index, t, min(t + 5, 40), 40, halo, fill_kernel)
+        for t in range(0, 40, 5)
+    ]
+    np.testing.assert_array_equal(np.concatenate(blocks), whole)
+    assert not np.array_equal(whole[5:8, 0, 1:4], data[5:8, 0, 1:4])
+
+
+def test_remove_artefacts_blocks_match_whole():
+    data = np.random.RandomState(0).randint(0, 60000, size=(40, 2, 8, 3)).astype(np.uint16)
+    # Includes a run of 3 consecutive time points in plane 1, which crosses block boundaries.
+    index = artefact_index.ArtefactIndex.from_arrays(
+        t=[2, 9, 10, 11, 20, 31], z=[0, 1, 1, 1, 0, 1], row_start=[1, 0, 2, 3, 5, 0], row_stop=[3, 4, 5, 8, 8, 2]
+    )
+    assert preprocess.artefact_halo(index) == 3
+
+    whole = preprocess.remove_artefacts_block(data, index, 0, data.shape[0])
+    blocks = [preprocess.remove_artefacts_block(data, index, t, min(t + 5, 40)) for t in range(0, 40, 5)]
+    np.testing.assert_array_equal(np.concatenate(blocks), whole)
+
+    # Reference: mark artefacts with nan and interpolate the full movie.
+    expected = data.astype(np.float32)
+    for t, z, y0, y1 in zip(index.t, index.z, index.row_start, index.row_stop):
+        expected[t, z, y0:y1] = np.nan
+    expected = np.clip(interpolate.interpolate_nan(expected), 0, 65535).astype(np.uint16)
+    np.testing.assert_array_equal(whole, expected)
+
+
+def test_artefact_halo_rows_move():
+    # Every time point of plane 0 has an artefact, but on alternating rows.
+    num_t = 10000
+    t = np.arange(num_t)
+    row_start = np.where(t % 2, 10, 0)
+    index = artefact_index.ArtefactIndex.from_arrays(t, np.zeros(num_t), row_start, row_start + 5, num_t)
+
+    assert preprocess.artefact_halo(index) == 1
+    assert preprocess.artefact_halo(index, neighbours=2) == 2
+
+    data = np.random.RandomState(0).randint(0, 1000, size=(40, 1, 16, 3)).astype(np.uint16)
+    small = artefact_index.ArtefactIndex.from_arrays(t[:40], np.zeros(40), row_start[:40], row_start[:40] + 5, 40)
+    whole = preprocess.remove_artefacts_block(data, small, 0, 40)
+    blocks = [preprocess.remove_artefacts_block(data, small, t, min(t + 5, 40)) for t in range(0, 40, 5)]
+    np.testing.assert_array_equal(np.concatenate(blocks), whole)
+
+
+def test_artefact_halo_too_long():
+    num_t = preprocess.MAX_HALO_TIMEPOINTS + 1
+    index = artefact_index.ArtefactIndex.from_arrays(np.arange(num_t), [1] * num_t, [3] * num_t, [4] * num_t)
+
+    with pytest.raises(preprocess.PreprocessError, match="Row 3 of plane 1 .* from 0"):
+        preprocess.artefact_halo(index)
+
+
+@pytest.mark.parametrize("suffix", [".h5", ".zarr"])
+def test_remove_artefacts_parallel(tmp_path, suffix):
+    data = np.random.RandomState(1).randint(0, 60000, size=(70, 2, 8, 3)).astype(np.uint16)
+    index = artefact_index.ArtefactIndex.from_arrays(
+        t=[3, 31, 32, 64], z=[0, 1, 1, 0], row_start=[1, 0, 2, 4], row_stop=[3, 4, 5, 8], num_timepoints=70
+    )
+    orig_path = tmp_path / "orig.h5"
+    with storage.open_store(orig_path, "w") as store:
+        store.create("data", data=data, chunks=(1, 1, 8, 3))
+
+    out_path = tmp_path / ("preprocess" + suffix)
+    with storage.open_store(out_path, "w") as store:
+        data_out = store.create("data", shape=data.shape, dtype=np.uint16, chunks=(1, 1, 8, 3))
+        writer = suite2p_binary.BinaryWriter(tmp_path / "suite2p", data.shape)
+        writer.create()
+        summary = preprocess.remove_artefacts_parallel(
+            orig_path, data_out, out_path, index, data.shape, workers=2, writer=writer
+        )
+
+    expected = preprocess.remove_artefacts_block(data, index, 0, data.shape[0])
+    with storage.open_store(out_path, "r") as store:
+        np.testing.assert_array_equal(store["data"][...], expected)
+    binary = np.fromfile(writer.raw_file(1), dtype=np.int16).reshape((-1, 8, 3))
+    np.testing.assert_array_equal(binary, expected[:, 1] // 2)
+    np.testing.assert_allclose(summary.mean, expected.mean(axis=0), rtol=1e-10)
+
+
+def test_resolve_piezo():
+    assert preprocess.resolve_piezo({}, 10, 2) == (10, 2)
+    assert preprocess.resolve_piezo({}) == (None, None)
+    assert preprocess.resolve_piezo({}, 10) == (10, 0)
+
+    attrs = {"piezo_period_frames": 10, "piezo_skip_frames": 2}
+    assert preprocess.resolve_piezo(attrs) == (10, 2)
+    assert preprocess.resolve_piezo(attrs, 10, 2) == (10, 2)
+    with pytest.raises(preprocess.PreprocessError):
+        preprocess.resolve_piezo(attrs, 10, 3)
+
+
+def test_shard_range():
+    ranges = [preprocess.shard_range(shard, 3, 10) for shard in range(3)]
+    assert ranges == [(0, 3), (3, 6), (6, 10)]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_shards(tmp_path, workers):
+    data = np.random.RandomState(2).randint(0, 60000, size=(23, 2, 8, 3)).astype(np.uint16)
+    # Includes a run of artefacts across the boundary between shards 0 and 1, at time point 7.
+    df_artefacts = pd.DataFrame(
+        {
+            "t": [3, 6, 7, 8, 15, 22],
+            "z": [0, 1, 1, 1, 0, 1],
+            "row_start": [1, 0, 2, 3, 5, 0],
+            "row_stop": [3, 4, 5, 8, 8, 2],
+        }
+    )
+    index = preprocess.artefact_index_from_df(df_artefacts, data.shape[0])
+    lo = layout.Layout(tmp_path, "acq")
+    lo.orig_h5_path().parent.mkdir(parents=True)
+    with storage.open_store(lo.orig_h5_path(), "w") as store:
+        store.create("data", data=data, chunks=(1, 1, 8, 3))
+    lo.artefacts_path().parent.mkdir(parents=True)
+    params = {"shape": list(data.shape), "frame_period": 0.03}
+    artefact_index.write(lo.artefacts_path(), index, df_artefacts, params=params)
+    suite2p_binary.BinaryWriter(lo.suite2p_binary_path(), data.shape).create()
+
+    preprocess.run_shards(lo, 3, workers, write_binary=True)
+
+    expected = preprocess.remove_artefacts_block(data, index, 0, data.shape[0])
+    with storage.open_store(lo.preprocess_h5_path(), "r") as store:
+        assert store["data"].is_virtual
+        np.testing.assert_array_equal(store["data"][...], expected)
+        np.testing.assert_allclose(stats.read(store, "mean"), expected.mean(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(stats.read(store, "frame_mean"), expected.mean(axis=(2, 3)), rtol=1e-6)
+    binary = np.fromfile(lo.suite2p_binary_path() / "plane1" / suite2p_binary.RAW_FILE, dtype=np.int16)
+    np.testing.assert_array_equal(binary.reshape((-1, 8, 3)), expected[:, 1] // 2)
+
+    # Shards are referred to by relative paths, so the stage can be moved.
+    moved = tmp_path / "moved"
+    lo.path("preprocess").rename(moved)
+    with storage.open_store(moved / "preprocess" / "preprocess.h5", "r") as store:
+        np.testing.assert_array_equal(store["data"][...], expected)
+
+
+def test_write_shards_script(tmp_path):
+    lo = layout.Layout(tmp_path, "acq", {"preprocess": tmp_path / "scratch"})
+    lo.path("preprocess").mkdir(parents=True)
+
+    submit = preprocess.write_shards_script(lo, 4, "cubic")
+
+    script = (lo.path("preprocess") / "preprocess_shards.sbatch").read_text()
+    assert "#SBATCH --array=0-3" in script
+    assert "preprocess --fill-kernel cubic --shard $SLURM_ARRAY_TASK_ID/4" in script
+    # Tasks stage their data as the submitting run did.
+    assert f"--stage-root preprocess={tmp_path / 'scratch'} preprocess" in script
+    assert "--shards 4 --merge-shards" in submit
+
+
+def test_parse_shard():
+    assert preprocess.parse_shard(None, None, "2/5") == (2, 5)
+    assert preprocess.parse_shard(None, None, None) is None
+    for value in ["5/5", "2", "a/5", "-1/5"]:
+        with pytest.raises(click.BadParameter):
+            preprocess.parse_shard(None, None, value)
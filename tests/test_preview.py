@@ -0,0 +1,30 @@
+"""Tests of preview.py module."""
+
+import numpy as np
+import scipy.ndimage
+
+from two_photon import preview
+
+
+def test_estimate_motion_recovers_shifts():
+    rng = np.random.RandomState(0)
+    reference = scipy.ndimage.gaussian_filter(rng.rand(2, 32, 40), (0, 2, 2)) * 1000
+    true_shifts = rng.randint(-3, 4, size=(70, 2, 2))
+    data = np.stack(
+        [[np.roll(reference[z], true_shifts[t, z], axis=(0, 1)) for z in range(2)] for t in range(70)]
+    ).astype(np.uint16)
+
+    result = preview.estimate_motion(data, reference, max_shift_frac=0.1, workers=2)
+
+    np.testing.assert_array_equal(result["shifts"], true_shifts)
+    assert result["peak"].min() > 0.5
+    np.testing.assert_allclose(result["mean_corrected"], reference.astype(np.uint16), atol=1e-3)
+
+
+def test_phase_correlation_limits_search():
+    reference = np.zeros((1, 20, 20))
+    reference[0, 5, 5] = 1
+    frames = np.roll(reference, (8, 0), axis=(1, 2))
+    ref_fft_conj = np.conj(preview._fft(reference, None))[0]
+    shifts, _ = preview.phase_correlation(frames, ref_fft_conj, (2, 2))
+    assert np.abs(shifts).max() <= 2
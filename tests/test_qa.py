@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from two_photon import artefact_index, qa
+
+
+def make_data(num_t=40, num_z=2, num_y=32, seed=0):
+    """Flat noisy movie, with one artefact per frame in rows 10:14, numbered by stim."""
+    data = np.random.RandomState(seed).normal(1000, 10, size=(num_t, num_z, num_y, 8)).astype(np.uint16)
+    t, z = [a.ravel() for a in np.mgrid[0:num_t, 0:num_z]]
+    df_artefacts = pd.DataFrame({"t": t, "z": z, "row_start": 10, "row_stop": 14, "stim": t})
+    index = artefact_index.ArtefactIndex.from_arrays(t, z, df_artefacts["row_start"], df_artefacts["row_stop"], num_t)
+    return data, index, df_artefacts
+
+
+def test_artefact_metrics(monkeypatch):
+    monkeypatch.setattr(qa, "BLOCK_TIMEPOINTS", 7)
+    data, index, df_artefacts = make_data()
+    data[5, 1, 10:14] = 2000  # A badly corrected artefact.
+
+    df_metrics = qa.artefact_metrics(data, index, df_artefacts)
+
+    assert len(df_metrics) == len(df_artefacts)
+    expected_row_mean = data[df_artefacts["t"], df_artefacts["z"], 10:14].mean(axis=(1, 2))
+    np.testing.assert_allclose(df_metrics["row_mean"], expected_row_mean)
+    expected_adjacent = np.concatenate([data[:, :, 6:10], data[:, :, 14:18]], axis=2).mean(axis=(2, 3)).ravel()
+    np.testing.assert_allclose(df_metrics["adjacent_mean"], expected_adjacent)
+    # Every frame has an artefact on the same rows, so there are no clean neighbouring rows.
+    assert df_metrics["neighbour_mean"].isna().all()
+
+    outliers = df_metrics[df_metrics["outlier"]]
+    assert outliers[["t", "z"]].values.tolist() == [[5, 1]]
+    assert abs(df_metrics["adjacent_residual"].median()) < 0.01
+
+
+def test_artefact_metrics_neighbours():
+    data, index, df_artefacts = make_data()
+    sparse = df_artefacts["t"] % 3 == 0
+    df_artefacts = df_artefacts[sparse].reset_index(drop=True)
+    index = artefact_index.ArtefactIndex.from_arrays(
+        df_artefacts["t"], df_artefacts["z"], df_artefacts["row_start"], df_artefacts["row_stop"], 40
+    )
+
+    df_metrics = qa.artefact_metrics(data, index, df_artefacts)
+
+    row = df_metrics.iloc[3]  # t=3, z=1: neighbouring frames 2 and 4.
+    assert (row["t"], row["z"]) == (3, 1)
+    assert row["neighbour_mean"] == pytest.approx(data[[2, 4], 1, 10:14].mean())
+    row = df_metrics.iloc[0]  # t=0: only the frame after.
+    assert row["neighbour_mean"] == pytest.approx(data[1, 0, 10:14].mean())
+
+
+def test_write_metrics_gate(tmp_path):
+    data, index, df_artefacts = make_data()
+    # Artefact left in the rows just outside the corrected window, as with a wrong shift_px.
+    data[:, :, 14:16] += 300
+
+    df_metrics = qa.artefact_metrics(data, index, df_artefacts)
+    summary = qa.write_metrics(tmp_path, df_metrics, max_residual=0.05)
+
+    assert not summary["passed"]
+    assert summary["planes"]["0"]["adjacent_residual"]["median"] < -0.05
+    with pytest.raises(qa.QAError):
+        qa.check_summary(summary)
+    assert json.loads((tmp_path / "qa_metrics.json").read_text())["artefacts"] == 80
+    assert len(pd.read_csv(tmp_path / "qa_stims.csv")) == 40
+    assert len(pd.read_csv(tmp_path / "qa_artefacts.csv")) == 80
+
+    assert qa.summarize(df_metrics)["passed"]  # Without a limit, nothing fails.
+
+
+def test_color_limits():
+    plane_mean = np.full((20, 20), 1000.0)
+    plane_std = np.full((20, 20), 10.0)
+    plane_mean[3, 4] = 60000  # A hot pixel.
+    plane_std[5, 6] = 20000  # A pixel of a bright frame.
+
+    assert qa.color_limits(plane_mean, plane_std) == (980, 1020)
+
+
+def test_side_by_side_comparison_labels():
+    data = np.random.RandomState(0).rand(5, 2, 8, 8)
+    df_artefacts = pd.DataFrame(
+        {"t": [0, 1, 2, 3], "z": [0, 1, 0, 1], "row_start": 1, "row_stop": 3, "stim": [7, 7, 8, 9]}
+    )
+
+    figure = qa.side_by_side_comparison(data, data, df_artefacts, 2)
+
+    labels = [axes.get_ylabel() for axes in figure.axes[::2]]
+    assert labels == ["Stim 7, Timepoint 0, Plane 0", "Stim 9, Timepoint 3, Plane 1"]
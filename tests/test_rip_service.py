@@ -0,0 +1,89 @@
+import os
+import pathlib
+import threading
+import time
+
+import pytest
+
+from two_photon import raw2tiff, rip_service
+
+
+@pytest.fixture
+def queue_path(tmp_path, testdata):
+    """Queue directory watched by a rip service running the stub ripper."""
+    queue_path = tmp_path / "queue"
+    pool = rip_service.PrefixPool(2)
+    pool.start()
+    service = rip_service.RipService(
+        queue_path, pool, testdata / "stub_ripper.py", poll_secs=0.05, rip_poll_secs=0.1, extra_wait_secs=0
+    )
+    stop = threading.Event()
+    thread = threading.Thread(target=service.serve, args=(stop,))
+    thread.start()
+    yield queue_path
+    stop.set()
+    thread.join()
+    pool.close()
+
+
+def make_raw(path):
+    path.mkdir(parents=True)
+    (path / "acq-001Filelist.txt").write_text("")
+    (path / "CYCLE_000001_RAWDATA_000001").write_bytes(b"raw")
+    return path
+
+
+def test_rip_service(tmp_path, queue_path):
+    jobs = []
+    for name in ["acq-001", "acq-002", "acq-003"]:
+        raw_path = make_raw(tmp_path / "raw" / name)
+        tiff_path = tmp_path / "tiff" / name
+        jobs.append((raw_path, tiff_path, raw2tiff.submit_rip(queue_path, raw_path, tiff_path)))
+
+    for raw_path, tiff_path, job_id in jobs:
+        result = raw2tiff.wait_for_rip(queue_path, job_id, poll_secs=0.05, timeout_secs=30)
+        assert result["status"] == "done"
+        assert (tiff_path / f"{raw_path.name}_Cycle00001_Ch3_000001.ome.tif").exists()
+        assert (raw_path / f"{raw_path.name}.xml").exists()
+        assert not (raw_path / f"{raw_path.name}.xml").samefile(tiff_path / f"{raw_path.name}.xml")
+    assert not list((queue_path / raw2tiff.QUEUE_RUNNING).glob("*/*.json"))
+
+
+def test_rip_service_failed(tmp_path, queue_path):
+    raw_path = tmp_path / "raw"
+    raw_path.mkdir()
+    job_id = raw2tiff.submit_rip(queue_path, raw_path, tmp_path / "tiff")
+
+    with pytest.raises(raw2tiff.RippingError, match="Filelist"):
+        raw2tiff.wait_for_rip(queue_path, job_id, poll_secs=0.05, timeout_secs=30)
+
+
+def test_requeue_running(tmp_path):
+    queue_path = tmp_path / "queue"
+    service = rip_service.RipService(queue_path, rip_service.PrefixPool(1))
+    job_id = raw2tiff.submit_rip(queue_path, tmp_path / "raw", tmp_path / "tiff")
+    assert service.claim()[0] == job_id
+    assert service.claim() is None
+
+    # Jobs of a live service are left alone.
+    other = rip_service.RipService(queue_path, rip_service.PrefixPool(1), stale_secs=60)
+    other.requeue_running()
+    assert other.claim() is None
+
+    stale = time.time() - 120
+    os.utime(service.running_path / rip_service.HEARTBEAT, (stale, stale))
+    other.requeue_running()
+    assert other.claim()[0] == job_id
+    assert not service.running_path.exists()
+
+
+def test_claim_skips_vanished_jobs(tmp_path, monkeypatch):
+    queue_path = tmp_path / "queue"
+    service = rip_service.RipService(queue_path, rip_service.PrefixPool(1))
+    job_ids = [raw2tiff.submit_rip(queue_path, tmp_path / "raw", tmp_path / name) for name in ["a", "b"]]
+    pending_path = queue_path / raw2tiff.QUEUE_PENDING
+    listed = sorted(pending_path.glob("[!.]*.json"))
+    (pending_path / f"{job_ids[0]}.json").unlink()  # Claimed by another service after the listing.
+    monkeypatch.setattr(pathlib.Path, "glob", lambda self, pattern: iter(listed))
+
+    assert service.claim()[0] == job_ids[1]
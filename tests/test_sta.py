@@ -0,0 +1,76 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+from two_photon import artefact_image, artefact_index, cli, layout, preprocess, sta
+
+
+def test_stim_onsets():
+    df_frames = pd.DataFrame({"start": [0.0, 10.0, 20.0, 30.0, 40.0, 50.0], "stop": [10.0, 20, 30, 40, 50, 60]})
+    df_stims = pd.DataFrame({"start": [-5.0, 0.0, 15.0, 25.0, 55.0], "stop": [-4.0, 1, 16, 26, 56]})
+
+    np.testing.assert_array_equal(sta.stim_onsets(df_frames, df_stims, num_z=2), [-1, 0, 0, 1, 2])
+    onsets = sta.stim_onsets(df_frames, df_stims, num_z=2, piezo_period_frames=3)
+    np.testing.assert_array_equal(onsets, [-1, 0, 0, 0, 1])
+
+
+def test_artefact_onsets():
+    # A stim running on from the last rows of plane 1 into the next time point starts at its first.
+    regions = ([3, 10, 11, 40], [0, 1, 0, 0], [5, 26, 0, 12], [9, 32, 4, 20])
+    df_artefacts = artefact_image.artefact_table(*(np.array(r) for r in regions), (60, 2, 32, 16))
+
+    np.testing.assert_array_equal(sta.artefact_onsets(df_artefacts), [3, 10, 40])
+
+
+def test_sta_image_artefacts(tmp_path):
+    lo = layout.Layout(tmp_path, "acq")
+    data = np.random.RandomState(0).randint(0, 1000, size=(60, 2, 32, 16)).astype(np.uint16)
+    lo.preprocess_h5_path().parent.mkdir(parents=True)
+    with h5py.File(lo.preprocess_h5_path(), "w") as h5file:
+        h5file.create_dataset("data", data=data)
+    lo.artefacts_path().parent.mkdir(parents=True)
+    regions = ([20], [0], [4], [8])
+    df_artefacts = artefact_image.artefact_table(*(np.array(r) for r in regions), data.shape)
+    index = preprocess.artefact_index_from_df(df_artefacts, data.shape[0])
+    artefact_index.write(lo.artefacts_path(), index, df_artefacts, params={"artefact_source": "image"})
+
+    args = ["--base-path", str(tmp_path), "--acquisition", "acq", "sta", "--pre-frames", "2", "--post-frames", "5"]
+    result = CliRunner().invoke(cli.cli, args)
+
+    assert result.exit_code == 0, result.output
+    with h5py.File(lo.sta_h5_path(), "r") as h5file:
+        np.testing.assert_allclose(h5file[sta.ALL_STIMS]["mean"][...], data[18:25])
+
+
+def test_accumulate(tmp_path, monkeypatch):
+    monkeypatch.setattr(sta, "BLOCK_TIMEPOINTS", 7)
+    data = np.random.RandomState(0).randint(0, 1000, size=(60, 2, 4, 3)).astype(np.uint16)
+    # Overlapping windows, a repeated onset, and stims at both ends whose windows do not fit.
+    onsets = np.array([1, 10, 12, 12, 30, 41, 58])
+    stim_types = np.array(["a", "b", "a", "a", "b", "a", "b"])
+
+    accumulators = sta.accumulate(data, onsets, stim_types, pre_frames=3, post_frames=5)
+
+    for stim_type in ["a", "b"]:
+        type_onsets = [t for t, typ in zip(onsets, stim_types) if typ == stim_type and 3 <= t <= 55]
+        windows = np.stack([data[t - 3 : t + 5] for t in type_onsets]).astype(np.float64)
+        accumulator = accumulators[stim_type]
+        assert accumulator.count == len(type_onsets)
+        np.testing.assert_allclose(accumulator.mean, windows.mean(axis=0))
+        sem = windows.std(axis=0, ddof=1) / np.sqrt(len(type_onsets))
+        np.testing.assert_allclose(accumulator.sem, sem, rtol=1e-6)
+
+    sta.write(tmp_path / "sta.h5", accumulators, 3, 5)
+    with h5py.File(tmp_path / "sta.h5", "r") as h5file:
+        np.testing.assert_array_equal(h5file["offsets"][...], np.arange(-3, 5))
+        assert h5file["a"].attrs["count"] == 3
+        assert h5file["a/mean"].shape == (8, 2, 4, 3)
+        assert h5file["b/sem"].dtype == np.float32
+
+
+def test_accumulate_no_stims():
+    data = np.zeros((10, 1, 2, 2), dtype=np.uint16)
+    with pytest.raises(sta.STAError):
+        sta.accumulate(data, np.array([0, 9]), pre_frames=3, post_frames=5)
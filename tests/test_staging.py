@@ -0,0 +1,131 @@
+import time
+
+import click
+import h5py
+import numpy as np
+import pytest
+
+from two_photon import cli, layout, staging
+
+
+def test_sync_tree(tmp_path):
+    src_path = tmp_path / "src"
+    (src_path / "sub").mkdir(parents=True)
+    (src_path / "a.h5").write_bytes(b"a" * 100)
+    (src_path / "sub" / "b.bin").write_bytes(b"b" * 10)
+
+    assert staging.sync_tree(src_path, tmp_path / "dst") == 110
+    assert (tmp_path / "dst" / "sub" / "b.bin").read_bytes() == b"b" * 10
+    assert staging.sync_tree(src_path, tmp_path / "dst") == 0  # Nothing changed.
+
+    (src_path / "a.h5").write_bytes(b"c" * 50)
+    assert staging.sync_tree(src_path, tmp_path / "dst") == 50
+    assert (tmp_path / "dst" / "a.h5").read_bytes() == b"c" * 50
+
+
+def test_layout_stage_roots(tmp_path):
+    lo = layout.Layout(tmp_path / "shared", "mouse/acq-001", {"convert": tmp_path / "scratch"})
+
+    assert lo.path("convert") == tmp_path / "scratch" / "convert" / "mouse/acq-001"
+    assert lo.path("raw") == tmp_path / "shared" / "raw" / "mouse/acq-001"
+    assert lo.base_path_of("convert") == tmp_path / "shared" / "convert" / "mouse/acq-001"
+    # Other acquisitions not processed under the root are read from the base path.
+    assert lo.path("convert", "mouse/acq-000") == tmp_path / "shared" / "convert" / "mouse/acq-000"
+
+
+def test_staging(tmp_path):
+    scratch_path = tmp_path / "scratch"
+    lo = layout.Layout(tmp_path / "shared", "acq", {"convert": scratch_path, "preprocess": scratch_path})
+    lo.base_path_of("convert").mkdir(parents=True)
+    (lo.base_path_of("convert") / "orig.h5").write_bytes(b"orig")
+
+    stager = staging.Staging(lo)
+    stager.prefetch()
+    stager.wait_for(["raw", "convert"])
+    assert (lo.path("convert") / "orig.h5").read_bytes() == b"orig"
+
+    lo.path("preprocess").mkdir(parents=True)
+    (lo.path("preprocess") / "preprocess.h5").write_bytes(b"preprocess")
+    stager.write_back("preprocess")
+    stager.write_back("raw")  # Kept under the base path, so nothing to write back.
+    stager.wait()
+    assert (lo.base_path_of("preprocess") / "preprocess.h5").read_bytes() == b"preprocess"
+
+
+def test_copy_verified_mismatch(tmp_path, monkeypatch):
+    (tmp_path / "src").write_bytes(b"data")
+    hashes = iter([b"x", b"y"])
+
+    class FakeHash:
+        def __init__(self):
+            self.value = next(hashes)
+
+        def update(self, chunk):
+            pass
+
+        def digest(self):
+            return self.value
+
+    monkeypatch.setattr(staging.hashlib, "blake2b", FakeHash)
+    with pytest.raises(staging.StagingError):
+        staging.copy_verified(tmp_path / "src", tmp_path / "dst")
+    assert not list(tmp_path.glob("*dst*"))
+
+
+def write_vds(path, source_name):
+    vds_layout = h5py.VirtualLayout(shape=(3,), dtype=np.int64)
+    vds_layout[:] = h5py.VirtualSource(source_name, "data", shape=(3,))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, "w") as h5file:
+        h5file.create_virtual_dataset("data", vds_layout)
+
+
+def test_check_vds(tmp_path):
+    root = tmp_path / "scratch"
+    path = root / "preprocess" / "acq" / "preprocess.h5"
+
+    for name in ["../../convert/acq/orig.h5", str(tmp_path / "shared" / "orig.h5")]:
+        write_vds(path, name)
+        staging.check_vds(path, root)
+
+    # Relative names leaving the root, and absolute names into it, break once written back.
+    for name in ["../../../shared/orig.h5", str(root / "convert" / "acq" / "orig.h5")]:
+        write_vds(path, name)
+        with pytest.raises(staging.StagingError):
+            staging.check_vds(path, root)
+        with pytest.raises(staging.StagingError):
+            staging.sync_tree(path.parent, tmp_path / "shared", vds_root=root)
+
+
+def test_rerun_waits_for_output_prefetch(tmp_path, monkeypatch):
+    lo = layout.Layout(tmp_path / "shared", "acq", {"convert": tmp_path / "scratch"})
+    lo.base_path_of("convert").mkdir(parents=True)
+    (lo.base_path_of("convert") / "orig.h5").write_bytes(b"old run")
+    sync_tree = staging.sync_tree
+
+    def slow_sync_tree(*args):
+        time.sleep(0.2)
+        return sync_tree(*args)
+
+    monkeypatch.setattr(staging, "sync_tree", slow_sync_tree)
+
+    def convert():
+        lo.path("convert").mkdir(parents=True, exist_ok=True)
+        (lo.path("convert") / "orig.h5").write_bytes(b"new")
+
+    command = cli.track_stages(click.Command("convert", callback=convert))
+    stager = staging.Staging(lo, write_back=False)
+    stager.prefetch()
+    with click.Context(command) as ctx:
+        ctx.meta["staging"] = stager
+        command.callback()
+    stager.wait()
+
+    assert (lo.path("convert") / "orig.h5").read_bytes() == b"new"
+
+
+def test_preprocess_readers_wait_for_convert():
+    # Overlay preprocess.h5 files are virtual datasets reading from the convert stage.
+    for command, stages in cli.STAGE_INPUTS.items():
+        if "preprocess" in stages:
+            assert "convert" in stages, command
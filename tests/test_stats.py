@@ -0,0 +1,43 @@
+"""Tests of stats.py module."""
+
+import numpy as np
+import pytest
+
+from two_photon import stats, storage, utils
+
+
+@pytest.mark.parametrize("suffix", [".h5", ".zarr"])
+def test_summary_stats_matches_numpy(tmp_path, suffix):
+    data = np.random.RandomState(0).randint(0, 60000, size=(23, 2, 4, 3)).astype(np.uint16)
+
+    summary = stats.SummaryStats()
+    for t_start, t_stop in utils.blocks(data.shape[0], 5):
+        summary.update(data[t_start:t_stop])
+
+    path = tmp_path / ("stats" + suffix)
+    with storage.open_store(path, "w") as store:
+        summary.write(store)
+
+    with storage.open_store(path, "r") as store:
+        np.testing.assert_allclose(stats.read(store, "mean"), data.mean(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(stats.read(store, "std"), data.std(axis=0), rtol=1e-5)
+        np.testing.assert_array_equal(stats.read(store, "min"), data.min(axis=0))
+        np.testing.assert_array_equal(stats.read(store, "max"), data.max(axis=0))
+        np.testing.assert_allclose(stats.read(store, "frame_mean"), data.mean(axis=(2, 3)), rtol=1e-6)
+        assert stats.read(store, "missing") is None
+
+
+def test_summary_stats_merge():
+    data = np.random.RandomState(1).randint(0, 60000, size=(17, 2, 4, 3)).astype(np.uint16)
+
+    summary = stats.SummaryStats()
+    for t_start, t_stop in utils.blocks(data.shape[0], 4):
+        partial = stats.SummaryStats()
+        partial.update(data[t_start:t_stop])
+        summary.merge(partial)
+
+    assert summary.count == data.shape[0]
+    np.testing.assert_allclose(summary.mean, data.mean(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(summary.std, data.std(axis=0), rtol=1e-10)
+    np.testing.assert_array_equal(summary.min, data.min(axis=0))
+    np.testing.assert_allclose(np.concatenate(summary.frame_mean), data.mean(axis=(2, 3)), rtol=1e-6)
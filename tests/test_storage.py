@@ -0,0 +1,55 @@
+"""Tests of storage.py module."""
+
+import h5py
+import numpy as np
+import pytest
+
+from two_photon import stats, storage
+
+
+@pytest.mark.parametrize("suffix", [".h5", ".zarr"])
+def test_store_roundtrip(tmp_path, suffix):
+    data = np.arange(3 * 2 * 4 * 5, dtype=np.uint16).reshape((3, 2, 4, 5))
+    path = tmp_path / ("data" + suffix)
+    with storage.open_store(path, "w") as store:
+        dset = store.create("data", shape=data.shape, dtype=data.dtype, chunks=(1, 1, 4, 5))
+        dset[1:3] = data[1:3]
+        dset[0] = data[0]
+        store.attrs["num_t"] = 3
+
+    assert storage.backend_of(path) == suffix.lstrip(".").replace("h5", "hdf5")
+    with storage.open_store(path, "r") as store:
+        assert "data" in store
+        assert "missing" not in store
+        assert store.attrs["num_t"] == 3
+        np.testing.assert_array_equal(store["data"][...], data)
+        np.testing.assert_array_equal(store["data"][2, 1], data[2, 1])
+
+
+def test_find_and_remove(tmp_path):
+    h5_path = tmp_path / "orig.h5"
+    with pytest.raises(storage.StorageError):
+        storage.find(h5_path)
+
+    with storage.open_store(storage.with_backend(h5_path, "zarr"), "w") as store:
+        store.create("data", data=np.zeros((2, 2), dtype=np.uint16))
+    assert storage.find(h5_path) == tmp_path / "orig.zarr"
+
+    storage.remove(h5_path)
+    assert not (tmp_path / "orig.zarr").exists()
+
+
+def test_export_hdf5(tmp_path):
+    data = np.random.RandomState(0).randint(0, 1000, size=(7, 2, 3, 4)).astype(np.uint16)
+    summary = stats.SummaryStats()
+    summary.update(data)
+    with storage.open_store(tmp_path / "data.zarr", "w") as store:
+        store.create("data", data=data, chunks=(1, 1, 3, 4))
+        summary.write(store)
+
+    storage.export_hdf5(tmp_path / "data.zarr", tmp_path / "data.h5")
+
+    with h5py.File(tmp_path / "data.h5", "r") as h5file:
+        np.testing.assert_array_equal(h5file["data"][()], data)
+        np.testing.assert_array_equal(h5file["stats/max"][()], data.max(axis=0))
+        assert h5file["stats"].attrs["count"] == 7
@@ -0,0 +1,66 @@
+"""Tests of suite2p_binary.py module."""
+
+import numpy as np
+import pytest
+
+from two_photon import suite2p_binary
+
+
+def read_plane(raw_file, shape):
+    return np.fromfile(raw_file, dtype=np.int16).reshape((-1,) + shape[2:])
+
+
+def write_binaries(path, data):
+    writer = suite2p_binary.BinaryWriter(path, data.shape)
+    writer.create()
+    # Blocks may be written in any order.
+    writer.write(4, data[4:])
+    writer.write(0, data[:4])
+    writer.write_ops(data.mean(axis=0))
+    return writer
+
+
+def test_binary_writer(tmp_path):
+    data = np.random.RandomState(0).randint(0, 60000, size=(7, 2, 3, 5)).astype(np.uint16)
+    writer = write_binaries(tmp_path / "suite2p", data)
+
+    for z in range(2):
+        np.testing.assert_array_equal(read_plane(writer.raw_file(z), data.shape), data[:, z] // 2)
+
+    ops = suite2p_binary.load_ops(tmp_path / "suite2p")
+    assert len(ops) == 2
+    assert (ops[1]["Ly"], ops[1]["Lx"], ops[1]["nframes"], ops[1]["iplane"]) == (3, 5, 7, 1)
+    np.testing.assert_allclose(ops[1]["meanImg"], data[:, 1].mean(axis=0) / 2, rtol=1e-6)
+
+
+def test_prepare_analysis_concatenates_acquisitions(tmp_path):
+    data1 = np.random.RandomState(1).randint(0, 60000, size=(5, 2, 3, 4)).astype(np.uint16)
+    data2 = np.random.RandomState(2).randint(0, 60000, size=(6, 2, 3, 4)).astype(np.uint16)
+    paths = [tmp_path / "acq1", tmp_path / "acq2"]
+    write_binaries(paths[0], data1)
+    write_binaries(paths[1], data2)
+
+    save_path = tmp_path / "analyze" / "suite2p"
+    assert suite2p_binary.prepare_analysis(paths, save_path, {"tau": 1.5}) == 2
+
+    ops = np.load(save_path / "plane1" / "ops.npy", allow_pickle=True).item()
+    assert ops["nframes"] == 11
+    assert ops["tau"] == 1.5
+    assert ops["keep_movie_raw"]
+    assert ops["reg_file"] == str(save_path / "plane1" / "data.bin")
+    np.testing.assert_array_equal(ops["frames_per_folder"], [5, 6])
+    expected = np.concatenate([data1[:, 1], data2[:, 1]]) // 2
+    np.testing.assert_array_equal(read_plane(ops["raw_file"], data1.shape), expected)
+
+
+def test_prepare_analysis_single_acquisition_uses_preprocess_binary(tmp_path):
+    data = np.zeros((3, 1, 2, 2), dtype=np.uint16)
+    writer = write_binaries(tmp_path / "acq", data)
+    suite2p_binary.prepare_analysis([tmp_path / "acq"], tmp_path / "suite2p", {})
+    ops = np.load(tmp_path / "suite2p" / "plane0" / "ops.npy", allow_pickle=True).item()
+    assert ops["raw_file"] == str(writer.raw_file(0))
+
+
+def test_load_ops_missing(tmp_path):
+    with pytest.raises(suite2p_binary.Suite2pBinaryError):
+        suite2p_binary.load_ops(tmp_path)
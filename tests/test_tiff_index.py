@@ -0,0 +1,95 @@
+"""Tests of tiff_index.py module."""
+
+import concurrent.futures
+
+import numpy as np
+import pytest
+import tifffile
+
+from two_photon import tiff_index
+
+
+def write_acquisition(tmp_path, data, channel=3, pages_per_file=1):
+    """Write a fake Bruker acquisition: one tiff per frame (or page group) and an XML index."""
+    num_t, num_z = data.shape[:2]
+    frames = data.reshape((num_t * num_z,) + data.shape[2:])
+
+    file_elements = []
+    for frame_num in range(frames.shape[0]):
+        file_num = frame_num // pages_per_file
+        fname = f"acq_Cycle00001_Ch{channel}_{file_num + 1:06d}.ome.tif"
+        if frame_num % pages_per_file == 0:
+            with tifffile.TiffWriter(tmp_path / fname) as tif:
+                for page in frames[frame_num : frame_num + pages_per_file]:
+                    tif.write(page, photometric="minisblack")
+        page = frame_num % pages_per_file + 1
+        file_elements.append(
+            f'<File channel="1" channelName="Ch1" filename="other_{frame_num}.ome.tif" />'
+            f'<File channel="{channel}" channelName="Ch{channel}" page="{page}" filename="{fname}" />'
+        )
+
+    sequences = []
+    for t in range(num_t):
+        frame_xml = "".join(
+            f'<Frame index="{z + 1}">{file_elements[t * num_z + z]}</Frame>' for z in range(num_z)
+        )
+        sequences.append(f'<Sequence cycle="{t + 1}">{frame_xml}</Sequence>')
+    # A final, incomplete volume which should be dropped.
+    sequences.append(f'<Sequence cycle="{num_t + 1}"><Frame index="1">{file_elements[0]}</Frame></Sequence>')
+
+    xml_path = tmp_path / "acq.xml"
+    xml_path.write_text("<PVScan>%s</PVScan>" % "".join(sequences))
+    return xml_path
+
+
+@pytest.mark.parametrize("pages_per_file", [1, 2])
+def test_tiff_index_read(tmp_path, pages_per_file):
+    data = np.arange(4 * 2 * 3 * 5, dtype=np.uint16).reshape((4, 2, 3, 5))
+    xml_path = write_acquisition(tmp_path, data, pages_per_file=pages_per_file)
+
+    index = tiff_index.TiffIndex.from_xml(xml_path, channel=3)
+    assert index.shape == (4, 2)
+
+    result = index.read(tmp_path)
+    assert result.shape == data.shape
+    np.testing.assert_array_equal(result, data)
+    np.testing.assert_array_equal(index.read_frame(tmp_path, 2, 1), data[2, 1])
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        np.testing.assert_array_equal(index.read(tmp_path, 1, 3, executor), data[1:3])
+
+
+def test_tiff_index_save_load(tmp_path):
+    data = np.zeros((2, 3, 4, 4), dtype=np.uint16)
+    xml_path = write_acquisition(tmp_path, data)
+    index = tiff_index.TiffIndex.from_xml(xml_path, channel=3)
+
+    index.save(tmp_path / "index.npz")
+    loaded = tiff_index.TiffIndex.load(tmp_path / "index.npz")
+
+    assert loaded.locate(1, 2) == index.locate(1, 2) == ("acq_Cycle00001_Ch3_000006.ome.tif", 0)
+    np.testing.assert_array_equal(loaded.file_index, index.file_index)
+
+
+def test_tiff_index_missing_channel(tmp_path):
+    xml_path = write_acquisition(tmp_path, np.zeros((2, 2, 4, 4), dtype=np.uint16))
+    with pytest.raises(tiff_index.TiffIndexError):
+        tiff_index.TiffIndex.from_xml(xml_path, channel=2)
+
+
+def test_tiff_index_with_piezo(tmp_path):
+    # A single T-series of 14 frames, with a piezo period of 4 frames whose first is flyback.
+    data = np.arange(14 * 3 * 5, dtype=np.uint16).reshape((1, 14, 3, 5))
+    xml_path = write_acquisition(tmp_path, data)
+    index = tiff_index.TiffIndex.from_xml(xml_path, channel=3).with_piezo(4, 1)
+    assert index.shape == (3, 3)
+
+    expected = data[0, :12].reshape((3, 4, 3, 5))[:, 1:]
+    np.testing.assert_array_equal(index.read(tmp_path), expected)
+
+
+@pytest.mark.parametrize("period_frames, skip_frames", [(4, 4), (4, -1), (20, 1)])
+def test_tiff_index_with_piezo_invalid(tmp_path, period_frames, skip_frames):
+    xml_path = write_acquisition(tmp_path, np.zeros((1, 8, 4, 4), dtype=np.uint16))
+    index = tiff_index.TiffIndex.from_xml(xml_path, channel=3)
+    with pytest.raises(tiff_index.TiffIndexError):
+        index.with_piezo(period_frames, skip_frames)
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from two_photon import artefact_index, layout, preprocess, traces
+
+
+def make_stat(frame_shape, num_rois=5, seed=0):
+    random = np.random.RandomState(seed)
+    stat = []
+    for _ in range(num_rois):
+        y0, x0 = random.randint(3, frame_shape[0] - 6), random.randint(3, frame_shape[1] - 6)
+        ypix, xpix = [a.ravel() for a in np.mgrid[y0 : y0 + 3, x0 : x0 + 3]]
+        stat.append({"ypix": ypix, "xpix": xpix, "lam": random.rand(9) + 0.1, "overlap": np.zeros(9, dtype=bool)})
+    return np.array(stat)
+
+
+def test_extract_matches_loop(monkeypatch):
+    monkeypatch.setattr(traces, "BLOCK_TIMEPOINTS", 16)
+    frame_shape = (32, 40)
+    data = np.random.RandomState(1).randint(0, 1000, size=(50, 2, *frame_shape)).astype(np.uint16)
+    stat = make_stat(frame_shape)
+    stat[0]["overlap"][:3] = True
+    plane = {"cells": traces.cell_weights(stat, frame_shape), "neuropil": traces.neuropil_weights(stat, frame_shape)}
+    f_cells, f_neuropil = traces.extract(data, [dict(plane, ref=None), dict(plane, ref=None)])
+
+    for z in range(2):
+        for num, roi in enumerate(stat):
+            keep = ~roi["overlap"]
+            lam = roi["lam"][keep] / roi["lam"][keep].sum()
+            expected = (data[:, z, roi["ypix"][keep], roi["xpix"][keep]] * lam).sum(axis=1)
+            np.testing.assert_allclose(f_cells[z][num], expected, rtol=1e-5)
+    assert f_neuropil[0].shape == (5, 50)
+
+
+def test_neuropil_weights():
+    frame_shape = (40, 40)
+    stat = make_stat(frame_shape)
+    weights = traces.neuropil_weights(stat, frame_shape).toarray()
+
+    np.testing.assert_allclose(weights.sum(axis=1), 1, rtol=1e-6)
+    assert ((weights > 0).sum(axis=1) == traces.MIN_NEUROPIL_PIXELS).all()
+    # No neuropil pixel is in a cell, or within 2 steps of one.
+    cells = traces.cell_weights(stat, frame_shape).toarray().any(axis=0).reshape(frame_shape)
+    near_cells = np.zeros(frame_shape, dtype=bool)
+    for dy in range(-2, 3):
+        for dx in range(-2 + abs(dy), 3 - abs(dy)):
+            near_cells |= np.roll(cells, (dy, dx), axis=(0, 1))
+    assert not (weights.any(axis=0) & near_cells.ravel()).any()
+
+    stored = [dict(roi, neuropil_mask=np.array([0, 1, 2, 3])) for roi in stat]
+    np.testing.assert_allclose(traces.neuropil_weights(stored, frame_shape).toarray()[:, :4], 0.25)
+
+
+@pytest.mark.parametrize("shift", [(0, 0), (3, -2), (-5, 4)])
+def test_register(shift):
+    ref = np.random.RandomState(2).rand(48, 64).astype(np.float32)
+    frames = np.stack([np.roll(ref, shift, axis=(0, 1)), ref])
+
+    dy, dx = traces.rigid_shifts(frames, ref, max_shift=6)
+    np.testing.assert_array_equal(dy, [shift[0], 0])
+    np.testing.assert_array_equal(dx, [shift[1], 0])
+    shifted, valid = traces.register(frames, ref, 6)
+    # Pixels shifted in from beyond the edge are masked, not wrapped around from the other side.
+    rows, cols = np.arange(48) + shift[0], np.arange(64) + shift[1]
+    expected_valid = ((rows >= 0) & (rows < 48))[:, np.newaxis] & ((cols >= 0) & (cols < 64))
+    np.testing.assert_array_equal(valid, np.stack([expected_valid, np.ones(ref.shape, dtype=bool)]))
+    np.testing.assert_array_equal(shifted[valid], np.stack([ref, ref])[valid])
+    assert (shifted[~valid] == 0).all()
+
+
+def test_extract_registered_leaves_out_edges():
+    ref = np.random.RandomState(2).rand(48, 64).astype(np.float32) * 1000
+    frames = np.stack([np.roll(ref, (3, 0), axis=(0, 1)), ref])
+    stat = [
+        {"ypix": np.array([0, 0, 1, 1]), "xpix": np.array([5, 6, 5, 6]), "lam": np.ones(4)},
+        {"ypix": np.array([46, 47]), "xpix": np.array([10, 10]), "lam": np.ones(2)},
+    ]
+    plane = {
+        "cells": traces.cell_weights(stat, ref.shape),
+        "neuropil": traces.neuropil_weights(stat, ref.shape),
+        "ref": ref,
+        "max_shift": 6,
+    }
+    f_cells, _ = traces.extract(frames[:, np.newaxis], [plane])
+
+    np.testing.assert_allclose(f_cells[0][0], ref[:2, 5:7].mean(), rtol=1e-5)
+    # The second ROI lies in the rows shifted in from beyond the edge of the first frame.
+    assert np.isnan(f_cells[0][1, 0])
+    np.testing.assert_allclose(f_cells[0][1, 1], ref[46:48, 10].mean(), rtol=1e-5)
+
+
+def test_volume_frames(tmp_path):
+    lo = layout.Layout(tmp_path, "acq")
+    assert traces.volume_frames(lo, 3) == 3
+
+    lo.artefacts_path().parent.mkdir(parents=True)
+    df_artefacts = pd.DataFrame({"t": [1], "z": [0], "row_start": [2], "row_stop": [4]})
+    index = preprocess.artefact_index_from_df(df_artefacts, 4)
+    params = {"piezo_period_frames": 5, "piezo_skip_frames": 2}
+    artefact_index.write(lo.artefacts_path(), index, df_artefacts, params=params)
+    assert traces.volume_frames(lo, 3) == 5
+
+
+def test_dff():
+    t = np.arange(2000)
+    f_cells = np.stack([100 + 50 * (t % 500 == 0), np.full(2000, 200.0)]).astype(np.float32)
+    f_neuropil = np.full_like(f_cells, 10)
+
+    result = traces.dff(f_cells, f_neuropil, fs=10, neuropil_coeff=0.7)
+    np.testing.assert_allclose(result[1], 0, atol=1e-6)
+    assert np.median(result[0]) == pytest.approx(0, abs=1e-6)
+    assert result[0, 500] > 0.1
+
+
+def test_load_plane(tmp_path):
+    stat = make_stat((32, 40))
+    np.save(tmp_path / "stat.npy", stat)
+    np.save(tmp_path / "iscell.npy", np.ones((5, 2)))
+    np.save(tmp_path / "ops.npy", {"Ly": 32, "Lx": 40, "refImg": np.zeros((32, 40)), "maxregshift": 0.1})
+
+    plane = traces.load_plane(tmp_path, (32, 40))
+    assert plane["cells"].shape == (5, 32 * 40)
+    assert plane["max_shift"] == 4
+    with pytest.raises(traces.TracesError):
+        traces.load_plane(tmp_path, (32, 32))
@@ -0,0 +1,98 @@
+"""Tests of transform.py module."""
+
+import dask.array as da
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from two_photon import transform
+
+
+def test_convert_removes_artefacts(tmp_path):
+    data = np.random.RandomState(0).randint(0, 60000, size=(130, 2, 8, 3)).astype(np.uint16)
+    # Frames on either side of the 64-frame chunk boundaries, plus two artefacts in one frame.
+    df_artefacts = pd.DataFrame(
+        {"z_plane": [0, 1, 1, 0, 1, 0], "y_min": [2, 0, 5, 3, 1, 6], "y_max": [3, 1, 7, 3, 2, 7]},
+        index=pd.Index([5, 5, 5, 63, 64, 128], name="frame"),
+    )
+
+    expected = data.copy()
+    for row in df_artefacts.itertuples():
+        rows = slice(row.y_min, row.y_max + 1)
+        before = data[row.Index - 1, row.z_plane, rows].astype(np.float32)
+        after = data[row.Index + 1, row.z_plane, rows].astype(np.float32)
+        expected[row.Index, row.z_plane, rows] = (before + after) / 2
+
+    fname_data = tmp_path / "corrected" / "data.h5"
+    fname_uncorrected = tmp_path / "uncorrected" / "data.h5"
+    transform.convert(da.from_array(data), fname_data, df_artefacts, fname_uncorrected)
+
+    with h5py.File(fname_uncorrected, "r") as h5file:
+        np.testing.assert_array_equal(h5file[transform.HDF5_KEY][()], data)
+    with h5py.File(fname_data, "r") as h5file:
+        np.testing.assert_array_equal(h5file[transform.HDF5_KEY][()], expected)
+
+
+@pytest.mark.parametrize("fill_kernel", ["linear", "cubic"])
+def test_convert_artefacts_at_edges(tmp_path, fill_kernel):
+    data = np.random.RandomState(0).randint(0, 60000, size=(130, 1, 8, 3)).astype(np.uint16)
+    df_artefacts = pd.DataFrame(
+        {"z_plane": [0, 0], "y_min": [2, 4], "y_max": [3, 6]}, index=pd.Index([0, 129], name="frame")
+    )
+
+    # Artefacts in the first and last frames take the value of the nearest unaffected frame.
+    expected = data.copy()
+    expected[0, 0, 2:4] = data[1, 0, 2:4]
+    expected[129, 0, 4:7] = data[128, 0, 4:7]
+
+    fname_data = tmp_path / "corrected" / "data.h5"
+    fname_uncorrected = tmp_path / "uncorrected" / "data.h5"
+    transform.convert(da.from_array(data), fname_data, df_artefacts, fname_uncorrected, fill_kernel=fill_kernel)
+
+    with h5py.File(fname_data, "r") as h5file:
+        np.testing.assert_array_equal(h5file[transform.HDF5_KEY][()], expected)
+
+
+@pytest.mark.parametrize("scheduler", ["synchronous", "processes"])
+def test_convert_schedulers(tmp_path, scheduler):
+    data = np.random.RandomState(1).randint(0, 1000, size=(20, 2, 4, 3)).astype(np.uint16)
+    df_artefacts = pd.DataFrame(
+        {"z_plane": [1], "y_min": [1], "y_max": [2]}, index=pd.Index([7], name="frame")
+    )
+    fname_data = tmp_path / "corrected.h5"
+    transform.convert(
+        da.from_array(data),
+        fname_data,
+        df_artefacts,
+        tmp_path / "uncorrected.h5",
+        scheduler=scheduler,
+        num_workers=2,
+        chunk_frames=6,
+    )
+    with h5py.File(fname_data, "r") as h5file:
+        result = h5file[transform.HDF5_KEY][()]
+    expected = data.copy()
+    expected[7, 1, 1:3] = (data[6, 1, 1:3].astype(np.float32) + data[8, 1, 1:3]) / 2
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_chunk_frames_for_memory():
+    # 2 planes of 512x512 uint16 is 1 MiB per time point.
+    shape = (1000, 2, 512, 512)
+    assert transform.chunk_frames_for_memory(shape, np.uint16, 64 << 20, num_workers=4) == 4
+    assert transform.chunk_frames_for_memory(shape, np.uint16, 1 << 20, num_workers=4) == 1
+    assert transform.chunk_frames_for_memory(shape, np.uint16, 1 << 40, num_workers=1) == 1000
+
+
+def test_convert_zarr(tmp_path):
+    data = np.random.RandomState(2).randint(0, 1000, size=(20, 2, 4, 3)).astype(np.uint16)
+    df_artefacts = pd.DataFrame({"z_plane": [0], "y_min": [0], "y_max": [1]}, index=pd.Index([12], name="frame"))
+    fname_data = tmp_path / "corrected.zarr"
+    transform.convert(
+        da.from_array(data), fname_data, df_artefacts, tmp_path / "uncorrected.zarr", num_workers=2, chunk_frames=6
+    )
+    result = da.from_zarr(str(fname_data), component=transform.ZARR_KEY).compute()
+    expected = data.copy()
+    expected[12, 0, 0:2] = (data[11, 0, 0:2].astype(np.float32) + data[13, 0, 0:2]) / 2
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+"""Stands in for the Bruker ripper in tests: writes a tiff and a metadata file, then never exits."""
+
+import pathlib
+import sys
+import time
+
+args = sys.argv[1:]
+raw_path = pathlib.Path(args[args.index("-AddRawFileWithSubFolders") + 1])
+out_path = pathlib.Path(args[args.index("-SetOutputDirectory") + 1]) / raw_path.name
+out_path.mkdir(parents=True, exist_ok=True)
+(out_path / f"{raw_path.name}_Cycle00001_Ch3_000001.ome.tif").write_bytes(b"tiff")
+(out_path / f"{raw_path.name}.xml").write_text("<PVScan/>")
+while True:
+    time.sleep(1)
@@ -1,14 +1,23 @@
 """Runs Suite2p analysis over one or more acquisitions."""
+import concurrent.futures
 import json
 import logging
+import os
+import shutil
 
 import click
-import h5py
+import numpy as np
 
-from two_photon import utils
+from two_photon import concat, slurm, storage, suite2p_binary
 
 logger = logging.getLogger(__name__)
 
+SAVE_FOLDER = "suite2p"  # Suite2p's default save_folder.
+
+
+class AnalyzeError(Exception):
+    """Error while running Suite2p analysis."""
+
 
 @click.command()
 @click.pass_obj
@@ -18,40 +27,182 @@ logger = logging.getLogger(__name__)
     help="Additional acquisitions to include in analysis in addition to --acquisitions",
 )
 @click.option("--suite2p-params-file", help="Optional Suite2p ops file (json format) to specify non-default options.")
-def analyze(layout, extra_acquisitions, suite2p_params_file):
+@click.option(
+    "--input-format",
+    type=click.Choice(["h5", "binary"]),
+    default="h5",
+    show_default=True,
+    help=(
+        "'h5' has Suite2p convert preprocess.h5 to its binary format, 'binary' uses the binaries "
+        "written by preprocess --suite2p-binary"
+    ),
+)
+@click.option(
+    "--plane-workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Run Suite2p separately on each z-plane, in this many processes, and merge the results.",
+)
+@click.option("--plane", type=int, help="Run Suite2p on only this z-plane, as one task of a --sbatch array job.")
+@click.option("--merge-planes", is_flag=True, help="Merge the results of runs with --plane for all z-planes.")
+@click.option("--sbatch", is_flag=True, help="Write a SLURM array script with one task per z-plane, and exit.")
+def analyze(
+    layout, extra_acquisitions, suite2p_params_file, input_format, plane_workers, plane, merge_planes, sbatch
+):
     """Runs suite2p on preprocessed data."""
-    preprocess_path = layout.path("preprocess")
     analyze_path = layout.path("analyze")
 
     analyze_path.mkdir(parents=True, exist_ok=True)
     json_path = analyze_path / "data_paths.json"
 
-    data_paths = [preprocess_path] + [layout.path("preprocess", acq) for acq in extra_acquisitions]
-    data_paths = [p / "preprocess" for p in data_paths]
+    acquisitions = [layout.acquisition] + list(extra_acquisitions)
+    data_paths = [layout.preprocess_h5_path(acq).parent for acq in acquisitions]
 
-    # Use first file to determine the sampling rate.
-    with h5py.File(data_paths[0] / "preprocess.h5", "r") as h5_file:
-        z_planes = h5_file["data"].shape[1]
-    period = utils.frame_period(layout)
+    if input_format == "binary":
+        binary_paths = [layout.suite2p_binary_path(acq) for acq in acquisitions]
+    else:
+        # Suite2p reads hdf5 only, so export any data preprocessed into zarr.
+        for data_path in data_paths:
+            h5_path = data_path / "preprocess.h5"
+            zarr_path = storage.with_backend(h5_path, "zarr")
+            if zarr_path.exists() and not h5_path.exists():
+                storage.export_hdf5(zarr_path, h5_path)
+
+    # Check the acquisitions match, using the info cached by preprocess.
+    infos = [concat.read_info(layout, acq) for acq in acquisitions]
+    offsets = concat.frame_offsets(infos, acquisitions)
+    z_planes = infos[0]["shape"][1]
+    period = infos[0]["frame_period"]
     fs_param = 1.0 / (period * z_planes)
 
+    sources = [data_path / "preprocess.h5" for data_path in data_paths]
+    # Sources under another root than analyze are not moved along with its virtual datasets.
+    analyze_root = layout.root_of("analyze").resolve()
+    relative = all(analyze_root in source.resolve().parents for source in sources)
+    if input_format == "h5" and len(acquisitions) > 1:
+        # Present the acquisitions to Suite2p as a single virtual dataset.
+        concat_path = layout.concat_h5_path()
+        concat.write_vds(concat_path, sources, infos, offsets, acquisitions, relative=relative)
+        logger.info("Joined acquisitions in %s, with frame offsets %s", concat_path, offsets.tolist())
+        data_paths = [concat_path.parent]
+
     # Use strings for paths: Suite2p and JSON cannot interpret Path, and logging is clearer.
     data_paths_str = [str(p) for p in data_paths]
 
     params_internal = {
-        "input_format": "h5",
+        "input_format": input_format,
         "data_path": data_paths_str,
         "save_path0": str(analyze_path),
         "fs": fs_param,
+        "h5py_key": concat.KEY,
     }
+    if input_format == "binary":
+        # Suite2p overrides the stored ops of each plane with these, so they must agree.
+        params_internal.update(nplanes=z_planes, nchannels=1, keep_movie_raw=True)
     params_external = json.load(open(suite2p_params_file, "r")) if suite2p_params_file else {}
     params = {**params_internal, **params_external}
 
     with open(json_path, "w") as fout:
         json.dump(data_paths_str, fout, indent=4)
+
+    save_folder = params.get("save_folder", SAVE_FOLDER)
+    if sbatch:
+        args = ["analyze", "--input-format", input_format]
+        for acquisition in extra_acquisitions:
+            args += ["--extra-acquisitions", acquisition]
+        if suite2p_params_file:
+            args += ["--suite2p-params-file", os.path.abspath(suite2p_params_file)]
+        slurm.write_array_script(
+            analyze_path / "analyze_planes.sbatch",
+            job_name="analyze-planes",
+            command=slurm.cli_command(layout, *args),
+            task_args="--plane %s" % slurm.TASK_ID,
+            num_tasks=z_planes,
+            log_path=layout.path("logs"),
+            description="Runs Suite2p on each z-plane of %s, then merges the planes." % layout.acquisition,
+            then=slurm.cli_command(layout, *args, "--merge-planes"),
+        )
+        return
+    if merge_planes:
+        merge_plane_results(analyze_path, save_folder, z_planes)
+        return
+    if plane is not None or plane_workers > 1:
+        planes = range(z_planes) if plane is None else [plane]
+        plane_params = []
+        for z in planes:
+            run_path = plane_run_path(analyze_path, z)
+            ops = {**params, "save_path0": str(run_path), "nplanes": 1}
+            if input_format == "binary":
+                suite2p_binary.prepare_analysis(binary_paths, run_path / save_folder, ops, plane=z)
+            else:
+                vds_path = run_path / "data" / f"plane{z}.h5"
+                concat.write_vds(vds_path, sources, infos, offsets, acquisitions, plane=z, relative=relative)
+                ops["data_path"] = [str(vds_path.parent)]
+            plane_params.append(ops)
+        run_planes(plane_params, plane_workers)
+        if plane is None:
+            merge_plane_results(analyze_path, save_folder, z_planes)
+        return
+
+    if input_format == "binary":
+        # Suite2p runs directly on the per-plane binaries found in its save folder.
+        suite2p_binary.prepare_analysis(binary_paths, analyze_path / save_folder, params)
     logger.info("Running suite2p on files:\n%s\n%s", "\n".join(data_paths_str), params)
 
     # Load suite2p only right before use, as it has a long load time.
     import suite2p
 
     suite2p.run_s2p(params)
+
+
+def plane_run_path(analyze_path, z):
+    """Directory of the Suite2p run on a single z-plane."""
+    return analyze_path / "planes" / f"plane{z}"
+
+
+def run_plane(params):
+    # Load suite2p only right before use, as it has a long load time.
+    import suite2p
+
+    logger.info("Running suite2p on plane with params:\n%s", params)
+    suite2p.run_s2p(params)
+
+
+def run_planes(plane_params, workers):
+    """Run Suite2p once per set of plane parameters, in a pool of `workers` processes."""
+    if workers <= 1:
+        for params in plane_params:
+            run_plane(params)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for future in [executor.submit(run_plane, params) for params in plane_params]:
+            future.result()
+
+
+def merge_plane_results(analyze_path, save_folder, z_planes):
+    """Move the per-plane Suite2p results into one save folder, and combine them as Suite2p does."""
+    save_path = analyze_path / save_folder
+    save_path.mkdir(parents=True, exist_ok=True)
+    for z in range(z_planes):
+        src = plane_run_path(analyze_path, z) / save_folder / "plane0"
+        dst = suite2p_binary.plane_dir(save_path, z)
+        if not (src / suite2p_binary.OPS_FILE).exists():
+            raise AnalyzeError("No Suite2p results for plane %d in %s" % (z, src))
+        if dst.exists():
+            logger.warning("Removing existing Suite2p results: %s", dst)
+            shutil.rmtree(dst)
+        os.replace(src, dst)
+
+        # Point the paths recorded in ops at the moved directory.
+        ops = np.load(dst / suite2p_binary.OPS_FILE, allow_pickle=True).item()
+        for key, value in ops.items():
+            if isinstance(value, str) and value.startswith(str(src)):
+                ops[key] = str(dst) + value[len(str(src)) :]
+        ops.update(iplane=z, nplanes=z_planes)
+        np.save(dst / suite2p_binary.OPS_FILE, ops)
+
+    import suite2p.io
+
+    logger.info("Combining results of %d planes in %s", z_planes, save_path)
+    suite2p.io.combined(str(save_path), save=True)
@@ -0,0 +1,236 @@
+"""Detecting stim artefacts from the images, for data without a reliable voltage stim channel.
+
+Stim light reaching the detector brightens (or, with a gated PMT, darkens) the rows scanned
+while the stim is on.  Each row of each frame is reduced to its mean intensity, streamed in
+blocks of time points, which shrinks the movie by the width of a frame.  Each row is then
+compared with a rolling median over time of the same row of the same plane, and scored in
+units of the robust (MAD) spread of the noise of that row over the session.  Runs of rows
+scoring above a threshold are artefacts.
+
+The rolling median follows slow changes such as calcium transients and bleaching, but an
+artefact in the same plane and rows for more than half of the window would be taken as the
+baseline, so the window must be more than twice the longest run of affected time points.
+
+Detected artefacts form a table of the same schema as preprocess.artefact_table, so they can
+be removed directly, or compared with the artefacts located from the voltage recordings.
+"""
+
+import logging
+
+import click
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+
+from two_photon import utils
+
+logger = logging.getLogger(__name__)
+
+BLOCK_TIMEPOINTS = 256  # Time points read at once.
+WINDOW_TIMEPOINTS = 21  # Time points of the rolling median baseline of each row.
+THRESHOLD = 6  # Robust z-score above which a row is an artefact.
+MIN_ROWS = 2  # Shortest run of rows kept as an artefact.
+MAD_TO_SD = 1.4826  # Ratio of the standard deviation to the median absolute deviation of normal data.
+MIN_SCALE = 1e-6  # Smallest robust spread of a row, for rows which never change.
+POLARITIES = ["bright", "dark", "both"]
+
+
+class ArtefactImageError(Exception):
+    """Error while detecting artefacts from the images."""
+
+
+def image_options(func):
+    """Click options for detecting artefacts from the images."""
+    options = [
+        click.option(
+            "--artefact-source",
+            type=click.Choice(["voltage", "image"]),
+            default="voltage",
+            show_default=True,
+            help="Locate artefacts from the voltage stim channel, or detect them from the images.",
+        ),
+        click.option(
+            "--check-image-artefacts/--no-check-image-artefacts",
+            default=False,
+            show_default=True,
+            help="Also detect artefacts from the images, and compare them with those from the voltage recordings.",
+        ),
+        click.option(
+            "--image-threshold",
+            type=float,
+            default=THRESHOLD,
+            show_default=True,
+            help="Robust z-score of a row's mean intensity, against its rolling baseline, marking an artefact.",
+        ),
+        click.option(
+            "--image-window",
+            type=int,
+            default=WINDOW_TIMEPOINTS,
+            show_default=True,
+            help="Time points of the rolling median baseline.  Must be over twice the longest artefact in time.",
+        ),
+        click.option(
+            "--image-min-rows", type=int, default=MIN_ROWS, show_default=True, help="Shortest artefact, in rows."
+        ),
+        click.option(
+            "--image-polarity",
+            type=click.Choice(POLARITIES),
+            default="bright",
+            show_default=True,
+            help="Whether artefacts brighten or darken rows.",
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def row_means(data, num_timepoints=None):
+    """Mean intensity of each row of (t, z, y, x) data, read in blocks, as a (t, z, y) float32 array."""
+    num_timepoints = data.shape[0] if num_timepoints is None else num_timepoints
+    means = np.empty((num_timepoints,) + tuple(data.shape[1:3]), dtype=np.float32)
+    for t_start, t_stop in utils.blocks(num_timepoints, BLOCK_TIMEPOINTS):
+        means[t_start:t_stop] = data[t_start:t_stop].mean(axis=3, dtype=np.float32)
+        logger.info("Read row means of time points %d-%d of %d", t_start, t_stop, num_timepoints)
+    return means
+
+
+def row_spread(plane):
+    """Robust standard deviation of the noise of (t, y) row means over time, for each row.
+
+    The spread is taken from the differences between consecutive time points, as a rolling
+    median tracks the data too closely for the spread of its residuals to be reliable where
+    the noise is small next to the trend.
+    """
+    diff = np.diff(plane, axis=0)
+    mad = np.median(np.abs(diff - np.median(diff, axis=0)), axis=0)
+    return np.maximum(MAD_TO_SD * mad / np.sqrt(2), MIN_SCALE)
+
+
+def row_scores(means, window=WINDOW_TIMEPOINTS, polarity="bright"):
+    """Robust z-scores of (t, z, y) row means against a rolling median of each row over time."""
+    scores = np.empty_like(means)
+    for z in range(means.shape[1]):
+        plane = means[:, z]
+        residual = plane - scipy.ndimage.median_filter(plane, size=(window, 1), mode="nearest")
+        scores[:, z] = residual / row_spread(plane)
+    if polarity == "dark":
+        return -scores
+    if polarity == "both":
+        return np.abs(scores)
+    return scores
+
+
+def artefact_mask(scores, threshold=THRESHOLD, min_rows=MIN_ROWS, buffer_rows=0):
+    """Boolean (t, z, y) mask of runs of at least min_rows rows scoring above threshold, widened by buffer_rows."""
+    mask = scores > threshold
+    if min_rows > 1:
+        mask = scipy.ndimage.binary_opening(mask, structure=np.ones((1, 1, min_rows), dtype=bool))
+    buffer_rows = int(np.ceil(buffer_rows))
+    if buffer_rows > 0:
+        mask = scipy.ndimage.binary_dilation(mask, structure=np.ones((1, 1, 2 * buffer_rows + 1), dtype=bool))
+    return mask
+
+
+def mask_regions(mask):
+    """Runs of artefact rows of a (t, z, y) mask, as (t, z, row_start, row_stop) arrays in (t, z, y) order."""
+    padded = np.zeros(mask.shape[:2] + (mask.shape[2] + 2,), dtype=np.int8)
+    padded[..., 1:-1] = mask
+    edges = np.diff(padded, axis=2)
+    # Starts and stops are found in the same order, so the i-th start and stop bound one run.
+    t, z, row_start = np.nonzero(edges == 1)
+    row_stop = np.nonzero(edges == -1)[2]
+    return t, z, row_start, row_stop
+
+
+def artefact_table(t, z, row_start, row_stop, shape, piezo_period_frames=None, piezo_skip_frames=None):
+    """Artefact table of regions of data with the given (t, z, y, x) shape, as from preprocess.artefact_table.
+
+    The frame of each region is its acquisition frame.  A region reaching the last row which is
+    continued from the first row of the next frame is part of the same stim.
+    """
+    num_z, num_y = shape[1], shape[2]
+    if piezo_period_frames is None:
+        frame = t * num_z + z
+    else:
+        frame = t * piezo_period_frames + (piezo_skip_frames or 0) + z
+    order = np.lexsort((row_start, frame))
+    t, z, row_start, row_stop, frame = (
+        np.asarray(values, dtype=np.int64)[order] for values in (t, z, row_start, row_stop, frame)
+    )
+
+    continues = (np.diff(frame) == 1) & (row_stop[:-1] == num_y) & (row_start[1:] == 0)
+    stim = np.concatenate([[0], np.cumsum(~continues)]) if len(frame) else np.zeros(0, dtype=np.int64)
+    return pd.DataFrame(
+        {
+            "frame": frame,
+            "frac_start": row_start / num_y,
+            "frac_stop": row_stop / num_y,
+            "stim": stim,
+            "row_start": row_start,
+            "row_stop": row_stop,
+            "t": t,
+            "z": z,
+        }
+    )
+
+
+def detect(
+    data,
+    shape=None,
+    window=WINDOW_TIMEPOINTS,
+    threshold=THRESHOLD,
+    min_rows=MIN_ROWS,
+    polarity="bright",
+    buffer_rows=0,
+    piezo_period_frames=None,
+    piezo_skip_frames=None,
+):
+    """Detect artefacts in the first shape[0] time points of (t, z, y, x) data, returning the artefact table."""
+    shape = data.shape if shape is None else shape
+    if window < 3:
+        raise ArtefactImageError("Window of the rolling baseline must be at least 3 time points, not %d" % window)
+    means = row_means(data, shape[0])
+    logger.info("Scoring rows against a rolling baseline of %d time points", window)
+    mask = artefact_mask(row_scores(means, window, polarity), threshold, min_rows, buffer_rows)
+    df_artefacts = artefact_table(*mask_regions(mask), shape, piezo_period_frames, piezo_skip_frames)
+    logger.info(
+        "Detected %d artefacts of %d stims, covering %.3f%% of rows",
+        len(df_artefacts),
+        df_artefacts["stim"].nunique(),
+        100 * mask.mean(),
+    )
+    return df_artefacts
+
+
+def compare(df_detected, df_expected, num_y):
+    """Compare detected artefacts with those expected, such as from the voltage recordings.
+
+    Frames (t, z) are matched if both tables have an artefact in them.  The offsets are the
+    median number of rows by which detected artefacts start and stop after the expected ones,
+    over the artefact edges inside a frame: a start offset suggests the shift (`--shift-px`) of
+    the expected stims, and the stop offset less the start offset their missing buffer.
+    """
+
+    def by_frame(df):
+        return df.groupby(["t", "z"]).agg(row_start=("row_start", "min"), row_stop=("row_stop", "max"))
+
+    detected, expected = by_frame(df_detected), by_frame(df_expected)
+    matched = expected.join(detected, how="inner", lsuffix="_expected", rsuffix="_detected")
+    starts = matched[matched["row_start_expected"] > 0]
+    stops = matched[matched["row_stop_expected"] < num_y]
+
+    def median_offset(df, column):
+        if df.empty:
+            return None
+        return float(np.median(df[column + "_detected"] - df[column + "_expected"]))
+
+    return {
+        "expected_frames": len(expected),
+        "detected_frames": len(detected),
+        "matched_frames": len(matched),
+        "missed_frames": len(expected) - len(matched),
+        "extra_frames": len(detected) - len(matched),
+        "start_offset_rows": median_offset(starts, "row_start"),
+        "stop_offset_rows": median_offset(stops, "row_stop"),
+    }
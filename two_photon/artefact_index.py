@@ -0,0 +1,156 @@
+"""NumPy-backed index of artefact regions, for fast lookup in the inner loops of artefact removal.
+
+Artefacts are stored sorted by time point, with CSR-style offsets: the artefacts of time
+point `t` are entries `offsets[t]:offsets[t + 1]` of the `z`, `row_start` and `row_stop`
+arrays.  Looking up a time point, or a range of time points, is then an O(1) slice.
+
+The artefact file written by preprocess stores the index in that form, alongside the full
+artefact table, the frame and stim windows it was computed from, and the parameters used.
+Tables are structured arrays in plain hdf5 datasets, so the file is read with h5py alone.
+"""
+
+import h5py
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+TABLES = ["artefacts", "frames", "stims"]  # Tables stored in the artefact file, when given.
+INDEX_GROUP = "index"
+PARAMS_GROUP = "params"
+INDEX_FIELDS = ["offsets", "t", "z", "row_start", "row_stop"]
+
+
+class ArtefactIndexError(Exception):
+    """Error while reading an artefact file."""
+
+
+class ArtefactIndex:
+    """Artefact regions (t, z, row_start:row_stop) indexed by time point.
+
+    Parameters
+    ----------
+    offsets: np.ndarray of int, shape (num_timepoints + 1,)
+        Start of each time point's entries in the remaining arrays.
+    t, z, row_start, row_stop: np.ndarray of int
+        Artefact regions, sorted by `t`.  `row_stop` is exclusive.
+    """
+
+    def __init__(self, offsets, t, z, row_start, row_stop):
+        self.offsets = offsets
+        self.t = t
+        self.z = z
+        self.row_start = row_start
+        self.row_stop = row_stop
+
+    @classmethod
+    def from_arrays(cls, t, z, row_start, row_stop, num_timepoints=None):
+        """Build the index from unsorted arrays of artefact regions."""
+        t = np.asarray(t, dtype=np.int64)
+        order = np.argsort(t, kind="stable")
+        t = t[order]
+        if num_timepoints is None:
+            num_timepoints = int(t[-1]) + 1 if len(t) else 0
+        keep = (t >= 0) & (t < num_timepoints)
+        order, t = order[keep], t[keep]
+
+        counts = np.bincount(t, minlength=num_timepoints)
+        offsets = np.zeros(num_timepoints + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(
+            offsets,
+            t,
+            np.asarray(z, dtype=np.int64)[order],
+            np.asarray(row_start, dtype=np.int64)[order],
+            np.asarray(row_stop, dtype=np.int64)[order],
+        )
+
+    @property
+    def num_timepoints(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.t)
+
+    def _bounds(self, t_start, t_stop):
+        t_start = min(max(t_start, 0), self.num_timepoints)
+        t_stop = min(max(t_stop, t_start), self.num_timepoints)
+        return self.offsets[t_start], self.offsets[t_stop]
+
+    def lookup(self, t):
+        """Artefacts (z, row_start, row_stop) of a single time point."""
+        lo, hi = self._bounds(t, t + 1)
+        return self.z[lo:hi], self.row_start[lo:hi], self.row_stop[lo:hi]
+
+    def lookup_range(self, t_start, t_stop):
+        """Artefacts (t, z, row_start, row_stop) of time points [t_start, t_stop)."""
+        lo, hi = self._bounds(t_start, t_stop)
+        return self.t[lo:hi], self.z[lo:hi], self.row_start[lo:hi], self.row_stop[lo:hi]
+
+    def mask(self, t_start, t_stop, num_z, num_y):
+        """Boolean (t, z, y) mask of artefact rows for time points [t_start, t_stop)."""
+        t, z, row_start, row_stop = self.lookup_range(t_start, t_stop)
+        # Mark +1 at each region start and -1 at its stop, so a cumulative sum along y is positive
+        # exactly on artefact rows.  This handles overlapping regions without a python loop.
+        diff = np.zeros((t_stop - t_start, num_z, num_y + 1), dtype=np.int32)
+        np.add.at(diff, (t - t_start, z, np.clip(row_start, 0, num_y)), 1)
+        np.add.at(diff, (t - t_start, z, np.clip(row_stop, 0, num_y)), -1)
+        return np.cumsum(diff, axis=2)[..., :num_y] > 0
+
+
+def write(path, index, df_artefacts, df_frames=None, df_stims=None, params=None):
+    """Write an artefact file holding the index, artefact table, frame/stim windows and parameters.
+
+    Parameters with a value of None are not stored.
+    """
+    tables = {"artefacts": df_artefacts, "frames": df_frames, "stims": df_stims}
+    with h5py.File(path, "w") as h5file:
+        h5file.attrs["version"] = FORMAT_VERSION
+        for name, df in tables.items():
+            if df is not None:
+                h5file.create_dataset(name, data=df.reset_index(drop=True).to_records(index=False))
+        group = h5file.create_group(INDEX_GROUP)
+        for field in INDEX_FIELDS:
+            group.create_dataset(field, data=getattr(index, field))
+        params_group = h5file.create_group(PARAMS_GROUP)
+        for key, value in (params or {}).items():
+            if value is not None:
+                params_group.attrs[key] = value
+
+
+def _version(h5file, path):
+    # Artefact files written before the format was versioned are pandas (PyTables) tables.
+    version = h5file.attrs.get("version")
+    if version is not None and int(version) != FORMAT_VERSION:
+        raise ArtefactIndexError("Unsupported artefact file version %d in %s" % (version, path))
+    return version
+
+
+def read(path):
+    """Read the ArtefactIndex of an artefact file, ready for lookups without sorting."""
+    with h5py.File(path, "r") as h5file:
+        if _version(h5file, path) is not None:
+            return ArtefactIndex(*(h5file[INDEX_GROUP][field][...] for field in INDEX_FIELDS))
+    df = read_table(path)
+    return ArtefactIndex.from_arrays(df["t"], df["z"], df["row_start"], df["row_stop"])
+
+
+def read_table(path, name="artefacts"):
+    """Read one of the TABLES of an artefact file as a dataframe."""
+    with h5py.File(path, "r") as h5file:
+        if _version(h5file, path) is not None:
+            if name not in h5file:
+                raise ArtefactIndexError("No %s table stored in %s" % (name, path))
+            return pd.DataFrame(h5file[name][...])
+    if name != "artefacts":
+        raise ArtefactIndexError("Unversioned artefact file %s only stores the artefacts table" % path)
+    return pd.read_hdf(path, "artefacts")
+
+
+def read_params(path):
+    """Read the parameters recorded in an artefact file, as a dict."""
+    with h5py.File(path, "r") as h5file:
+        if _version(h5file, path) is None:
+            return {}
+        params = dict(h5file[PARAMS_GROUP].attrs)
+    # Scalars are read as numpy types, converted back to plain python values.
+    return {key: value.item() if isinstance(value, np.generic) else value for key, value in params.items()}
@@ -1,7 +1,10 @@
+import concurrent.futures
 import logging
 import os
 import platform
 import subprocess
+import threading
+import time
 
 import click
 from click_pathlib import Path
@@ -33,7 +36,8 @@ class BackupError(Exception):
 #     backup(trial_order_path, dirname_backup / "trial_order")
 #     # backup_pattern(slm_root, slm_trial_order_pattern, dirname_backup / 'trial_order')
 
-ALLOWED_BACKUP_OPTIONS = ["raw", "tiff", "convert", "preprocess", "analyze"]
+ALLOWED_BACKUP_OPTIONS = ["raw", "tiff", "convert", "preprocess", "sta", "analyze", "traces"]
+BACKUP_WORKERS = 2  # Number of stages backed up at once in the background.
 
 
 class BackupOptions(click.ParamType):
@@ -78,18 +82,83 @@ def backup(layout, backup_path, backup_stages):
         Names of stages to backup
     """
     for stage in backup_stages:
-        local_path = layout.path(stage)
-        remote_path = layout.backup_path(backup_path, stage)
+        backup_stage(layout, backup_path, stage)
 
-        if stage == "tiff":  # TIFF stacks need to be archived first.
-            archive = archive_path(local_path)
-            backup_one_path(archive, remote_path / archive.name)
-        else:
-            backup_one_path(local_path, remote_path)
 
+def backup_stage(layout, backup_path, stage, bwlimit=None):
+    """Back up the output directory of one stage."""
+    local_path = layout.path(stage)
+    remote_path = layout.backup_path(backup_path, stage)
+
+    if stage == "tiff":  # TIFF stacks need to be archived first.
+        archive = archive_path(local_path)
+        backup_one_path(archive, remote_path / archive.name, bwlimit)
+    else:
+        backup_one_path(local_path, remote_path, bwlimit)
+
+
+class BackgroundBackup:
+    """Backs up stages in background threads while later stages of the pipeline run.
+
+    Each stage is backed up once `stage_done` reports its output is complete.  A stage reported
+    twice is synced again after its first backup, which then copies only what changed.
+
+    Parameters
+    ----------
+    layout: Layout object
+        Object used to determine path naming
+    backup_path: pathlib.Path
+        Top-level directory where backup data resides
+    backup_stages: list of str
+        Names of stages to backup; other stages reported done are ignored.
+    workers: int
+        Number of stages backed up at once.
+    bwlimit: int, optional
+        Bandwidth limit of each transfer, in KB/s (Linux only).
+    """
 
-def backup_one_path(local_path, backup_path):
-    """Sync local data to backup directory."""
+    def __init__(self, layout, backup_path, backup_stages, workers=BACKUP_WORKERS, bwlimit=None):
+        self.layout = layout
+        self.backup_path = backup_path
+        self.backup_stages = backup_stages
+        self.bwlimit = bwlimit
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="backup")
+        self.futures = []
+        self.locks = {stage: threading.Lock() for stage in backup_stages}
+
+    def stage_done(self, stage):
+        """Queue a backup of the stage, if it is one to back up."""
+        if stage not in self.backup_stages:
+            return
+        logger.info("Queuing background backup of %s", stage)
+        self.futures.append((stage, self.executor.submit(self._backup, stage)))
+
+    def _backup(self, stage):
+        # Backups of the same stage run in turn, so a re-sync never races the first copy.
+        with self.locks[stage]:
+            start = time.time()
+            backup_stage(self.layout, self.backup_path, stage, self.bwlimit)
+            return time.time() - start
+
+    def wait(self):
+        """Wait for all queued backups, logging the status of each, and raise BackupError if any failed."""
+        if self.futures:
+            logger.info("Waiting for %d background backups", sum(not future.done() for _, future in self.futures))
+        self.executor.shutdown(wait=True)
+        failed = []
+        for stage, future in self.futures:
+            exc = future.exception()
+            if exc is None:
+                logger.info("Backup of %s done in %.1f seconds", stage, future.result())
+            else:
+                logger.error("Backup of %s failed: %s", stage, exc)
+                failed.append(stage)
+        if failed:
+            raise BackupError("Background backup failed for stages: %s" % ", ".join(failed))
+
+
+def backup_one_path(local_path, backup_path, bwlimit=None):
+    """Sync local data to backup directory, at up to bwlimit KB/s if given (Linux only)."""
     os.makedirs(backup_path.parent, exist_ok=True)
     system = platform.system()
     if system == "Windows":
@@ -105,14 +174,17 @@ def backup_one_path(local_path, backup_path):
                 local_path.name,
             ]
         expected_returncode = 1  # robocopy.exe gives exit code 1 for a successful copy.
+        if bwlimit is not None:
+            logger.warning("Bandwidth limit is not supported with robocopy.exe, copying at full speed")
     elif system == "Linux":
+        options = ["-avh"] if bwlimit is None else ["-avh", f"--bwlimit={bwlimit}"]
         if os.path.isdir(local_path):
-            cmd = ["rsync", "-avh", str(local_path) + "/", str(backup_path)]
+            cmd = ["rsync", *options, str(local_path) + "/", str(backup_path)]
         else:
             os.makedirs(backup_path, exist_ok=True)
             cmd = [
                 "rsync",
-                "-avh",
+                *options,
                 str(local_path),
                 str(backup_path / local_path.name),
             ]
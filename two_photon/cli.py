@@ -1,20 +1,121 @@
 import datetime
+import functools
 import logging
+import pathlib
 
 import click
 from click_pathlib import Path
 
-from . import analyze, backup, convert, layout, preprocess, qa, raw2tiff
+from . import (
+    analyze,
+    backup,
+    convert,
+    follow,
+    frames,
+    layout,
+    preprocess,
+    preview,
+    qa,
+    raw2tiff,
+    sta,
+    staging,
+    storage,
+    traces,
+)
+
+logger = logging.getLogger(__name__)
+
+# Stages each command reads, which must be prefetched into their roots before it starts.  An
+# overlay preprocess.h5 reads unchanged rows from orig.h5, so readers of preprocess also read convert.
+STAGE_INPUTS = {
+    "raw2tiff": ["raw"],
+    "convert": ["raw", "tiff"],
+    "follow": ["raw", "tiff"],
+    "preprocess": ["raw", "convert"],
+    "preview": ["convert", "preprocess"],
+    "qa": ["convert", "preprocess"],
+    "sta": ["convert", "preprocess"],
+    "analyze": ["raw", "convert", "preprocess"],
+    "traces": ["convert", "preprocess", "analyze"],
+}
+
+# Stages whose output is complete once each command finishes, for write-back and background
+# backup.  The raw stage is also backed up at the start, and synced again after raw2tiff copies
+# metadata into it.
+STAGE_OUTPUTS = {
+    "raw2tiff": ["raw", "tiff"],
+    "convert": ["convert"],
+    "follow": ["convert", "preprocess"],
+    "preprocess": ["preprocess"],
+    "preview": ["preview"],
+    "qa": ["qa"],
+    "sta": ["sta"],
+    "analyze": ["analyze"],
+    "traces": ["traces"],
+}
+
+
+def parse_stage_roots(ctx, param, value):
+    stage_roots = {}
+    for item in value:
+        stage, sep, root = item.partition("=")
+        if not sep or not stage or not root:
+            raise click.BadParameter(f"'{item}' is not of the form STAGE=PATH")
+        stage_roots[stage] = pathlib.Path(root)
+    return stage_roots
 
 
 @click.group(chain=True)
 @click.pass_context
 @click.option("--base-path", type=Path(exists=True), required=True, help="Top-level storage for local data.")
 @click.option("--acquisition", required=True, help="Acquisition sub-directory to process.")
-def cli(ctx, base_path, acquisition):
+@click.option(
+    "--async-backup-path",
+    type=Path(exists=True),
+    help="Back up stages to this directory in the background, as each stage finishes.",
+)
+@click.option(
+    "--async-backup-stages",
+    type=backup.BackupOptions(),
+    default="all",
+    show_default=True,
+    help="Names of stages to back up in the background, as for backup --backup-stages.",
+)
+@click.option(
+    "--async-backup-workers",
+    type=int,
+    default=backup.BACKUP_WORKERS,
+    show_default=True,
+    help="Number of stages backed up at once in the background.",
+)
+@click.option("--async-backup-bwlimit", type=int, help="Bandwidth limit of each background backup, in KB/s.")
+@click.option(
+    "--stage-root",
+    "stage_roots",
+    multiple=True,
+    callback=parse_stage_roots,
+    help="Keep a stage under another root, such as node-local scratch, as STAGE=PATH.  May be repeated.",
+)
+@click.option(
+    "--write-back/--no-write-back",
+    default=True,
+    show_default=True,
+    help="Copy stages with their own roots back to the base path as they finish.",
+)
+def cli(
+    ctx,
+    base_path,
+    acquisition,
+    async_backup_path,
+    async_backup_stages,
+    async_backup_workers,
+    async_backup_bwlimit,
+    stage_roots,
+    write_back,
+):
     dt = datetime.datetime.now().strftime("%Y%m%d.%H%M%S")
 
-    lo = layout.Layout(base_path, acquisition)
+    lo = layout.Layout(base_path, acquisition, stage_roots)
     ctx.obj = lo
 
     logs_path = lo.path("logs")
@@ -28,10 +129,62 @@ def cli(ctx, base_path, acquisition):
         handlers=[logging.StreamHandler(), logging.FileHandler(fname_logs)],
     )
 
+    # Waits below run once the chain of commands exits, so processing and copying overlap.
+    if stage_roots:
+        stager = staging.Staging(lo, write_back)
+        ctx.meta["staging"] = stager
+        ctx.call_on_close(stager.wait)
+        stager.prefetch()
+
+    if async_backup_path is not None:
+        uploader = backup.BackgroundBackup(
+            lo, async_backup_path, async_backup_stages, async_backup_workers, async_backup_bwlimit
+        )
+        ctx.meta["backup"] = uploader
+        ctx.call_on_close(uploader.wait)
+        # Raw data with its own root is still being prefetched, and is backed up after raw2tiff.
+        if "raw" not in stage_roots and lo.path("raw").exists():
+            uploader.stage_done("raw")
+
+
+def track_stages(command):
+    """Wait for a command's input stages to be prefetched, and hand its output stages on once it returns.
+
+    The prefetch of its output stages is waited for too, so that stale copies from the base path
+    never overwrite the outputs of a rerun.  Commands run with --sbatch only write a script for
+    SLURM, so their output stages are written back, for the array tasks to read, but not backed up.
+    """
+    callback = command.callback
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        meta = click.get_current_context().meta
+        stager = meta.get("staging")
+        if stager is not None:
+            stager.wait_for(STAGE_INPUTS[command.name] + STAGE_OUTPUTS[command.name])
+        result = callback(*args, **kwargs)
+        for stage in STAGE_OUTPUTS[command.name]:
+            if stager is not None:
+                stager.write_back(stage)
+            if kwargs.get("sbatch"):
+                logger.info("Not backing up %s, whose outputs are still to be made under SLURM", stage)
+            elif meta.get("backup") is not None:
+                meta["backup"].stage_done(stage)
+        return result
+
+    command.callback = wrapper
+    return command
+
 
-cli.add_command(raw2tiff.raw2tiff)
-cli.add_command(convert.convert)
-cli.add_command(preprocess.preprocess)
-cli.add_command(qa.qa)
-cli.add_command(analyze.analyze)
+cli.add_command(track_stages(raw2tiff.raw2tiff))
+cli.add_command(track_stages(convert.convert))
+cli.add_command(track_stages(follow.follow))
+cli.add_command(track_stages(preprocess.preprocess))
+cli.add_command(storage.export)
+cli.add_command(track_stages(preview.preview))
+cli.add_command(track_stages(qa.qa))
+cli.add_command(track_stages(sta.sta))
+cli.add_command(track_stages(analyze.analyze))
+cli.add_command(track_stages(traces.traces))
 cli.add_command(backup.backup)
+cli.add_command(frames.serve)
@@ -0,0 +1,109 @@
+"""Joins preprocessed acquisitions for analysis together, without copying their data.
+
+Each preprocess run caches the shape, dtype and frame period of its output in a small JSON
+file, so acquisitions can be checked against each other without opening their hdf5 files.
+The acquisitions are then presented to Suite2p as one hdf5 virtual dataset (VDS), which
+maps consecutive ranges of time points onto the preprocess.h5 file of each acquisition.
+The frame offset of each acquisition is recorded, so traces can be split back afterwards.
+"""
+
+import json
+import logging
+
+import h5py
+import numpy as np
+
+from two_photon import storage, utils
+
+logger = logging.getLogger(__name__)
+
+KEY = "data"
+FRAME_PERIOD_RTOL = 1e-6  # Relative tolerance when comparing frame periods of acquisitions.
+
+
+class ConcatError(Exception):
+    """Error while joining acquisitions."""
+
+
+def write_info(path, shape, dtype, frame_period):
+    """Cache the shape, dtype and frame period of preprocessed data."""
+    info = {"shape": [int(n) for n in shape], "dtype": np.dtype(dtype).name, "frame_period": frame_period}
+    with open(path, "w") as fout:
+        json.dump(info, fout, indent=4)
+
+
+def read_info(layout, acquisition=None):
+    """Read the cached info of an acquisition's preprocessed data.
+
+    Outputs of earlier preprocess runs have no cache, so it is built (once) from the hdf5 file and
+    the acquisition XML.
+    """
+    path = layout.preprocess_info_path(acquisition)
+    if not path.exists():
+        logger.info("Caching preprocessed data info in %s", path)
+        with h5py.File(layout.preprocess_h5_path(acquisition), "r") as h5file:
+            data = h5file[KEY]
+            write_info(path, data.shape, data.dtype, utils.frame_period(layout, acquisition))
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def frame_offsets(infos, acquisitions):
+    """Check that acquisitions can be joined, and return the offset of each one's first time point.
+
+    The returned array has one more entry than `infos`, the total number of time points.
+    """
+    first = infos[0]
+    for acquisition, info in zip(acquisitions, infos):
+        if info["shape"][1:] != first["shape"][1:] or info["dtype"] != first["dtype"]:
+            raise ConcatError(
+                "Acquisition %s has shape %s and type %s, expected (*, %s) and %s as in %s"
+                % (acquisition, info["shape"], info["dtype"], first["shape"][1:], first["dtype"], acquisitions[0])
+            )
+        if not np.isclose(info["frame_period"], first["frame_period"], rtol=FRAME_PERIOD_RTOL, atol=0):
+            raise ConcatError(
+                "Acquisition %s has frame period %s, expected %s as in %s"
+                % (acquisition, info["frame_period"], first["frame_period"], acquisitions[0])
+            )
+    offsets = np.zeros(len(infos) + 1, dtype=np.int64)
+    np.cumsum([info["shape"][0] for info in infos], out=offsets[1:])
+    return offsets
+
+
+def write_vds(path, sources, infos, offsets, acquisitions, plane=None, relative=True):
+    """Write a virtual dataset joining the `data` of each source file along time.
+
+    If `plane` is given, only that z-plane is included, as a (t, y, x) dataset.  The frame
+    offsets and acquisition names are stored as attributes of the dataset, and in a JSON file
+    alongside it.  Sources are referred to relative to `path` (see storage.vds_source_path),
+    unless `relative` is False, for sources which are not moved along with it.
+    """
+    shape = (int(offsets[-1]),) + tuple(infos[0]["shape"][1:])
+    if plane is not None:
+        shape = shape[:1] + shape[2:]
+    layout = h5py.VirtualLayout(shape=shape, dtype=infos[0]["dtype"])
+    for source, info, start, stop in zip(sources, infos, offsets[:-1], offsets[1:]):
+        name = storage.vds_source_path(source, path) if relative else str(source.resolve())
+        vsource = h5py.VirtualSource(name, KEY, shape=tuple(info["shape"]))
+        layout[start:stop] = vsource if plane is None else vsource[:, plane]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, "w") as h5file:
+        dset = h5file.create_virtual_dataset(KEY, layout)
+        dset.attrs["frame_offsets"] = offsets
+        dset.attrs["acquisitions"] = [acquisition.encode() for acquisition in acquisitions]
+
+    with open(path.with_suffix(".json"), "w") as fout:
+        json.dump({"acquisitions": list(acquisitions), "frame_offsets": offsets.tolist()}, fout, indent=4)
+
+
+def read_offsets(path):
+    """Read the acquisitions and frame offsets recorded by `write_vds`."""
+    with open(path.with_suffix(".json")) as fin:
+        concat = json.load(fin)
+    return concat["acquisitions"], np.array(concat["frame_offsets"])
+
+
+def split_traces(traces, offsets):
+    """Split (..., time) traces of joined acquisitions, such as Suite2p's F.npy, per acquisition."""
+    return [traces[..., start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
@@ -1,25 +1,41 @@
 """Command to convert Bruker OME TIFF stack to hdf5."""
 
+import collections
+import concurrent.futures
 import logging
-import shutil
+import time
 
 import click
-import h5py
 import pandas as pd
 import tifffile
 
-from two_photon import correct_omexml
+from two_photon import correct_omexml, placement, stats, storage, tiff_index, utils
 
 logger = logging.getLogger(__name__)
 
 
 TIFF_GLOB_INIT = "*_Cycle00001_Ch{channel}_000001.ome.tif"
 
+READ_WORKERS = 8  # Number of TIFF files read concurrently by the index reader.
+READ_BLOCK_TIMEPOINTS = 32  # Number of time points read and written at once.
+READ_AHEAD_BLOCKS = 2  # Number of blocks read ahead of the one being written.
+
 
 class ConvertError(Exception):
     """Error during conversion of TIFF stack to HDF5."""
 
 
+def piezo_options(func):
+    """Click options describing a piezo z-scan, shared by commands reading or mapping its frames."""
+    options = [
+        click.option("--piezo-period-frames", type=int, help="The period of piezo oscillation, in number of frames."),
+        click.option("--piezo-skip-frames", type=int, help="The number of frames skipped in each piezo period."),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
 @click.command()
 @click.pass_obj
 @click.option(
@@ -28,13 +44,32 @@ class ConvertError(Exception):
     required=True,
     help="Channel number of tiff stack to convert to hdf5",
 )
+@click.option(
+    "--reader",
+    type=click.Choice(["index", "omexml"]),
+    default="index",
+    help=(
+        "How to locate frames: 'index' reads pages using the Bruker acquisition XML, "
+        "'omexml' loads the stack through the master OME tiff"
+    ),
+    show_default=True,
+)
 @click.option(
     "--fix-tiff/--no-fix-tiff",
     default=True,
-    help="Rewrite the master OME tiff to fix mis-specification by Bruker scopes",
+    help="Rewrite the master OME tiff to fix mis-specification by Bruker scopes (omexml reader only)",
     show_default=True,
 )
-def convert(layout, channel, fix_tiff):
+@storage.storage_option
+@piezo_options
+@click.option(
+    "--read-workers",
+    type=int,
+    default=READ_WORKERS,
+    show_default=True,
+    help="Number of TIFF files opened and decoded concurrently (index reader only).",
+)
+def convert(layout, channel, reader, fix_tiff, backend, piezo_period_frames, piezo_skip_frames, read_workers):
     """Convert OME TIFF stack and voltage recording data to HDF5."""
     # Input filenames
     voltage_csv_path = layout.raw_voltage_path()
@@ -43,9 +78,25 @@ def convert(layout, channel, fix_tiff):
     # Output filenames
     convert_path = layout.path("convert")
     convert_path.mkdir(parents=True, exist_ok=True)
-    orig_h5_path = convert_path / "orig.h5"
-    voltage_h5_path = convert_path / "voltage.h5"
+    orig_path = storage.with_backend(layout.orig_h5_path(), backend)
+    voltage_h5_path = layout.voltage_h5_path()
+
+    convert_voltage(voltage_csv_path, voltage_h5_path)
 
+    storage.remove(orig_path)
+
+    piezo = None if piezo_period_frames is None else (piezo_period_frames, piezo_skip_frames or 0)
+    if reader == "index":
+        index_path = convert_path / "tiff_index.npz"
+        convert_indexed(layout.raw_xml_path(), channel, tiff_path, orig_path, index_path, piezo, read_workers)
+    else:
+        convert_omexml(tiff_path, channel, fix_tiff, orig_path, piezo)
+
+    logger.info("Done")
+
+
+def convert_voltage(voltage_csv_path, voltage_h5_path):
+    """Convert the voltage recording csv to hdf5, returning the recordings as a dataframe."""
     logger.info("Reading voltage recordings from: %s", voltage_csv_path)
     df_voltage = pd.read_csv(voltage_csv_path, index_col="Time(ms)", skipinitialspace=True)
     logger.info("Voltage recordings head:\n%s", df_voltage.head())
@@ -56,7 +107,83 @@ def convert(layout, channel, fix_tiff):
         voltage_h5_path.unlink()
     df_voltage.to_hdf(voltage_h5_path, "voltage")
     logger.info("Done writing voltage data to hdf5")
-
+    return df_voltage
+
+
+def convert_indexed(xml_path, channel, tiff_path, orig_path, index_path, piezo=None, read_workers=READ_WORKERS):
+    """Convert the TIFF stack to hdf5 (or zarr) by reading pages located via the acquisition XML.
+
+    Files are read by `read_workers` threads, ahead of the block being written.  If `piezo` is
+    given as (period_frames, skip_frames), frames are regrouped into volumes of the piezo
+    z-scan, and flyback frames are never read.
+    """
+    logger.info("Building tiff index from: %s", xml_path)
+    index = tiff_index.TiffIndex.from_xml(xml_path, channel)
+    if piezo is not None:
+        index = index.with_piezo(*piezo)
+    index.save(index_path)
+    logger.info("Stored tiff index in %s", index_path)
+
+    frame = index.read_frame(tiff_path, 0, 0)
+    shape = index.shape + frame.shape
+    logger.info("Found TIFF data with shape %s and type %s", shape, frame.dtype)
+
+    logger.info("Writing image data to: %s" % orig_path)
+    with storage.open_store(orig_path, "w") as store:
+        # One chunk per frame, so any (t, z) frame can be read back without decoding others.
+        dset = store.create("data", shape=shape, dtype=frame.dtype, chunks=(1, 1) + frame.shape)
+        set_piezo_attrs(store, piezo)
+        summary = stats.SummaryStats()
+        start_time = time.time()
+        num_bytes = 0
+        for t_start, t_stop, block in read_blocks(index, tiff_path, read_workers):
+            dset[t_start:t_stop] = block
+            summary.update(block)
+            num_bytes += block.nbytes
+            logger.info(
+                "Wrote time points %d-%d of %d (%.1f MB/s)", t_start, t_stop, shape[0], _rate(num_bytes, start_time)
+            )
+        summary.write(store)
+    elapsed = time.time() - start_time
+    logger.info(
+        "Done writing image data: %.1f MB in %.1f s (%.1f MB/s) with %d read workers",
+        num_bytes / 1e6,
+        elapsed,
+        _rate(num_bytes, start_time),
+        read_workers,
+    )
+
+
+def read_blocks(index, tiff_path, read_workers=READ_WORKERS, read_ahead=READ_AHEAD_BLOCKS):
+    """Yield (t_start, t_stop, block) of indexed frames in time order, reading upcoming blocks in the background.
+
+    Each block's files are opened and decoded by a pool of `read_workers` threads, which release
+    the GIL while waiting on the filesystem.  Up to `read_ahead` blocks are read while the caller
+    writes the current one.
+    """
+    blocks = utils.blocks(index.shape[0], READ_BLOCK_TIMEPOINTS)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(read_workers) as file_executor:
+        # Blocks are gathered in a separate pool, as they wait on the reads of their files.
+        with concurrent.futures.ThreadPoolExecutor(read_ahead + 1) as block_executor:
+            for t_start, t_stop in blocks:
+                future = block_executor.submit(index.read, tiff_path, t_start, t_stop, file_executor)
+                pending.append((t_start, t_stop, future))
+                if len(pending) > read_ahead:
+                    t_start, t_stop, future = pending.popleft()
+                    yield t_start, t_stop, future.result()
+            while pending:
+                t_start, t_stop, future = pending.popleft()
+                yield t_start, t_stop, future.result()
+
+
+def _rate(num_bytes, start_time):
+    """Throughput in MB/s since start_time."""
+    return num_bytes / 1e6 / max(time.time() - start_time, 1e-9)
+
+
+def convert_omexml(tiff_path, channel, fix_tiff, orig_path, piezo=None):
+    """Convert the TIFF stack to hdf5 (or zarr) by loading it through the (corrected) master OME tiff."""
     # To load OME tiff stacks, it suffices to load just the first file, which contains
     # metadata to allow `tifffile` to load the entire stack.
     tiff_glob = TIFF_GLOB_INIT.format(channel=channel)
@@ -72,21 +199,43 @@ def convert(layout, channel, fix_tiff):
         if tiff_init_fixed.exists():
             logger.warning("Deleting previously corrected Burker tiff: %s", str(tiff_init))
             tiff_init_fixed.unlink()
-        shutil.copy(tiff_init, tiff_init_fixed)
+        # Not a hardlink, which would correct the original in place too.
+        placement.place(tiff_init, tiff_init_fixed, link=False)
         correct_omexml.correct_tiff(tiff_init_fixed)
         tiff_init = tiff_init_fixed
 
     logger.info("Reading TIFF metadata")
     data = tifffile.imread(tiff_init)
     logger.info("Found TIFF data with shape %s and type %s", data.shape, data.dtype)
-
-    if orig_h5_path.exists():
-        logging.warning("Removing existing hdf5 image file: %s", orig_h5_path)
-        orig_h5_path.unlink()
-    logger.info("Writing image data to hdf5: %s" % orig_h5_path)
-
-    with h5py.File(orig_h5_path, "w") as h5file:
-        h5file.create_dataset("data", data=data)
-    logger.info("Done writing image data hdf5")
-
-    logger.info("Done")
+    if piezo is not None:
+        data = drop_flyback(data, *piezo)
+        logger.info("Regrouped data into piezo volumes of shape %s", data.shape)
+
+    logger.info("Writing image data to: %s" % orig_path)
+
+    with storage.open_store(orig_path, "w") as store:
+        store.create("data", data=data, chunks=(1, 1) + data.shape[2:])
+        set_piezo_attrs(store, piezo)
+        summary = stats.SummaryStats()
+        for t_start, t_stop in utils.blocks(data.shape[0], READ_BLOCK_TIMEPOINTS):
+            summary.update(data[t_start:t_stop])
+        summary.write(store)
+    logger.info("Done writing image data")
+
+
+def drop_flyback(data, period_frames, skip_frames):
+    """View of a stack of frames as (t, z, y, x) piezo volumes, without the flyback frames.
+
+    The frames are reshaped and sliced, so no data is copied.
+    """
+    frames = data.reshape((-1,) + data.shape[-2:])
+    num_t = frames.shape[0] // period_frames
+    volumes = frames[: num_t * period_frames].reshape((num_t, period_frames) + frames.shape[1:])
+    return volumes[:, skip_frames:]
+
+
+def set_piezo_attrs(store, piezo):
+    """Record the piezo settings used to regroup frames, so later stages map frames consistently."""
+    if piezo is not None:
+        store.attrs["piezo_period_frames"] = int(piezo[0])
+        store.attrs["piezo_skip_frames"] = int(piezo[1])
@@ -0,0 +1,289 @@
+"""Command to convert and preprocess TIFF files while the ripper is still writing them."""
+
+import concurrent.futures
+import logging
+import time
+
+import click
+import numpy as np
+import tifffile
+
+from two_photon import concat, convert, interpolate, preprocess, stats, storage, suite2p_binary, tiff_index, utils
+
+logger = logging.getLogger(__name__)
+
+FOLLOW_POLL_SECS = 5  # Time to wait between polling the filesystem for new tiff files.
+FOLLOW_IDLE_SECS = 600  # Give up if no tiff file completes for this long.
+FOLLOW_LOOKAHEAD_FILES = 64  # Stop checking pending files after this many consecutive missing ones.
+
+
+class FollowError(Exception):
+    """Error while following the ripper output."""
+
+
+class TiffWatcher:
+    """Detects tiff files of an acquisition that the ripper has finished writing.
+
+    A file is considered complete once it exists and its size is unchanged between two polls.
+    The ripper writes files roughly in order, so pending files are checked in index order and
+    checking stops after a run of missing files.
+
+    Parameters
+    ----------
+    index: tiff_index.TiffIndex
+        Index of the files expected for the acquisition.
+    tiff_dirs: list of pathlib.Path
+        Directories where the files may appear, in order of preference.
+    """
+
+    def __init__(self, index, tiff_dirs, lookahead=FOLLOW_LOOKAHEAD_FILES):
+        self.index = index
+        self.tiff_dirs = tiff_dirs
+        self.lookahead = lookahead
+        self.pending = list(range(len(index.files)))
+        self.sizes = {}
+
+        # (t, z) frames stored in each file, grouped by file id.
+        order = np.argsort(index.file_index, axis=None, kind="stable")
+        bounds = np.searchsorted(index.file_index.ravel()[order], np.arange(len(index.files) + 1))
+        t_all, z_all = np.unravel_index(order, index.shape)
+        self.frames = [
+            list(zip(t_all[lo:hi], z_all[lo:hi], index.page.ravel()[order[lo:hi]]))
+            for lo, hi in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def locate(self, fid):
+        for tiff_dir in self.tiff_dirs:
+            path = tiff_dir / self.index.files[fid]
+            if path.exists():
+                return path
+        return None
+
+    def poll(self):
+        """Return the ids of files which completed since the last poll."""
+        completed = []
+        missing = 0
+        for fid in self.pending:
+            path = self.locate(fid)
+            if path is None:
+                missing += 1
+                if missing >= self.lookahead:
+                    break
+                continue
+            missing = 0
+            try:
+                size = path.stat().st_size
+            except OSError:  # Moved by raw2tiff between locating and checking.
+                continue
+            if size > 0 and self.sizes.get(fid) == size:
+                completed.append(fid)
+            self.sizes[fid] = size
+        done = set(completed)
+        self.pending = [fid for fid in self.pending if fid not in done]
+        return completed
+
+
+@click.command()
+@click.pass_obj
+@click.option("--channel", type=int, required=True, help="Channel number of tiff stack to convert to hdf5")
+@preprocess.artefact_options
+@click.option(
+    "--poll-secs", type=float, default=FOLLOW_POLL_SECS, show_default=True, help="Time between polls for new tiffs."
+)
+@click.option(
+    "--idle-secs",
+    type=float,
+    default=FOLLOW_IDLE_SECS,
+    show_default=True,
+    help="Give up if no new tiff file completes within this time.",
+)
+@storage.storage_option
+@click.option(
+    "--suite2p-binary/--no-suite2p-binary",
+    "write_binary",
+    default=False,
+    show_default=True,
+    help="Also write Suite2p per-plane binaries, for analyze --input-format binary.",
+)
+def follow(
+    layout,
+    channel,
+    frame_channel_name,
+    stim_channel_name,
+    shift_px,
+    buffer_px,
+    settle_ms,
+    fill_kernel,
+    piezo_period_frames,
+    piezo_skip_frames,
+    poll_secs,
+    idle_secs,
+    backend,
+    write_binary,
+):
+    """Convert and preprocess the TIFF stack as the ripper writes it (run alongside raw2tiff)."""
+    if frame_channel_name is None or stim_channel_name is None:
+        raise FollowError("follow locates artefacts from the voltage recordings, so needs frame and stim channel names")
+    raw_path = layout.path("raw")
+    tiff_path = layout.path("tiff")
+    convert_path = layout.path("convert")
+    convert_path.mkdir(parents=True, exist_ok=True)
+    orig_path = storage.with_backend(layout.orig_h5_path(), backend)
+    preprocess_path = storage.with_backend(layout.preprocess_h5_path(), backend)
+    artefacts_path = layout.artefacts_path()
+    preprocess_path.parent.mkdir(parents=True, exist_ok=True)
+    artefacts_path.parent.mkdir(parents=True, exist_ok=True)
+
+    df_voltage = convert.convert_voltage(layout.raw_voltage_path(), layout.voltage_h5_path())
+
+    index = tiff_index.TiffIndex.from_xml(layout.raw_xml_path(), channel)
+    # Nothing is converted yet, so there are no stored settings to check against.
+    piezo_period_frames, piezo_skip_frames = preprocess.resolve_piezo({}, piezo_period_frames, piezo_skip_frames)
+    piezo = None if piezo_period_frames is None else (piezo_period_frames, piezo_skip_frames)
+    if piezo is not None:
+        index = index.with_piezo(*piezo)
+    index.save(convert_path / "tiff_index.npz")
+
+    # The ripper writes into a sub-directory named after the raw directory, which raw2tiff then
+    # moves up one level once ripping is complete.
+    watcher = TiffWatcher(index, [tiff_path / raw_path.name, tiff_path])
+
+    def artefacts(shape):
+        df_artefacts = preprocess.artefacts_from_voltage(
+            df_voltage,
+            shape,
+            utils.frame_period(layout),
+            frame_channel_name,
+            stim_channel_name,
+            shift_px,
+            buffer_px,
+            settle_ms,
+            piezo_period_frames,
+            piezo_skip_frames,
+            artefacts_path,
+        )
+        return df_artefacts
+
+    storage.remove(orig_path)
+    storage.remove(preprocess_path)
+
+    with storage.open_store(orig_path, "w") as orig_store:
+        convert.set_piezo_attrs(orig_store, piezo)
+        with storage.open_store(preprocess_path, "w") as preprocess_store:
+            binary_path = layout.suite2p_binary_path() if write_binary else None
+            run_follow(
+                watcher,
+                orig_store,
+                preprocess_store,
+                artefacts,
+                poll_secs,
+                idle_secs,
+                binary_path=binary_path,
+                fill_kernel=fill_kernel,
+            )
+            shape = preprocess_store["data"].shape
+    concat.write_info(layout.preprocess_info_path(), shape, np.uint16, utils.frame_period(layout))
+
+    logger.info("Done")
+
+
+def run_follow(
+    watcher,
+    orig_store,
+    preprocess_store,
+    artefacts_fn,
+    poll_secs=FOLLOW_POLL_SECS,
+    idle_secs=FOLLOW_IDLE_SECS,
+    block_timepoints=preprocess.BLOCK_TIMEPOINTS,
+    binary_path=None,
+    fill_kernel=interpolate.DEFAULT_FILL_KERNEL,
+):
+    """Poll for completed tiff files, writing them to orig_store and preprocessed blocks to preprocess_store.
+
+    `artefacts_fn` is called with the data shape once the first file is read, and returns the
+    artefact table.  Blocks are preprocessed once they and their halo have been converted.  If
+    `binary_path` is given, preprocessed blocks are also written there as Suite2p binaries.
+    Artefacts are removed with the named `fill_kernel`.
+    """
+    index = watcher.index
+    num_t = index.shape[0]
+    converted = np.zeros(index.shape, dtype=bool)
+    num_ready = 0  # Leading time points with all z-planes converted.
+    num_preprocessed = 0
+    orig_stats = stats.SummaryStats()
+    preprocess_stats = stats.SummaryStats()
+    orig_data = preprocess_data = artefacts = halo = writer = None
+
+    last_progress = time.time()
+    with concurrent.futures.ThreadPoolExecutor(convert.READ_WORKERS) as executor:
+        while num_preprocessed < num_t:
+            completed = watcher.poll()
+            frames = executor.map(lambda fid: read_file_frames(watcher, fid), completed)
+            for fid, file_frames in zip(completed, frames):
+                if file_frames is None:  # Not readable yet, try again on the next poll.
+                    watcher.pending.append(fid)
+                    continue
+                for t, z, frame in file_frames:
+                    if orig_data is None:
+                        shape = index.shape + frame.shape
+                        chunks = (1, 1) + frame.shape
+                        orig_data = orig_store.create("data", shape=shape, dtype=frame.dtype, chunks=chunks)
+                        preprocess_data = preprocess_store.create("data", shape=shape, dtype=np.uint16, chunks=chunks)
+                        artefacts = preprocess.artefact_index_from_df(artefacts_fn(shape), num_t)
+                        halo = preprocess.artefact_halo(artefacts, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+                        if binary_path is not None:
+                            writer = suite2p_binary.BinaryWriter(binary_path, shape)
+                            writer.create()
+                    orig_data[t, z] = frame
+                    converted[t, z] = True
+            watcher.pending.sort()
+
+            ready = converted.all(axis=1)
+            new_ready = num_ready + int(np.argmin(ready[num_ready:])) if not ready.all() else num_t
+            if new_ready > num_ready:
+                orig_stats.update(orig_data[num_ready:new_ready])
+                logger.info("Converted time points %d-%d of %d", num_ready, new_ready, num_t)
+                num_ready = new_ready
+                last_progress = time.time()
+
+            # Preprocess blocks once the following halo has also been converted.
+            while num_preprocessed < num_ready and (
+                num_preprocessed + block_timepoints + halo <= num_ready or num_ready == num_t
+            ):
+                t_stop = min(num_preprocessed + block_timepoints, num_ready)
+                block = preprocess.remove_artefacts_block(
+                    orig_data, artefacts, num_preprocessed, t_stop, num_t, halo, fill_kernel
+                )
+                preprocess_data[num_preprocessed:t_stop] = block
+                if writer is not None:
+                    writer.write(num_preprocessed, block)
+                preprocess_stats.update(block)
+                logger.info("Preprocessed time points %d-%d of %d", num_preprocessed, t_stop, num_t)
+                num_preprocessed = t_stop
+
+            if num_preprocessed >= num_t:
+                break
+            if time.time() - last_progress > idle_secs:
+                raise FollowError(
+                    "No tiff files completed within %s seconds (%d of %d time points converted)"
+                    % (idle_secs, num_ready, num_t)
+                )
+            time.sleep(poll_secs)
+
+    orig_stats.write(orig_store)
+    preprocess_stats.write(preprocess_store)
+    if writer is not None:
+        writer.write_ops(preprocess_stats.mean)
+
+
+def read_file_frames(watcher, fid):
+    """Read the frames stored in one tiff file as (t, z, frame) tuples, or None if not readable."""
+    path = watcher.locate(fid)
+    if path is None:
+        return None
+    try:
+        with tifffile.TiffFile(str(path)) as tif:
+            return [(t, z, tif.pages[int(page)].asarray()) for t, z, page in watcher.frames[fid]]
+    except Exception as exc:  # tifffile raises a variety of errors for partially written files.
+        logger.info("Could not read %s yet: %s", path, exc)
+        return None
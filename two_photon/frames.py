@@ -0,0 +1,252 @@
+"""Random access to frames of converted and preprocessed data, for notebooks and QA."""
+
+import collections
+import http.server
+import io
+import logging
+import re
+import threading
+
+import click
+import numpy as np
+
+from two_photon import stats, storage, utils
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ["orig", "preprocess"]
+PROJECTIONS = ["mean", "max"]
+DEFAULT_CACHE_BYTES = 1 << 30  # 1 GB of decoded chunks.
+PROJECTION_BLOCK_TIMEPOINTS = 64  # Time points read at once when computing projections.
+
+
+class FrameServerError(Exception):
+    """Error while serving frames."""
+
+
+class FrameServer:
+    """Serves individual frames, frame ranges and per-plane projections from the hdf5 or zarr outputs.
+
+    Decoded chunks are kept in an LRU cache bounded by `cache_bytes`, and projections are
+    computed once per (source, plane) and then cached.  Files are opened lazily and kept open
+    until `close` is called.
+
+    Parameters
+    ----------
+    layout: Layout object
+        Object used to determine path naming
+    cache_bytes: int
+        Maximum size of decoded chunks held in memory.
+    """
+
+    def __init__(self, layout, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.layout = layout
+        self.cache_bytes = cache_bytes
+        self._stores = {}
+        self._chunks = collections.OrderedDict()
+        self._chunks_nbytes = 0
+        self._projections = {}
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores = {}
+            self._chunks.clear()
+            self._chunks_nbytes = 0
+
+    def path(self, source):
+        if source == "orig":
+            return storage.find(self.layout.orig_h5_path())
+        if source == "preprocess":
+            return storage.find(self.layout.preprocess_h5_path())
+        raise FrameServerError("Unknown source %s, expected one of: %s" % (source, ", ".join(SOURCES)))
+
+    def store(self, source):
+        with self._lock:
+            if source not in self._stores:
+                self._stores[source] = storage.open_store(self.path(source), "r")
+            return self._stores[source]
+
+    def dataset(self, source):
+        return self.store(source)["data"]
+
+    def shape(self, source):
+        """Shape (t, z, y, x) of the data."""
+        return self.dataset(source).shape
+
+    def _chunk_shape(self, source):
+        # Cache in units of the stored chunks along t and z.  Contiguous (unchunked) datasets are
+        # cached one frame at a time.
+        dset = self.dataset(source)
+        if dset.chunks is None:
+            return 1, 1
+        return dset.chunks[0], dset.chunks[1]
+
+    def _chunk(self, source, t_chunk, z_chunk):
+        key = (source, t_chunk, z_chunk)
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                return self._chunks[key]
+
+            t_size, z_size = self._chunk_shape(source)
+            chunk = self.dataset(source)[
+                t_chunk * t_size : (t_chunk + 1) * t_size, z_chunk * z_size : (z_chunk + 1) * z_size
+            ]
+            self._chunks[key] = chunk
+            self._chunks_nbytes += chunk.nbytes
+            while self._chunks_nbytes > self.cache_bytes and len(self._chunks) > 1:
+                _, evicted = self._chunks.popitem(last=False)
+                self._chunks_nbytes -= evicted.nbytes
+            return chunk
+
+    def frame(self, source, t, z):
+        """A single (y, x) frame."""
+        num_t, num_z = self.shape(source)[:2]
+        if not (0 <= t < num_t and 0 <= z < num_z):
+            raise FrameServerError("Frame (t=%d, z=%d) out of range for shape %s" % (t, z, self.shape(source)))
+        t_size, z_size = self._chunk_shape(source)
+        return self._chunk(source, t // t_size, z // z_size)[t % t_size, z % z_size]
+
+    def frames(self, source, t_start, t_stop, z):
+        """Frames [t_start, t_stop) of one z plane, as a (t, y, x) array, empty if t_stop <= t_start.
+
+        As with slicing, t_stop may run past the last frame.
+        """
+        shape = self.shape(source)
+        if not (0 <= t_start <= shape[0] and 0 <= z < shape[1]):
+            raise FrameServerError("Frames (t=%d:%d, z=%d) out of range for shape %s" % (t_start, t_stop, z, shape))
+        t_stop = min(t_stop, shape[0])
+        if t_stop <= t_start:
+            return np.empty((0,) + tuple(shape[2:]), dtype=self.dataset(source).dtype)
+        return np.stack([self.frame(source, t, z) for t in range(t_start, t_stop)])
+
+    def projection(self, source, z, kind="mean"):
+        """Mean or max projection over time of one z plane."""
+        if kind not in PROJECTIONS:
+            raise FrameServerError("Unknown projection %s, expected one of: %s" % (kind, ", ".join(PROJECTIONS)))
+        key = (source, z, kind)
+        with self._lock:
+            if key not in self._projections:
+                self._projections[key] = self._compute_projection(source, z, kind)
+            return self._projections[key]
+
+    def _compute_projection(self, source, z, kind):
+        # Use the statistics stored by convert/preprocess when present.  Otherwise, stream over the
+        # whole plane, bypassing the chunk cache rather than evicting it.
+        dset = self.dataset(source)
+        precomputed = stats.read(self.store(source), kind)
+        if precomputed is not None:
+            return precomputed[z]
+
+        num_t = dset.shape[0]
+        logger.info("Computing %s projection of %s plane %d", kind, source, z)
+        result = None
+        for t_start, t_stop in utils.blocks(num_t, PROJECTION_BLOCK_TIMEPOINTS):
+            block = dset[t_start:t_stop, z]
+            if kind == "mean":
+                partial = block.sum(axis=0, dtype=np.float64)
+                result = partial if result is None else result + partial
+            else:
+                partial = block.max(axis=0)
+                result = partial if result is None else np.maximum(result, partial)
+        if kind == "mean":
+            result = (result / num_t).astype(np.float32)
+        return result
+
+    def view(self, source):
+        """Array-like view supporting `view[t, z]` indexing, e.g. for `qa.side_by_side_comparison`."""
+        return _FrameView(self, source)
+
+
+class _FrameView:
+    def __init__(self, server, source):
+        self.server = server
+        self.source = source
+
+    @property
+    def shape(self):
+        return self.server.shape(self.source)
+
+    def __getitem__(self, key):
+        t, z = key
+        return self.server.frame(self.source, t, z)
+
+
+def _npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def make_handler(server):
+    """Build an HTTP request handler serving arrays in .npy format from a FrameServer.
+
+    Routes:
+        /shape/<source>
+        /frame/<source>/<t>/<z>
+        /frames/<source>/<t_start>/<t_stop>/<z>
+        /projection/<source>/<kind>/<z>
+    """
+    routes = [
+        (re.compile(r"^/shape/(\w+)$"), lambda m: server.shape(m[1])),
+        (re.compile(r"^/frame/(\w+)/(\d+)/(\d+)$"), lambda m: server.frame(m[1], int(m[2]), int(m[3]))),
+        (
+            re.compile(r"^/frames/(\w+)/(\d+)/(\d+)/(\d+)$"),
+            lambda m: server.frames(m[1], int(m[2]), int(m[3]), int(m[4])),
+        ),
+        (re.compile(r"^/projection/(\w+)/(\w+)/(\d+)$"), lambda m: server.projection(m[1], int(m[3]), m[2])),
+    ]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            for pattern, getter in routes:
+                match = pattern.match(self.path)
+                if match:
+                    break
+            else:
+                self.send_error(404, "Unknown route: %s" % self.path)
+                return
+            try:
+                body = _npy_bytes(getter(match))
+            except (FrameServerError, storage.StorageError, OSError) as exc:
+                self.send_error(400, str(exc))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.info("%s - %s", self.address_string(), format % args)
+
+    return Handler
+
+
+@click.command()
+@click.pass_obj
+@click.option("--host", default="127.0.0.1", show_default=True, help="Interface to serve on.")
+@click.option("--port", type=int, default=8642, show_default=True, help="Port to serve on.")
+@click.option(
+    "--cache-mb", type=int, default=DEFAULT_CACHE_BYTES >> 20, show_default=True, help="Size of decoded chunk cache."
+)
+def serve(layout, host, port, cache_mb):
+    """Serve frames and projections of converted/preprocessed data over local HTTP (as .npy)."""
+    with FrameServer(layout, cache_bytes=cache_mb << 20) as server:
+        httpd = http.server.ThreadingHTTPServer((host, port), make_handler(server))
+        logger.info("Serving frames of %s on http://%s:%d", layout.acquisition, host, port)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Stopping frame server")
+        finally:
+            httpd.server_close()
@@ -1,7 +1,26 @@
-"""Utilities for interpolating stim artefact regions."""
+"""Utilities for interpolating stim artefact regions.
+
+Artefact rows are filled by a fill kernel, chosen by name from FILL_KERNELS.  Each kernel
+interpolates a slab of rows along its axis: time ("t"), from the same row in neighbouring
+frames, or y ("y"), from the unaffected rows above and below in the same frame.  A slab
+has shape (n, m, x), where n runs along the kernel's axis and m over the rows filled
+together, with a boolean (n, m) mask of the rows to fill.
+"""
+import collections
+
 import numpy as np
 import scipy.interpolate
 
+CUBIC_NEIGHBOURS = 2  # Unaffected time points used on each side of an artefact run by the cubic kernel.
+DEFAULT_FILL_KERNEL = "linear"
+
+
+class FillKernel(collections.namedtuple("FillKernel", ["fill", "axis", "neighbours"])):
+    """A fill kernel: `fill(slab, mask)` returns a filled float32 copy of the slab.
+
+    `neighbours` is the number of time points needed on each side of an artefact run.
+    """
+
 
 def interpolate_nan(data, axis=0, kind="linear"):
     """Interpolation of nan pixels along a given axis.
@@ -35,3 +54,125 @@ def interp1d_nan(data, kind="linear"):
 
     data[nans] = func(x_nans)
     return data
+
+
+def _interp_gaps(slab, mask):
+    """Linearly interpolate masked rows of a slab from the nearest unmasked rows along axis 0.
+
+    Masked rows before the first (or after the last) unmasked row take the value of the nearest
+    unmasked row.
+    """
+    n = mask.shape[0]
+    pos = np.arange(n)[:, np.newaxis]
+    prev = np.maximum.accumulate(np.where(mask, -1, pos), axis=0)
+    after = np.minimum.accumulate(np.where(mask, n, pos)[::-1], axis=0)[::-1]
+    if (mask & (prev < 0) & (after >= n)).any():
+        raise ValueError("No unaffected values to fill artefacts from")
+    prev = np.where(prev < 0, after, prev)
+    after = np.where(after >= n, prev, after)
+
+    # Interpolate only the masked rows.
+    t, col = np.nonzero(mask)
+    before_values = slab[prev[t, col], col].astype(np.float32)
+    after_values = slab[after[t, col], col].astype(np.float32)
+    frac = ((t - prev[t, col]) / np.maximum(after[t, col] - prev[t, col], 1)).astype(np.float32)
+    filled = slab.astype(np.float32)
+    filled[t, col] = before_values + (after_values - before_values) * frac.reshape(frac.shape + (1,) * (slab.ndim - 2))
+    return filled
+
+
+def _runs(pattern):
+    """(start, stop) of each run of True values in a 1d boolean array."""
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], pattern, [False]]).astype(np.int8)))
+    return zip(edges[::2], edges[1::2])
+
+
+def fill_linear(slab, mask):
+    """Linear interpolation between the nearest unaffected frames."""
+    return _interp_gaps(slab, mask)
+
+
+def fill_cubic(slab, mask, neighbours=CUBIC_NEIGHBOURS):
+    """Cubic spline through the unaffected frames within `neighbours` of each side of each artefact run.
+
+    Rows with the same pattern of artefact frames share each spline fit, so fits are done once per
+    pattern rather than once per row.
+    """
+    filled = slab.astype(np.float32)
+    n = mask.shape[0]
+    pos = np.arange(n)
+    patterns, inverse = np.unique(mask.T, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    for num, pattern in enumerate(patterns):
+        cols = np.flatnonzero(inverse == num)
+        for start, stop in _runs(pattern):
+            support = pos[max(start - neighbours, 0) : min(stop + neighbours, n)]
+            support = support[~pattern[support]]
+            if not len(support):
+                raise ValueError("No unaffected values to fill artefacts from")
+            run = pos[start:stop]
+            if support.min() > start or support.max() < stop:
+                # Artefacts at the edge of the data take the value of the nearest unaffected frame.
+                nearest = support.min() if support.min() > start else support.max()
+                filled[np.ix_(run, cols)] = filled[nearest, cols]
+                continue
+            spline = scipy.interpolate.CubicSpline(support, filled[np.ix_(support, cols)], axis=0)
+            filled[np.ix_(run, cols)] = spline(run)
+    return filled
+
+
+def fill_rows(slab, mask):
+    """Linear interpolation between the nearest unaffected rows in the same frame."""
+    return _interp_gaps(slab, mask)
+
+
+FILL_KERNELS = {
+    "linear": FillKernel(fill_linear, "t", 1),
+    "cubic": FillKernel(fill_cubic, "t", CUBIC_NEIGHBOURS),
+    "rows": FillKernel(fill_rows, "y", 0),
+}
+
+
+def fill_block(block, mask, kernel=DEFAULT_FILL_KERNEL, core=None):
+    """Fill artefact rows of a (t, z, y, x) block with a fill kernel, returning a filled copy.
+
+    Only the artefact rows are interpolated, in float32, and cast back to the type of the
+    block (clipped to its range, for integer types).  Artefacts at the edges of the block, with
+    unaffected values on one side only, take the nearest unaffected value.
+
+    Parameters
+    ----------
+    block: np.ndarray, shape (t, z, y, x)
+        Image data, including any time points read around the core for temporal kernels.
+    mask: np.ndarray of bool, shape (t, z, y)
+        Artefact rows of the block.
+    kernel: str
+        Name of the fill kernel, one of FILL_KERNELS.
+    core: tuple of int, optional
+        Range [start, stop) of time points which must be filled.  Defaults to the whole block.
+        Only rows with an artefact in the core are filled.
+    """
+    fill, axis, _ = FILL_KERNELS[kernel]
+    core_start, core_stop = (0, block.shape[0]) if core is None else core
+    filled = np.array(block)
+
+    if axis == "y":
+        t, z = np.nonzero(mask[core_start:core_stop].any(axis=2))
+        t += core_start
+        if len(t):
+            # Slab of (y, frames, x), interpolated along y.
+            slab = fill(block[t, z].swapaxes(0, 1), mask[t, z].T)
+            filled[t, z] = _cast(slab.swapaxes(0, 1), block.dtype)
+        return filled
+
+    z, y = np.nonzero(mask[core_start:core_stop].any(axis=0))
+    if len(z):
+        # Slab of (t, rows, x), interpolated along t.
+        filled[:, z, y] = _cast(fill(block[:, z, y], mask[:, z, y]), block.dtype)
+    return filled
+
+
+def _cast(values, dtype):
+    if np.issubdtype(dtype, np.integer):
+        values = np.clip(values, np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return values.astype(dtype)
@@ -2,19 +2,75 @@
 
 
 class Layout:
-    def __init__(self, base_path, acquisition):
+    def __init__(self, base_path, acquisition, stage_roots=None):
         self.base_path = base_path
         self.acquisition = acquisition
         self.prefix = acquisition.split("/")[-1]
+        # Stages kept under a root other than base_path, such as node-local scratch, see staging.py.
+        self.stage_roots = stage_roots or {}
+
+    def root_of(self, stage):
+        """Root under which the stage is kept, its own or base_path."""
+        return self.stage_roots.get(stage, self.base_path)
 
     def path(self, stage, acquisition=None):
+        path = self.root_of(stage) / stage / (acquisition or self.acquisition)
+        # Other acquisitions are read from base_path, unless they were also processed in the root.
+        if acquisition not in (None, self.acquisition) and not path.exists():
+            return self.base_path_of(stage, acquisition)
+        return path
+
+    def base_path_of(self, stage, acquisition=None):
+        """Path of the stage under base_path, which is where it is written back to from its root."""
         return self.base_path / stage / (acquisition or self.acquisition)
 
     def backup_path(self, backup_path, stage):
         return backup_path / stage / self.acquisition
 
-    def raw_xml_path(self):
-        return self.path("raw") / f"{self.prefix}.xml"
+    def raw_xml_path(self, acquisition=None):
+        acquisition = acquisition or self.acquisition
+        return self.path("raw", acquisition) / f"{acquisition.split('/')[-1]}.xml"
 
     def raw_voltage_path(self):
         return self.path("raw") / f"{self.prefix}_Cycle00001_VoltageRecording_001.csv"
+
+    def orig_h5_path(self, acquisition=None):
+        return self.path("convert", acquisition) / "orig.h5"
+
+    def voltage_h5_path(self, acquisition=None):
+        return self.path("convert", acquisition) / "voltage.h5"
+
+    def preprocess_h5_path(self, acquisition=None):
+        # The preprocess.h5 is alone in a separate directory, otherwise Suite2p fails because it
+        # tries to read all the h5 files in the directory.
+        return self.path("preprocess", acquisition) / "preprocess" / "preprocess.h5"
+
+    def preprocess_info_path(self, acquisition=None):
+        # Cached shape and frame period of the preprocessed data, see concat.py.
+        return self.path("preprocess", acquisition) / "preprocess.json"
+
+    def concat_h5_path(self):
+        # Virtual dataset joining the acquisitions of analyze, alone in its directory for Suite2p.
+        return self.path("analyze") / "concat" / "concat.h5"
+
+    def preview_h5_path(self, acquisition=None):
+        return self.path("preview", acquisition) / "preview.h5"
+
+    def preprocess_shard_path(self, shard, num_shards, acquisition=None):
+        # Outside the directory of preprocess.h5, whose virtual dataset refers to them, as Suite2p
+        # reads every h5 file in that directory.
+        return self.path("preprocess", acquisition) / "shards" / f"shard-{shard}-of-{num_shards}.h5"
+
+    def suite2p_binary_path(self, acquisition=None):
+        # Per-plane Suite2p binaries (planeN/data_raw.bin and ops.npy), see suite2p_binary.py.
+        return self.path("preprocess", acquisition) / "suite2p"
+
+    def sta_h5_path(self, acquisition=None):
+        return self.path("sta", acquisition) / "sta.h5"
+
+    def artefacts_path(self, acquisition=None):
+        return self.path("preprocess", acquisition) / "artefacts" / "artefacts.h5"
+
+    def image_artefacts_path(self, acquisition=None):
+        # Artefacts detected from the images, when only cross-checked against the voltage recordings.
+        return self.path("preprocess", acquisition) / "artefacts" / "image_artefacts.h5"
@@ -0,0 +1,149 @@
+"""Preprocess output stored as a sparse overlay of patched rows on the converted data.
+
+Artefacts affect only a small fraction of rows, so instead of a full copy of the movie, an
+overlay stores just the rows changed by artefact removal, with a table of where they go.  The
+`data` dataset Suite2p reads is an hdf5 virtual dataset (VDS), mapping each patched row range
+onto the stored rows and everything else onto the converted data.  The table of patched rows
+doubles as a record of exactly what preprocessing changed.
+
+The VDS needs a few mappings per patched frame, and hdf5 opens and reads a VDS more slowly as
+its mappings grow into the tens of thousands, so data with more than MAX_VDS_MAPPINGS is
+stored as a full copy instead (see `max_vds_mappings`).
+"""
+
+import logging
+
+import h5py
+import numpy as np
+
+from two_photon import storage
+
+logger = logging.getLogger(__name__)
+
+KEY = "data"
+ROWS_KEY = "overlay/rows"  # (num_rows, x) patched rows, in the order of the runs table.
+RUNS_KEY = "overlay/runs"  # Runs of consecutive patched rows, see RUN_DTYPE.
+SOURCE_KEY = "data"  # Dataset of the converted data.
+ROWS_CHUNK = 256  # Patched rows per chunk of the rows dataset.
+MAX_VDS_MAPPINGS = 10000  # Most mappings of an overlay VDS, above which a full copy is stored.
+
+RUN_DTYPE = np.dtype([(name, np.int64) for name in ["t", "z", "row_start", "row_stop", "offset"]])
+
+
+class OverlayWriter:
+    """Collects the patched rows of preprocessed blocks, and writes the overlay into an hdf5 file.
+
+    Blocks are assigned as to an hdf5 dataset, `writer[t_start:t_stop] = block`, in time order.
+    Only the artefact rows of the block are stored.
+
+    Parameters
+    ----------
+    h5file: h5py.File
+        Open output file, which will hold the overlay and its `data` VDS.
+    source_path: pathlib.Path
+        The hdf5 file of converted data, which the overlay patches.  It may have more time points
+        than `shape`.
+    index: artefact_index.ArtefactIndex
+        Artefacts of the data, whose rows are patched.
+    shape: tuple of int
+        Shape (t, z, y, x) of the data.
+    dtype: np.dtype
+        Type of the data.
+    """
+
+    def __init__(self, h5file, source_path, index, shape, dtype):
+        self.h5file = h5file
+        self.source_path = source_path
+        self.index = index
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.rows = h5file.create_dataset(
+            ROWS_KEY, shape=(0, shape[3]), maxshape=(None, shape[3]), chunks=(ROWS_CHUNK, shape[3]), dtype=dtype
+        )
+        self.runs = []
+
+    def __setitem__(self, key, block):
+        t_start = key.start
+        t, z, y = np.nonzero(self.index.mask(t_start, t_start + len(block), self.shape[1], self.shape[2]))
+        if not len(t):
+            return
+
+        # A new run starts wherever the frame changes or the rows are not consecutive.
+        new_run = (np.diff(t, prepend=-1) != 0) | (np.diff(z, prepend=-1) != 0) | (np.diff(y, prepend=-2) != 1)
+        starts = np.flatnonzero(new_run)
+        stops = np.append(starts[1:], len(t))
+        offset = self.rows.shape[0]
+        runs = np.empty(len(starts), dtype=RUN_DTYPE)
+        runs["t"] = t[starts] + t_start
+        runs["z"] = z[starts]
+        runs["row_start"] = y[starts]
+        runs["row_stop"] = y[stops - 1] + 1
+        runs["offset"] = offset + starts
+        self.runs.append(runs)
+
+        self.rows.resize(offset + len(t), axis=0)
+        self.rows[offset:] = block[t, z, y]
+
+    def close(self):
+        """Write the table of runs and the `data` VDS presenting the patched movie."""
+        runs = np.concatenate(self.runs) if self.runs else np.empty(0, dtype=RUN_DTYPE)
+        self.h5file.create_dataset(RUNS_KEY, data=runs)
+        with h5py.File(self.source_path, "r") as source_file:
+            source_shape = source_file[SOURCE_KEY].shape
+        write_vds(self.h5file, self.source_path, source_shape, self.shape, self.dtype, runs, self.rows.shape)
+        num_rows = self.shape[0] * self.shape[1] * self.shape[2]
+        logger.info(
+            "Stored %d patched rows (%.2f%% of rows) in %d runs",
+            self.rows.shape[0],
+            100 * self.rows.shape[0] / num_rows,
+            len(runs),
+        )
+
+
+def max_vds_mappings(index, shape):
+    """Upper bound on the number of mappings of the VDS of an overlay of data of the given (t, z, y, x) shape.
+
+    Each plane has a mapping for each patched run, for the rows around them in each patched
+    frame, and for the time points between patched frames.
+    """
+    t, z, _, _ = index.lookup_range(0, shape[0])
+    num_frames = len(np.unique(t * shape[1] + z))
+    return 2 * len(t) + 2 * num_frames + shape[1]
+
+
+def write_vds(h5file, source_path, source_shape, shape, dtype, runs, rows_shape):
+    """Write the `data` VDS of an overlay, given its table of runs sorted by (t, z, row_start)."""
+    num_t, num_z, num_y, _ = shape
+    layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    source = h5py.VirtualSource(storage.vds_source_path(source_path, h5file.filename), SOURCE_KEY, shape=source_shape)
+    # The patched rows are in the same file as the VDS.
+    rows = h5py.VirtualSource(".", ROWS_KEY, shape=rows_shape)
+
+    for z in range(num_z):
+        plane_runs = runs[runs["z"] == z]
+        frame_t, frame_starts = np.unique(plane_runs["t"], return_index=True)
+        t_next = 0  # First time point not yet mapped.
+        for t, frame_runs in zip(frame_t, np.split(plane_runs, frame_starts[1:])):
+            if t > t_next:
+                layout[t_next:t, z] = source[t_next:t, z]
+            row_next = 0
+            for run in frame_runs:
+                row_start, row_stop, offset = int(run["row_start"]), int(run["row_stop"]), int(run["offset"])
+                if row_start > row_next:
+                    layout[t, z, row_next:row_start] = source[t, z, row_next:row_start]
+                layout[t, z, row_start:row_stop] = rows[offset : offset + row_stop - row_start]
+                row_next = row_stop
+            if row_next < num_y:
+                layout[t, z, row_next:] = source[t, z, row_next:]
+            t_next = t + 1
+        if t_next < num_t:
+            layout[t_next:, z] = source[t_next:num_t, z]
+
+    h5file.create_virtual_dataset(KEY, layout)
+
+
+def read_runs(h5file):
+    """The table of patched row runs of an overlay, or None if the file stores full data."""
+    if RUNS_KEY not in h5file:
+        return None
+    return h5file[RUNS_KEY][...]
@@ -0,0 +1,146 @@
+"""Placing files at a new location, without copying their data where the filesystem allows.
+
+Strategies are tried from cheapest to most expensive: a rename (for moves on one filesystem),
+a reflink (a copy-on-write clone, on filesystems such as btrfs and xfs), a hardlink, and
+finally a parallel chunked copy.  A hardlink shares the file, so is skipped for files which
+will be modified in place.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows, which has no reflinks here.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FICLONE = 0x40049409  # Linux ioctl cloning one file into another.
+COPY_WORKERS = 4  # Number of threads copying chunks of one file.
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+
+RENAME = "rename"
+REFLINK = "reflink"
+HARDLINK = "hardlink"
+COPY = "copy"
+
+
+def reflink(src, dst):
+    """Clone src into a new file dst, sharing its data until either is modified."""
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this system")
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            fout.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def parallel_copy(src, dst, workers=COPY_WORKERS, chunk_bytes=COPY_CHUNK_BYTES):
+    """Copy src to dst, with chunks copied in parallel by positional reads and writes."""
+    size = os.path.getsize(src)
+    if size <= chunk_bytes or not hasattr(os, "pread"):
+        shutil.copy2(src, dst)
+        return
+
+    src_fd = os.open(src, os.O_RDONLY)
+    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(dst_fd, size)
+
+        def copy_chunk(offset):
+            data = os.pread(src_fd, chunk_bytes, offset)
+            while data:
+                written = os.pwrite(dst_fd, data, offset)
+                offset += written
+                data = data[written:]
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(copy_chunk, range(0, size, chunk_bytes)))
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+    shutil.copystat(src, dst)
+
+
+def _place(src, dst, move, link, workers):
+    if move:
+        try:
+            os.rename(src, dst)
+            return RENAME
+        except OSError:  # Such as a move across filesystems.
+            pass
+
+    try:
+        reflink(src, dst)
+        strategy = REFLINK
+    except OSError:
+        strategy = None
+    if strategy is None and link:
+        try:
+            os.link(src, dst)
+            strategy = HARDLINK
+        except OSError:
+            pass
+    if strategy is None:
+        parallel_copy(src, dst, workers)
+        strategy = COPY
+
+    if move:
+        os.unlink(src)
+    return strategy
+
+
+def place(src, dst, move=False, link=True, workers=COPY_WORKERS):
+    """Place file src at dst, returning the strategy used.
+
+    Parameters
+    ----------
+    src: pathlib.Path
+        File to place.
+    dst: pathlib.Path
+        New path of the file, which must not exist.
+    move: bool
+        Whether to remove src, trying a rename first.
+    link: bool
+        Whether src and dst may be hardlinks of one file, which is not the case if either will be
+        modified in place.
+    workers: int
+        Number of threads for a copy.
+    """
+    strategy = _place(src, dst, move, link, workers)
+    logger.info("Placed %s at %s by %s", src, dst, strategy)
+    return strategy
+
+
+def place_tree(src, dst, move=False, link=True, workers=COPY_WORKERS):
+    """Place the directory src at dst as with `place`, returning the number of files placed by each strategy.
+
+    dst may already exist, as long as none of the files placed do.  With move, src is removed.
+    """
+    if move and not dst.exists():
+        try:
+            os.rename(src, dst)
+            logger.info("Placed %s at %s by %s", src, dst, RENAME)
+            return collections.Counter({RENAME: 1})
+        except OSError:
+            pass
+
+    strategies = collections.Counter()
+    for dirpath, _, filenames in os.walk(src):
+        dst_dir = dst / os.path.relpath(dirpath, src)
+        dst_dir.mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            strategies[_place(os.path.join(dirpath, filename), dst_dir / filename, move, link, workers)] += 1
+    if move:
+        for dirpath, _, _ in sorted(os.walk(src), reverse=True):  # Deepest directories first.
+            os.rmdir(dirpath)
+    logger.info("Placed %s at %s, number of files by strategy: %s", src, dst, dict(strategies))
+    return strategies
@@ -1,40 +1,126 @@
+import collections
+import concurrent.futures
 import logging
+import os
 
 import click
 import h5py
 import numpy as np
 import pandas as pd
 
-from two_photon import artefact_detect, interpolate, utils
+from two_photon import (
+    artefact_detect,
+    artefact_image,
+    artefact_index,
+    concat,
+    convert,
+    interpolate,
+    overlay,
+    slurm,
+    stats,
+    storage,
+    suite2p_binary,
+    utils,
+)
 
 logger = logging.getLogger(__name__)
 
+BLOCK_TIMEPOINTS = 32  # Time points preprocessed (and written) at once.
+MAX_HALO_TIMEPOINTS = 256  # Most time points read on either side of a block to interpolate its artefacts.
+
+
+class PreprocessError(Exception):
+    """Error while preprocessing the converted data."""
+
+
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    shard, sep, num_shards = value.partition("/")
+    if not sep or not shard.isdigit() or not num_shards.isdigit() or not 0 <= int(shard) < int(num_shards):
+        raise click.BadParameter(f"'{value}' is not of the form I/N, with 0 <= I < N")
+    return int(shard), int(num_shards)
+
+
+def artefact_options(func):
+    """Click options shared by commands that locate stim artefacts from the voltage recordings, and remove them."""
+    options = [
+        click.option("--frame-channel-name", help="Name of the frame start signal"),
+        click.option("--stim-channel-name", help="Name of the stim signal"),
+        click.option(
+            "--shift-px",
+            type=float,
+            default=0,
+            help="Number of pixel rows to offset stim windows, to adjust for unknown jitter in timing.",
+        ),
+        click.option(
+            "--buffer-px",
+            type=float,
+            default=0,
+            help="Number for pixel rows to lengthen stim windows, to adjust for unknown jitter in timing.",
+        ),
+        click.option(
+            "--settle-ms",
+            type=float,
+            default=0,
+            help="Time (milleseconds) during a frame time period during which acquisition does not happen.",
+        ),
+        click.option(
+            "--fill-kernel",
+            type=click.Choice(list(interpolate.FILL_KERNELS)),
+            default=interpolate.DEFAULT_FILL_KERNEL,
+            show_default=True,
+            help="How artefact rows are filled: linear or cubic in time, or from the neighbouring rows of the frame.",
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return convert.piezo_options(func)
+
 
 @click.command()
 @click.pass_obj
-@click.option("--frame-channel-name", required=True, help="Name of the frame start signal")
-@click.option("--stim-channel-name", required=True, help="Name of the stim signal")
+@artefact_options
+@artefact_image.image_options
+@click.option("--max-frames", type=int, help="Read in only max-frames image frames of original data.")
+@storage.storage_option
 @click.option(
-    "--shift-px",
-    type=float,
-    default=0,
-    help="Number of pixel rows to offset stim windows, to adjust for unknown jitter in timing.",
+    "--workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes preprocessing blocks of time points.  With zarr storage, each writes its own blocks.",
 )
 @click.option(
-    "--buffer-px",
-    type=float,
-    default=0,
-    help="Number for pixel rows to lengthen stim windows, to adjust for unknown jitter in timing.",
+    "--suite2p-binary/--no-suite2p-binary",
+    "write_binary",
+    default=False,
+    show_default=True,
+    help="Also write Suite2p per-plane binaries, for analyze --input-format binary.",
 )
 @click.option(
-    "--settle-ms",
-    type=float,
-    default=0,
-    help="Time (milleseconds) during a frame time period during which acquisition does not happen.",
+    "--overlay/--no-overlay",
+    "write_overlay",
+    default=False,
+    show_default=True,
+    help="Store only the patched rows, with the data presented as a virtual dataset over orig.h5 (hdf5 only).",
+)
+@click.option(
+    "--shards",
+    type=int,
+    help="Preprocess in this many shards of time points, in --workers processes, joined by a virtual dataset.",
+)
+@click.option(
+    "--shard",
+    callback=parse_shard,
+    help="Preprocess only shard I of N, given as I/N, as one task of a --sbatch array job.",
+)
+@click.option("--merge-shards", is_flag=True, help="Join the shards of runs with --shard, for all --shards.")
+@click.option(
+    "--sbatch",
+    is_flag=True,
+    help="Locate artefacts, then write a SLURM array script with one task per shard, and exit.",
 )
-@click.option("--piezo-period-frames", type=int, help="The period of piezo oscillation, in number of frames.")
-@click.option("--piezo-skip-frames", type=int, help="The number of frames skipped in each piezo period.")
-@click.option("--max-frames", type=int, help="Read in only max-frames image frames of original data.")
 def preprocess(
     layout,
     frame_channel_name,
@@ -42,43 +128,397 @@ def preprocess(
     shift_px,
     buffer_px,
     settle_ms,
+    fill_kernel,
     piezo_period_frames,
     piezo_skip_frames,
+    artefact_source,
+    check_image_artefacts,
+    image_threshold,
+    image_window,
+    image_min_rows,
+    image_polarity,
     max_frames,
+    backend,
+    workers,
+    write_binary,
+    write_overlay,
+    shards,
+    shard,
+    merge_shards,
+    sbatch,
 ):
     """Removes artefacts from raw data."""
+    if shard is not None:
+        preprocess_shard(layout, *shard, fill_kernel, write_binary)
+        return
+    if merge_shards:
+        if shards is None:
+            raise PreprocessError("The number of shards to merge must be given with --shards")
+        merge_shard_outputs(layout, shards, write_binary)
+        return
+    if sbatch and shards is None:
+        raise PreprocessError("The number of shards of the array job must be given with --shards")
+
     # Input files
-    convert_path = layout.path("convert")
-    orig_h5_path = convert_path / "orig.h5"
-    voltage_h5_path = convert_path / "voltage.h5"
+    orig_path = storage.find(layout.orig_h5_path())
+    voltage_h5_path = layout.voltage_h5_path()
 
     # Output files.  The preprocess.h5 has to be alone in a separate directory, otherwise
     # when Suite2p runs it fail because it tries to read all al the h5 files in the directory,
     # which would included artefacts.h5.
-    preprocess_path = layout.path("preprocess")
-    preprocess_h5_path = preprocess_path / "preprocess" / "preprocess.h5"
-    artefacts_path = preprocess_path / "artefacts" / "artefacts.h5"
+    preprocess_h5_path = layout.preprocess_h5_path()
+    artefacts_path = layout.artefacts_path()
 
     preprocess_h5_path.parent.mkdir(parents=True, exist_ok=True)
     artefacts_path.parent.mkdir(parents=True, exist_ok=True)
 
-    if stim_channel_name is None:
+    if artefact_source == "voltage" and stim_channel_name is None:
         logger.info("No stim channel given for artefact removal - passing through uncorrected data.")
-        preprocess_h5_path.symlink_to(orig_h5_path)
+        storage.remove(preprocess_h5_path)
+        storage.with_backend(preprocess_h5_path, storage.backend_of(orig_path)).symlink_to(orig_path)
+        with storage.open_store(orig_path, "r") as store:
+            data = store["data"]
+            concat.write_info(layout.preprocess_info_path(), data.shape, data.dtype, utils.frame_period(layout))
+        if write_binary:
+            write_suite2p_binary(orig_path, layout.suite2p_binary_path(), max_frames)
         return
 
-    logger.info("Reading data from %s", orig_h5_path)
-    with h5py.File(orig_h5_path, "r") as h5file:
+    if artefact_source == "voltage":
+        if frame_channel_name is None:
+            raise PreprocessError("A frame channel name is needed to locate artefacts from the voltage recordings")
+        logger.info("Reading voltage data from %s", voltage_h5_path)
+        df_voltage = pd.read_hdf(voltage_h5_path)
+
+    logger.info("Reading data from %s", orig_path)
+    with storage.open_store(orig_path, "r") as store:
+        data = store["data"]
+        shape = data.shape
+        piezo_period_frames, piezo_skip_frames = resolve_piezo(store.attrs, piezo_period_frames, piezo_skip_frames)
         if max_frames is not None:
-            data = h5file["data"][:max_frames]
+            shape = (min(max_frames, shape[0]),) + shape[1:]
+
+        image_params = {
+            "buffer_px": buffer_px,
+            "window": image_window,
+            "threshold": image_threshold,
+            "min_rows": image_min_rows,
+            "polarity": image_polarity,
+            "piezo_period_frames": piezo_period_frames,
+            "piezo_skip_frames": piezo_skip_frames,
+        }
+        if artefact_source == "image":
+            df_artefacts = artefacts_from_image(
+                data, shape, utils.frame_period(layout), artefacts_path=artefacts_path, **image_params
+            )
         else:
-            data = h5file["data"][()]
+            df_artefacts = artefacts_from_voltage(
+                df_voltage,
+                shape,
+                utils.frame_period(layout),
+                frame_channel_name,
+                stim_channel_name,
+                shift_px,
+                buffer_px,
+                settle_ms,
+                piezo_period_frames,
+                piezo_skip_frames,
+                artefacts_path,
+            )
+            if check_image_artefacts:
+                artefacts_from_image(
+                    data,
+                    shape,
+                    utils.frame_period(layout),
+                    artefacts_path=layout.image_artefacts_path(),
+                    df_expected=df_artefacts,
+                    **image_params,
+                )
+
+        if shards is not None:
+            if backend != "hdf5" or write_overlay:
+                raise PreprocessError(
+                    "Shards are joined by an hdf5 virtual dataset, so need hdf5 storage and no overlay"
+                )
+            if write_binary:
+                suite2p_binary.BinaryWriter(layout.suite2p_binary_path(), shape).create()
+            if sbatch:
+                write_shards_script(layout, shards, fill_kernel, write_binary)
+            else:
+                run_shards(layout, shards, workers, fill_kernel, write_binary)
+            return
+
+        preprocess_path = storage.with_backend(preprocess_h5_path, backend)
+        if write_overlay and layout.root_of("convert") != layout.root_of("preprocess"):
+            # The overlay refers to orig.h5 by a relative path, which would break once either is written back.
+            raise PreprocessError("Overlay output needs the convert and preprocess stages under the same root")
+        if write_overlay and (backend != "hdf5" or storage.backend_of(orig_path) != "hdf5" or data.dtype != np.uint16):
+            raise PreprocessError("Overlay output needs uint16 data, with hdf5 storage for both orig and preprocess")
+        storage.remove(preprocess_h5_path)
+        logger.info("Writing preprocessed image data to: %s" % preprocess_path)
+
+        writer = None
+        if write_binary:
+            writer = suite2p_binary.BinaryWriter(layout.suite2p_binary_path(), shape)
+            writer.create()
+            logger.info("Writing Suite2p binaries to: %s" % writer.path)
+
+        index = artefact_index_from_df(df_artefacts, shape[0])
+        if write_overlay and overlay.max_vds_mappings(index, shape) > overlay.MAX_VDS_MAPPINGS:
+            logger.warning(
+                "An overlay of %d artefacts may need over %d virtual dataset mappings, so storing a full copy",
+                len(index),
+                overlay.MAX_VDS_MAPPINGS,
+            )
+            write_overlay = False
+        with storage.open_store(preprocess_path, "w") as store_out:
+            if write_overlay:
+                data_out = overlay.OverlayWriter(store_out.root, orig_path, index, shape, np.uint16)
+            else:
+                data_out = store_out.create("data", shape=shape, dtype=np.uint16, chunks=(1, 1) + shape[2:])
+            if workers > 1:
+                summary = remove_artefacts_parallel(
+                    orig_path, data_out, preprocess_path, index, shape, workers, writer, fill_kernel
+                )
+            else:
+                summary = stats.SummaryStats()
+                halo = artefact_halo(index, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+                for t_start, t_stop in utils.blocks(shape[0], BLOCK_TIMEPOINTS):
+                    block = remove_artefacts_block(data, index, t_start, t_stop, shape[0], halo, fill_kernel)
+                    data_out[t_start:t_stop] = block
+                    if writer is not None:
+                        writer.write(t_start, block)
+                    summary.update(block)
+                    logger.info("Preprocessed time points %d-%d of %d", t_start, t_stop, shape[0])
+            if write_overlay:
+                data_out.close()
+            summary.write(store_out)
+        if writer is not None:
+            writer.write_ops(summary.mean)
+    concat.write_info(layout.preprocess_info_path(), shape, np.uint16, utils.frame_period(layout))
+
+    logger.info("Done")
+
+
+def shard_range(shard, num_shards, num_timepoints):
+    """Time points [t_start, t_stop) of one of num_shards equal runs of time points."""
+    return shard * num_timepoints // num_shards, (shard + 1) * num_timepoints // num_shards
 
-    logger.info("Reading voltage data from %s", voltage_h5_path)
-    df_voltage = pd.read_hdf(voltage_h5_path)
 
-    period_sec = utils.frame_period(layout)
-    y_px = data.shape[2]  # dims are t, z, y, x
+def preprocess_shard(layout, shard, num_shards, fill_kernel=interpolate.DEFAULT_FILL_KERNEL, write_binary=False):
+    """Preprocess one shard of time points into its own hdf5 file, with the artefacts already located.
+
+    Artefacts are read from the artefact file, so every shard uses the table located once for
+    the whole acquisition.  As in `remove_artefacts_block`, a halo of time points around the
+    shard is read for interpolation, but only the shard's own time points are written.  Suite2p
+    binaries, if written, must have been allocated already.
+    """
+    orig_path = storage.find(layout.orig_h5_path())
+    artefacts_path = layout.artefacts_path()
+    shape = artefact_index.read_params(artefacts_path).get("shape")
+    if shape is None:
+        raise PreprocessError("No data shape recorded in %s, locate artefacts again before sharding" % artefacts_path)
+    shape = tuple(shape)
+    index = artefact_index.read(artefacts_path)
+    halo = artefact_halo(index, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+    t_first, t_last = shard_range(shard, num_shards, shape[0])
+    writer = suite2p_binary.BinaryWriter(layout.suite2p_binary_path(), shape) if write_binary else None
+
+    shard_path = layout.preprocess_shard_path(shard, num_shards)
+    shard_path.parent.mkdir(parents=True, exist_ok=True)
+    logger.info("Preprocessing time points %d-%d of %d into %s", t_first, t_last, shape[0], shard_path)
+    summary = stats.SummaryStats()
+    with storage.open_store(orig_path, "r") as store, storage.open_store(shard_path, "w") as store_out:
+        data = store["data"]
+        shard_shape = (t_last - t_first,) + shape[1:]
+        data_out = store_out.create("data", shape=shard_shape, dtype=np.uint16, chunks=(1, 1) + shape[2:])
+        for t_start, t_stop in utils.blocks(t_last - t_first, BLOCK_TIMEPOINTS):
+            t_start, t_stop = t_start + t_first, t_stop + t_first
+            block = remove_artefacts_block(data, index, t_start, t_stop, shape[0], halo, fill_kernel)
+            data_out[t_start - t_first : t_stop - t_first] = block
+            if writer is not None:
+                writer.write(t_start, block)
+            summary.update(block)
+            logger.info("Preprocessed time points %d-%d of %d-%d", t_start, t_stop, t_first, t_last)
+        summary.write(store_out)
+
+
+def merge_shard_outputs(layout, num_shards, write_binary=False):
+    """Join the shards of preprocessed time points into preprocess.h5 as a virtual dataset, without copying.
+
+    The shards are referred to by paths relative to preprocess.h5, so the stage can be moved as a
+    whole.  Their statistics are merged and stored alongside the virtual dataset.
+    """
+    preprocess_h5_path = layout.preprocess_h5_path()
+    params = artefact_index.read_params(layout.artefacts_path())
+    shape = tuple(params["shape"])
+    shard_paths = [layout.preprocess_shard_path(shard, num_shards) for shard in range(num_shards)]
+    missing = [str(path) for path in shard_paths if not path.exists()]
+    if missing:
+        raise PreprocessError("Missing preprocessed shards: %s" % ", ".join(missing))
+
+    vds_layout = h5py.VirtualLayout(shape=shape, dtype=np.uint16)
+    summary = stats.SummaryStats()
+    for shard, shard_path in enumerate(shard_paths):
+        t_start, t_stop = shard_range(shard, num_shards, shape[0])
+        shard_shape = (t_stop - t_start,) + shape[1:]
+        with storage.open_store(shard_path, "r") as store:
+            if store["data"].shape != shard_shape:
+                raise PreprocessError(
+                    "Shard %s has shape %s, expected %s" % (shard_path, store["data"].shape, shard_shape)
+                )
+            summary.merge(stats.load(store))
+        source = os.path.relpath(shard_path, preprocess_h5_path.parent)
+        vds_layout[t_start:t_stop] = h5py.VirtualSource(source, "data", shape=shard_shape)
+
+    storage.remove(preprocess_h5_path)
+    preprocess_h5_path.parent.mkdir(parents=True, exist_ok=True)
+    with storage.open_store(preprocess_h5_path, "w") as store:
+        store.root.create_virtual_dataset("data", vds_layout)
+        summary.write(store)
+    if write_binary:
+        suite2p_binary.BinaryWriter(layout.suite2p_binary_path(), shape).write_ops(summary.mean)
+    concat.write_info(layout.preprocess_info_path(), shape, np.uint16, params["frame_period"])
+    logger.info("Joined %d shards in %s", num_shards, preprocess_h5_path)
+
+
+def run_shards(layout, num_shards, workers=1, fill_kernel=interpolate.DEFAULT_FILL_KERNEL, write_binary=False):
+    """Preprocess all shards in a pool of `workers` processes, as an array job would, then join them."""
+    args = [(layout, shard, num_shards, fill_kernel, write_binary) for shard in range(num_shards)]
+    if workers <= 1:
+        for shard_args in args:
+            preprocess_shard(*shard_args)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for future in [executor.submit(preprocess_shard, *shard_args) for shard_args in args]:
+                future.result()
+    merge_shard_outputs(layout, num_shards, write_binary)
+
+
+def write_shards_script(layout, num_shards, fill_kernel=interpolate.DEFAULT_FILL_KERNEL, write_binary=False):
+    """Write a SLURM array script preprocessing one shard per task, followed by the merge of the shards."""
+    args = ["preprocess", "--fill-kernel", fill_kernel]
+    if write_binary:
+        args.append("--suite2p-binary")
+    return slurm.write_array_script(
+        layout.path("preprocess") / "preprocess_shards.sbatch",
+        job_name="preprocess-shards",
+        command=slurm.cli_command(layout, *args),
+        task_args="--shard %s/%d" % (slurm.TASK_ID, num_shards),
+        num_tasks=num_shards,
+        log_path=layout.path("logs"),
+        description="Preprocesses %d shards of time points of %s, then joins them." % (num_shards, layout.acquisition),
+        then=slurm.cli_command(layout, *args, "--shards", num_shards, "--merge-shards"),
+        cpus_per_task=1,  # Each shard is preprocessed in one process.
+    )
+
+
+def resolve_piezo(attrs, piezo_period_frames=None, piezo_skip_frames=None):
+    """Piezo settings used to map stim frames onto (t, z), defaulting to those recorded at convert time.
+
+    Data regrouped into piezo volumes by convert must be preprocessed with the same settings, or
+    artefacts would be mapped onto the wrong planes.  A given period without skipped frames skips none.
+    """
+    stored = attrs.get("piezo_period_frames"), attrs.get("piezo_skip_frames")
+    if stored[0] is None:
+        if piezo_period_frames is None:
+            return None, None
+        return piezo_period_frames, piezo_skip_frames or 0
+    stored = int(stored[0]), int(stored[1])
+    given = piezo_period_frames, piezo_skip_frames
+    if piezo_period_frames is not None and (piezo_period_frames, piezo_skip_frames or 0) != stored:
+        raise PreprocessError(
+            "Piezo settings (period %s, skip %s) do not match those used at convert time (period %s, skip %s)"
+            % (given + stored)
+        )
+    return stored
+
+
+def write_suite2p_binary(orig_path, binary_path, max_frames=None):
+    """Write Suite2p binaries of data which needs no artefact removal."""
+    with storage.open_store(orig_path, "r") as store:
+        data = store["data"]
+        shape = data.shape if max_frames is None else (min(max_frames, data.shape[0]),) + data.shape[1:]
+        writer = suite2p_binary.BinaryWriter(binary_path, shape)
+        writer.create()
+        logger.info("Writing Suite2p binaries to: %s" % binary_path)
+        summary = stats.SummaryStats()
+        for t_start, t_stop in utils.blocks(shape[0], BLOCK_TIMEPOINTS):
+            block = data[t_start:t_stop]
+            writer.write(t_start, block)
+            summary.update(block)
+    writer.write_ops(summary.mean)
+
+
+def remove_artefacts_parallel(
+    orig_path,
+    data_out,
+    preprocess_path,
+    index,
+    shape,
+    workers,
+    writer=None,
+    fill_kernel=interpolate.DEFAULT_FILL_KERNEL,
+):
+    """Remove artefacts from blocks of time points in a pool of processes, returning their statistics.
+
+    Zarr outputs are written by the workers directly, as each block covers separate chunks.  HDF5
+    outputs only support one writer, so blocks are returned to this process and written to
+    `data_out` here.  Suite2p binaries, if a `writer` is given, are written by the workers.
+    """
+    halo = artefact_halo(index, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+    write_in_worker = storage.backend_of(preprocess_path) == "zarr"
+    summary = stats.SummaryStats()
+    blocks = list(utils.blocks(shape[0], BLOCK_TIMEPOINTS))
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for num, (t_start, t_stop) in enumerate(blocks):
+            args = (orig_path, index, t_start, t_stop, shape[0], halo, fill_kernel)
+            out = preprocess_path if write_in_worker else None
+            pending.append((t_start, t_stop, executor.submit(_remove_artefacts_worker, *args, out, writer)))
+            # Bound the number of blocks in flight, and merge statistics in time order.
+            while pending and (len(pending) > 2 * workers or num == len(blocks) - 1):
+                t_start, t_stop, future = pending.popleft()
+                partial, block = future.result()
+                if block is not None:
+                    data_out[t_start:t_stop] = block
+                summary.merge(partial)
+                logger.info("Preprocessed time points %d-%d of %d", t_start, t_stop, shape[0])
+    return summary
+
+
+def _remove_artefacts_worker(orig_path, index, t_start, t_stop, num_timepoints, halo, fill_kernel, out_path, writer):
+    with storage.open_store(orig_path, "r") as store:
+        block = remove_artefacts_block(store["data"], index, t_start, t_stop, num_timepoints, halo, fill_kernel)
+    if writer is not None:
+        writer.write(t_start, block)
+    partial = stats.SummaryStats()
+    partial.update(block)
+    if out_path is None:
+        return partial, block
+    with storage.open_store(out_path, "r+") as store:
+        store["data"][t_start:t_stop] = block
+    return partial, None
+
+
+def artefacts_from_voltage(
+    df_voltage,
+    shape,
+    period_sec,
+    frame_channel_name,
+    stim_channel_name,
+    shift_px=0,
+    buffer_px=0,
+    settle_ms=0,
+    piezo_period_frames=None,
+    piezo_skip_frames=None,
+    artefacts_path=None,
+):
+    """Build the artefact table for data of the given (t, z, y, x) shape from voltage recordings.
+
+    If `artefacts_path` is given, the table is also stored there as an artefact file (see
+    artefact_index.write), with the frame and stim windows and the parameters used.
+    """
+    y_px = shape[2]  # dims are t, z, y, x
     px_to_ms = 1000 * period_sec / y_px
     shift_ms = shift_px * px_to_ms
     buffer_ms = buffer_px * px_to_ms
@@ -86,60 +526,194 @@ def preprocess(
     logger.info("Identifying frame and stim windows")
     df_frames = extract_frames(df_voltage[frame_channel_name], settle_ms)
     df_stims = extract_stims(df_voltage[stim_channel_name], shift_ms, buffer_ms)
+    df_artefacts = artefact_table(df_frames, df_stims, shape, piezo_period_frames, piezo_skip_frames)
 
-    df_artefacts, data_processed = _preprocess(df_frames, df_stims, data, piezo_period_frames, piezo_skip_frames)
+    if artefacts_path is not None:
+        params = {
+            "artefact_source": "voltage",
+            "frame_channel_name": frame_channel_name,
+            "stim_channel_name": stim_channel_name,
+            "shift_px": shift_px,
+            "buffer_px": buffer_px,
+            "settle_ms": settle_ms,
+            "piezo_period_frames": piezo_period_frames,
+            "piezo_skip_frames": piezo_skip_frames,
+            "frame_period": period_sec,
+            "shape": list(shape),
+        }
+        index = artefact_index_from_df(df_artefacts, shape[0])
+        artefact_index.write(artefacts_path, index, df_artefacts, df_frames, df_stims, params)
+        logger.info("Stored artefacts in %s\npreview:\n%s", artefacts_path, df_artefacts.head())
+    return df_artefacts
 
-    # Write output
-    df_artefacts.to_hdf(artefacts_path, "artefacts")
-    logger.info("Stored artefacts in %s\npreview:\n%s", artefacts_path, df_artefacts.head())
 
-    if preprocess_h5_path.exists():
-        logging.warning("Removing existing preprocessed hdf5 image file: %s", preprocess_h5_path)
-        preprocess_h5_path.unlink()
-    logger.info("Writing preprocessed image data to hdf5: %s" % preprocess_h5_path)
+def artefacts_from_image(
+    data,
+    shape,
+    period_sec,
+    buffer_px=0,
+    window=artefact_image.WINDOW_TIMEPOINTS,
+    threshold=artefact_image.THRESHOLD,
+    min_rows=artefact_image.MIN_ROWS,
+    polarity="bright",
+    piezo_period_frames=None,
+    piezo_skip_frames=None,
+    artefacts_path=None,
+    df_expected=None,
+):
+    """Build the artefact table for data of the given (t, z, y, x) shape by detecting artefacts in the images.
 
-    with h5py.File(preprocess_h5_path, "w") as h5file:
-        h5file.create_dataset("data", data=data_processed)
+    See artefact_image.detect.  If `df_expected` is given, such as the artefacts located from the
+    voltage recordings, the detected artefacts are compared with it (see artefact_image.compare),
+    and the comparison is logged and stored with the parameters.  If `artefacts_path` is given,
+    the table is also stored there as an artefact file, without frame or stim windows.
+    """
+    df_artefacts = artefact_image.detect(
+        data, shape, window, threshold, min_rows, polarity, buffer_px, piezo_period_frames, piezo_skip_frames
+    )
+    params = {
+        "artefact_source": "image",
+        "buffer_px": buffer_px,
+        "window": window,
+        "threshold": threshold,
+        "min_rows": min_rows,
+        "polarity": polarity,
+        "piezo_period_frames": piezo_period_frames,
+        "piezo_skip_frames": piezo_skip_frames,
+        "frame_period": period_sec,
+        "shape": list(shape),
+    }
+    if df_expected is not None:
+        comparison = artefact_image.compare(df_artefacts, df_expected, shape[2])
+        logger.info("Artefacts detected from images, against those expected: %s", comparison)
+        offset = comparison["start_offset_rows"]
+        if offset:
+            logger.warning(
+                "Artefacts detected from images start %.1f rows %s those expected; consider --shift-px",
+                abs(offset),
+                "after" if offset > 0 else "before",
+            )
+        params.update(comparison)
 
-    logger.info("Done")
+    if artefacts_path is not None:
+        index = artefact_index_from_df(df_artefacts, shape[0])
+        artefact_index.write(artefacts_path, index, df_artefacts, params=params)
+        logger.info("Stored artefacts in %s\npreview:\n%s", artefacts_path, df_artefacts.head())
+    return df_artefacts
 
 
 def _preprocess(df_frames, df_stims, data, piezo_period_frames=None, piezo_skip_frames=None):
     """Internal method of preprocess with no I/O for testing."""
+    df_artefacts = artefact_table(df_frames, df_stims, data.shape, piezo_period_frames, piezo_skip_frames)
+    index = artefact_index_from_df(df_artefacts, data.shape[0])
+    data = remove_artefacts_block(data, index, 0, data.shape[0])
+    return df_artefacts, data
+
+
+def artefact_table(df_frames, df_stims, shape, piezo_period_frames=None, piezo_skip_frames=None):
+    """Locate artefacts as (t, z, row_start:row_stop) regions of data with the given shape."""
     logger.info("Identifying artefacts")
     df_artefacts = artefact_detect.artefact_regions(df_frames, df_stims)
+    # Kept as a column, as the stored table does not keep the index.
+    df_artefacts["stim"] = df_artefacts.index
 
-    y_shape = data.shape[2]
+    y_shape = shape[2]
     df_artefacts["row_start"] = np.floor(df_artefacts["frac_start"] * y_shape).astype(np.int64)
     df_artefacts["row_stop"] = np.ceil(df_artefacts["frac_stop"] * y_shape).astype(np.int64)
 
-    z_shape = data.shape[1]
+    z_shape = shape[1]
     if piezo_period_frames is None:
         df_artefacts["t"] = df_artefacts["frame"] // z_shape
         df_artefacts["z"] = df_artefacts["frame"] % z_shape
     else:
-        assert piezo_skip_frames, "piezo_skip_frames must be set if piezeo_period_frames is set"
+        assert piezo_skip_frames is not None, "piezo_skip_frames must be set if piezeo_period_frames is set"
         assert z_shape == piezo_period_frames - piezo_skip_frames
         df_artefacts["t"] = df_artefacts["frame"] // piezo_period_frames
         df_artefacts["z"] = (df_artefacts["frame"] % piezo_period_frames) - piezo_skip_frames
         df_artefacts = df_artefacts[df_artefacts["z"] >= 0]
 
     # Remove extra voltage data, which can occur when using max-frames.
-    df_artefacts = df_artefacts[df_artefacts["t"] < data.shape[0]]
+    df_artefacts = df_artefacts[df_artefacts["t"] < shape[0]]
+    return df_artefacts
 
-    # Mask stim regions with nan, and then interpolate values for those pixels.
-    # Temporarily use float32 in order to use nan.
-    logger.info("Marking artefacts")
-    data = data.astype(np.float32)
-    for t, z, y0, y1 in df_artefacts[["t", "z", "row_start", "row_stop"]].values:
-        data[t, z, y0:y1] = np.nan
 
-    logger.info("Interpolating (can take several minutes)")
-    data = interpolate.interpolate_nan(data)
-    data = np.clip(data, 0, 65535)
-    data = data.astype(np.uint16)
+def artefact_index_from_df(df_artefacts, num_timepoints):
+    """Build an ArtefactIndex from the artefact table."""
+    return artefact_index.ArtefactIndex.from_arrays(
+        df_artefacts["t"].values,
+        df_artefacts["z"].values,
+        df_artefacts["row_start"].values,
+        df_artefacts["row_stop"].values,
+        num_timepoints,
+    )
 
-    return df_artefacts, data
+
+def artefact_halo(index, neighbours=1):
+    """Number of time points needed on either side of a block to interpolate all its artefacts.
+
+    Each row is interpolated from `neighbours` unaffected time points of the same row on either
+    side, so the halo must span the longest run of consecutive time points with an artefact on
+    the same row of the same z-plane, plus the extra neighbours.  Kernels filling from the same
+    frame need no halo.  `index` may be an ArtefactIndex or an artefact table.
+
+    Raises PreprocessError if the halo would exceed MAX_HALO_TIMEPOINTS, as every block would
+    then read most of the movie.
+    """
+    if neighbours == 0:
+        return 0
+    t, z, row_start, row_stop = (
+        np.asarray(getattr(index, name), dtype=np.int64) for name in ["t", "z", "row_start", "row_stop"]
+    )
+    # One entry per artefact row, sorted by (z, y, t).
+    num_rows = np.maximum(row_stop - row_start, 0)
+    entry = np.repeat(np.arange(len(t)), num_rows)
+    y = row_start[entry] + np.arange(len(entry)) - np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+    t, z = t[entry], z[entry]
+    order = np.lexsort((t, y, z))
+    t, y, z = t[order], y[order], z[order]
+    if not len(t):
+        return 1
+    # Runs of consecutive time points of a row are split wherever the row changes or the step is not 1.
+    # Overlapping artefacts repeat a time point, which neither splits nor lengthens a run.
+    step = np.diff(t)
+    new_run = (np.diff(z) != 0) | (np.diff(y) != 0) | (step > 1)
+    step = np.concatenate([[1], np.where(new_run, 1, step)])
+    run_id = np.cumsum(np.concatenate([[True], new_run]))
+    run_lengths = np.bincount(run_id, weights=step).astype(np.int64)
+    halo = max(int(run_lengths.max()) + neighbours - 1, 1)
+    if halo > MAX_HALO_TIMEPOINTS:
+        longest = np.flatnonzero(run_id == run_lengths.argmax())[0]
+        raise PreprocessError(
+            "Row %d of plane %d has artefacts in %d consecutive time points from %d, so interpolating over time"
+            " would read more than %d time points around each block.  Use --fill-kernel rows instead."
+            % (y[longest], z[longest], run_lengths.max(), t[longest], MAX_HALO_TIMEPOINTS)
+        )
+    return halo
+
+
+def remove_artefacts_block(
+    data, index, t_start, t_stop, num_timepoints=None, halo=None, fill_kernel=interpolate.DEFAULT_FILL_KERNEL
+):
+    """Remove artefacts from time points [t_start, t_stop) of data, returning a uint16 block.
+
+    `data` can be a numpy array, or an hdf5 or zarr array.  Only `halo` time points on either side of
+    the block are read in addition to the block itself, and only rows containing an artefact
+    are interpolated, with the named fill kernel (see interpolate.FILL_KERNELS).
+    """
+    num_timepoints = data.shape[0] if num_timepoints is None else num_timepoints
+    if halo is None:
+        halo = artefact_halo(index, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+    read_start = max(t_start - halo, 0)
+    read_stop = min(t_stop + halo, num_timepoints)
+    block = data[read_start:read_stop]
+
+    core_start, core_stop = t_start - read_start, t_stop - read_start
+
+    mask = index.mask(read_start, read_stop, block.shape[1], block.shape[2])
+    if mask[core_start:core_stop].any():
+        block = interpolate.fill_block(block, mask, fill_kernel, (core_start, core_stop))
+
+    return block[core_start:core_stop].astype(np.uint16)
 
 
 def extract_frames(frame_signal, settle_ms=0):
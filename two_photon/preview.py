@@ -0,0 +1,119 @@
+"""Command to quickly estimate motion in preprocessed data, before running Suite2p."""
+
+import logging
+import os
+
+import click
+import h5py
+import numpy as np
+import scipy.fft
+
+from two_photon import preprocess, stats, storage, utils
+
+logger = logging.getLogger(__name__)
+
+MAX_SHIFT_FRAC = 0.1  # Largest shift searched, as a fraction of the frame size (as Suite2p's maxregshift).
+REFERENCE_TIMEPOINTS = 200  # Time points averaged for the reference, when no mean image is stored.
+EPS = 1e-6  # Added to magnitudes before whitening the cross-power spectrum.
+
+
+@click.command()
+@click.pass_obj
+@click.option("--max-frames", type=int, help="Estimate motion over only the first max-frames time points.")
+@click.option(
+    "--max-shift-frac",
+    type=float,
+    default=MAX_SHIFT_FRAC,
+    show_default=True,
+    help="Largest shift searched, as a fraction of the frame height/width.",
+)
+@click.option("--workers", type=int, help="Number of threads used by each FFT.  Defaults to the number of CPUs.")
+def preview(layout, max_frames, max_shift_frac, workers):
+    """Estimate rigid motion of the preprocessed data, writing shifts and a motion-corrected mean image."""
+    preprocess_path = storage.find(layout.preprocess_h5_path())
+    preview_h5_path = layout.preview_h5_path()
+    preview_h5_path.parent.mkdir(parents=True, exist_ok=True)
+
+    logger.info("Estimating motion of %s", preprocess_path)
+    with storage.open_store(preprocess_path, "r") as store:
+        data = store["data"]
+        num_t = data.shape[0] if max_frames is None else min(max_frames, data.shape[0])
+        reference = stats.read(store, "mean")
+        if reference is None:
+            logger.info("No stored mean image, using the mean of the first %d time points", REFERENCE_TIMEPOINTS)
+            reference = data[:REFERENCE_TIMEPOINTS].mean(axis=0, dtype=np.float64)
+        result = estimate_motion(data, reference, num_t, max_shift_frac, workers or os.cpu_count())
+
+    logger.info("Writing motion estimate to %s", preview_h5_path)
+    with h5py.File(preview_h5_path, "w") as h5file:
+        h5file.create_dataset("reference", data=reference.astype(np.float32))
+        for name, value in result.items():
+            h5file.create_dataset(name, data=value)
+
+    abs_shifts = np.abs(result["shifts"]).max(axis=2)
+    for z in range(abs_shifts.shape[1]):
+        logger.info(
+            "Plane %d: median shift %.1f px, 99th percentile %.1f px, max %d px",
+            z,
+            np.median(abs_shifts[:, z]),
+            np.percentile(abs_shifts[:, z], 99),
+            abs_shifts[:, z].max(),
+        )
+    logger.info("Done")
+
+
+def estimate_motion(data, reference, num_t=None, max_shift_frac=MAX_SHIFT_FRAC, workers=None):
+    """Rigid motion of (t, z, y, x) data relative to a (z, y, x) reference image, streamed in blocks.
+
+    Returns a dict of:
+        shifts: (t, z, 2) int array of (dy, dx), such that each frame is its reference rolled by the shift.
+        peak: (t, z) phase correlation at the shift, near 1 for a good match.
+        mean_corrected: (z, y, x) mean image after undoing the shifts.
+    """
+    num_t = data.shape[0] if num_t is None else num_t
+    num_z, num_y, num_x = data.shape[1:]
+    max_shift = (max(1, int(num_y * max_shift_frac)), max(1, int(num_x * max_shift_frac)))
+    ref_fft = [np.conj(_fft(reference[z][np.newaxis], workers))[0] for z in range(num_z)]
+
+    shifts = np.zeros((num_t, num_z, 2), dtype=np.int32)
+    peak = np.zeros((num_t, num_z), dtype=np.float32)
+    corrected_sum = np.zeros((num_z, num_y, num_x), dtype=np.float64)
+    for t_start, t_stop in utils.blocks(num_t, preprocess.BLOCK_TIMEPOINTS):
+        block = data[t_start:t_stop]
+        for z in range(num_z):
+            frames = block[:, z]
+            block_shifts, block_peak = phase_correlation(frames, ref_fft[z], max_shift, workers)
+            shifts[t_start:t_stop, z], peak[t_start:t_stop, z] = block_shifts, block_peak
+            for frame, (dy, dx) in zip(frames, block_shifts):
+                corrected_sum[z] += np.roll(frame, (-dy, -dx), axis=(0, 1))
+        logger.info("Estimated motion of time points %d-%d of %d", t_start, t_stop, num_t)
+
+    return {"shifts": shifts, "peak": peak, "mean_corrected": (corrected_sum / num_t).astype(np.float32)}
+
+
+def _fft(frames, workers):
+    frames = frames.astype(np.float32)
+    frames -= frames.mean(axis=(1, 2), keepdims=True)
+    return scipy.fft.fft2(frames, workers=workers)
+
+
+def phase_correlation(frames, ref_fft_conj, max_shift, workers=None):
+    """Integer (dy, dx) shifts of (t, y, x) frames from a reference, by batched phase correlation.
+
+    `ref_fft_conj` is the conjugate of the reference's FFT.  Only shifts up to `max_shift`
+    (dy, dx) are searched.
+    """
+    cross = _fft(frames, workers) * ref_fft_conj
+    cross /= np.abs(cross) + EPS
+    corr = scipy.fft.ifft2(cross, workers=workers).real
+
+    # Gather the window of allowed shifts, which wraps around the corners of the correlation.
+    max_y, max_x = max_shift
+    dy = np.arange(-max_y, max_y + 1)
+    dx = np.arange(-max_x, max_x + 1)
+    window = corr[:, dy[:, np.newaxis], dx[np.newaxis, :]]
+
+    flat = window.reshape(len(frames), -1)
+    best = flat.argmax(axis=1)
+    iy, ix = np.unravel_index(best, window.shape[1:])
+    return np.stack([dy[iy], dx[ix]], axis=1), flat[np.arange(len(frames)), best]
@@ -1,13 +1,25 @@
+import json
 import logging
 
 import click
-import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from two_photon import artefact_index, frames, stats, storage, utils
+
 logger = logging.getLogger(__name__)
 
+BLOCK_TIMEPOINTS = 256  # Time points read at once for the QA metrics.
+ADJACENT_ROWS = 4  # Unaffected rows above and below each artefact compared against it.
+OUTLIER_Z = 5  # Robust z-score of a residual above which an artefact is an outlier.
+COLOR_PERCENTILES = (1, 99)  # Percentiles of the plane's pixels setting the color scale of QA plots.
+COLOR_STDS = 2  # Standard deviations either side of the mean image spanned by the color scale.
+
+
+class QAError(Exception):
+    """Error raised when the QA metrics fail the given limits."""
+
 
 @click.command()
 @click.pass_obj
@@ -17,36 +29,200 @@ logger = logging.getLogger(__name__)
     type=int,
     help="Random seed for sampling frames for QA (if unset, frames are evenly spaced through dataset)",
 )
-def qa(layout, num_frames, random_state):
-    convert_path = layout.path("convert")
-    orig_h5_path = convert_path / "orig.h5"
-
-    preprocess_path = layout.path("preprocess")
-    preprocess_h5_path = preprocess_path / "preprocess" / "preprocess.h5"
-    artefacts_path = preprocess_path / "artefacts" / "artefacts.h5"
+@click.option("--plots/--no-plots", default=True, show_default=True, help="Make the QA plots, besides the metrics.")
+@click.option(
+    "--max-residual",
+    type=float,
+    help="Fail if the median residual of corrected rows, relative to their surroundings, exceeds this in any plane.",
+)
+def qa(layout, num_frames, random_state, plots, max_residual):
+    artefacts_path = layout.artefacts_path()
 
     qa_path = layout.path("qa")
     qa_plot_path = qa_path / "qa.png"
 
-    with h5py.File(orig_h5_path, "r") as h5file:
-        data = h5file["data"][()]
-
-    with h5py.File(preprocess_h5_path, "r") as h5file:
-        data_processed = h5file["data"][()]
+    df_artefacts = artefact_index.read_table(artefacts_path)
 
-    df_artefacts = pd.read_hdf(artefacts_path, "artefacts")
+    qa_path.mkdir(parents=True, exist_ok=True)
+    with storage.open_store(storage.find(layout.preprocess_h5_path()), "r") as store:
+        df_metrics = artefact_metrics(store["data"], artefact_index.read(artefacts_path), df_artefacts)
+    summary = write_metrics(qa_path, df_metrics, max_residual)
+    if not plots:
+        check_summary(summary)
+        return
 
-    qa_plot = side_by_side_comparison(data, data_processed, df_artefacts, num_frames, random_state)
+    # Only the sampled frames are read, rather than loading both full datasets.
+    with frames.FrameServer(layout) as server:
+        plane_mean = stats.read(server.store("preprocess"), "mean")
+        plane_std = stats.read(server.store("preprocess"), "std")
+        qa_plot = side_by_side_comparison(
+            server.view("orig"),
+            server.view("preprocess"),
+            df_artefacts,
+            num_frames,
+            random_state,
+            plane_mean=plane_mean,
+            plane_std=plane_std,
+        )
 
-    qa_plot_path.parent.mkdir(parents=True, exist_ok=True)
     qa_plot.savefig(qa_plot_path)
     logger.info("Stored QA plot in %s", qa_plot_path)
+    check_summary(summary)
 
     logger.info("Done")
 
 
-def side_by_side_comparison(uncorrected, corrected, df_artefacts, num_frames=15, random_state=None):
-    """Makes a figure showing a sample of frames with artefacts, before and after correction."""
+def artefact_metrics(data, index, df_artefacts, adjacent_rows=ADJACENT_ROWS):
+    """Compare the corrected rows of every artefact with their surroundings, in one pass over the data.
+
+    Frames are reduced to row means as they stream through in blocks, so each artefact costs a few
+    lookups.  Rows of other artefacts are left out of the surroundings.  Returns a table with the
+    rows of df_artefacts, adding:
+
+    - row_mean: mean intensity of the corrected rows.
+    - adjacent_mean, adjacent_residual: of up to adjacent_rows unaffected rows above and below in
+      the same frame, and row_mean / adjacent_mean - 1.  A misaligned stim window leaves artefact
+      in the rows next to the corrected ones, so skews this residual.
+    - neighbour_mean, neighbour_residual: of the same rows in the frames before and after, and
+      row_mean / neighbour_mean - 1.
+    """
+    num_t, num_z, num_y = data.shape[:3]
+    t = df_artefacts["t"].values
+    z = df_artefacts["z"].values
+    row_start = np.clip(df_artefacts["row_start"].values, 0, num_y)
+    row_stop = np.clip(df_artefacts["row_stop"].values, 0, num_y)
+    metrics = {name: np.full(len(t), np.nan) for name in ["row_mean", "adjacent_mean", "neighbour_mean"]}
+
+    order = np.argsort(t, kind="stable")
+    for t_start, t_stop in utils.blocks(num_t, BLOCK_TIMEPOINTS):
+        sel = order[np.searchsorted(t[order], t_start) : np.searchsorted(t[order], t_stop)]
+        if not len(sel):
+            continue
+        # One time point on either side, for the neighbouring frames.
+        read_start, read_stop = max(t_start - 1, 0), min(t_stop + 1, num_t)
+        row_means = data[read_start:read_stop].mean(axis=3, dtype=np.float64)
+        clean = ~index.mask(read_start, read_stop, num_z, num_y)
+        pad = [(0, 0), (0, 0), (1, 0)]
+        sum_all = np.pad(np.cumsum(row_means, axis=2), pad)
+        sum_clean = np.pad(np.cumsum(row_means * clean, axis=2), pad)
+        count_clean = np.pad(np.cumsum(clean, axis=2), pad)
+
+        ts, zs, starts, stops = t[sel] - read_start, z[sel], row_start[sel], row_stop[sel]
+        total = sum_all[ts, zs, stops] - sum_all[ts, zs, starts]
+        metrics["row_mean"][sel] = total / np.maximum(stops - starts, 1)
+        above = _range_sums(sum_clean, count_clean, ts, zs, np.maximum(starts - adjacent_rows, 0), starts)
+        below = _range_sums(sum_clean, count_clean, ts, zs, stops, np.minimum(stops + adjacent_rows, num_y))
+        before = _range_sums(sum_clean, count_clean, ts - 1, zs, starts, stops)
+        after = _range_sums(sum_clean, count_clean, ts + 1, zs, starts, stops)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            metrics["adjacent_mean"][sel] = (above[0] + below[0]) / (above[1] + below[1])
+            metrics["neighbour_mean"][sel] = (before[0] + after[0]) / (before[1] + after[1])
+        logger.info("Computed QA metrics of time points %d-%d of %d", t_start, t_stop, num_t)
+
+    df_metrics = df_artefacts.reset_index(drop=True).assign(**metrics)
+    df_metrics["adjacent_residual"] = df_metrics["row_mean"] / df_metrics["adjacent_mean"] - 1
+    df_metrics["neighbour_residual"] = df_metrics["row_mean"] / df_metrics["neighbour_mean"] - 1
+    df_metrics["outlier"] = False
+    for _, df_plane in df_metrics.groupby("z"):
+        for column in ["adjacent_residual", "neighbour_residual"]:
+            df_metrics.loc[df_plane.index, "outlier"] |= robust_z(df_plane[column]) > OUTLIER_Z
+    return df_metrics
+
+
+def _range_sums(cum_sum, cum_count, frame, z, start, stop):
+    """Sums and counts of rows [start, stop) from cumulative (t, z, y + 1) arrays, zero for frames outside them."""
+    inside = (frame >= 0) & (frame < len(cum_sum))
+    frame = np.clip(frame, 0, len(cum_sum) - 1)
+    total = (cum_sum[frame, z, stop] - cum_sum[frame, z, start]) * inside
+    count = (cum_count[frame, z, stop] - cum_count[frame, z, start]) * inside
+    return total, count
+
+
+def robust_z(values):
+    """Absolute deviation of values from their median, in robust standard deviations (from the MAD)."""
+    deviation = (values - values.median()).abs()
+    scale = 1.4826 * deviation.median()
+    if not scale > 0:
+        return pd.Series(0.0, index=values.index)
+    return (deviation / scale).fillna(0)
+
+
+def summarize(df_metrics, max_residual=None):
+    """Summary of the residuals per z-plane, with whether they pass max_residual, as a JSON-ready dict."""
+    residuals = ["adjacent_residual", "neighbour_residual"]
+    planes = {}
+    for z, df_plane in df_metrics.groupby("z"):
+        plane = {"artefacts": len(df_plane), "outliers": int(df_plane["outlier"].sum())}
+        for column in residuals:
+            values = df_plane[column].dropna()
+            plane[column] = {
+                "median": float(values.median()) if len(values) else None,
+                "mean": float(values.mean()) if len(values) else None,
+                "p95_abs": float(values.abs().quantile(0.95)) if len(values) else None,
+            }
+        planes[str(z)] = plane
+
+    failed = []
+    if max_residual is not None:
+        for z, plane in planes.items():
+            for column in residuals:
+                median = plane[column]["median"]
+                if median is not None and abs(median) > max_residual:
+                    failed.append("plane %s %s median %.3f" % (z, column, median))
+    return {
+        "artefacts": len(df_metrics),
+        "outliers": int(df_metrics["outlier"].sum()),
+        "planes": planes,
+        "max_residual": max_residual,
+        "failed": failed,
+        "passed": not failed,
+    }
+
+
+def write_metrics(qa_path, df_metrics, max_residual=None):
+    """Store per-artefact and per-stim metrics as CSV, and their summary as JSON, returning the summary."""
+    df_metrics.to_csv(qa_path / "qa_artefacts.csv", index=False)
+    if "stim" in df_metrics:
+        residuals = ["row_mean", "adjacent_residual", "neighbour_residual"]
+        df_stims = df_metrics.groupby("stim")[residuals].mean()
+        df_stims["artefacts"] = df_metrics.groupby("stim").size()
+        df_stims["outliers"] = df_metrics.groupby("stim")["outlier"].sum()
+        df_stims.to_csv(qa_path / "qa_stims.csv")
+
+    summary = summarize(df_metrics, max_residual)
+    with open(qa_path / "qa_metrics.json", "w") as fout:
+        json.dump(summary, fout, indent=4)
+    logger.info(
+        "Stored QA metrics in %s: %d artefacts, %d outliers", qa_path, summary["artefacts"], summary["outliers"]
+    )
+    return summary
+
+
+def check_summary(summary):
+    if not summary["passed"]:
+        raise QAError("QA metrics exceed the maximum residual: %s" % "; ".join(summary["failed"]))
+
+
+def color_limits(plane_mean, plane_std):
+    """Color scale (vmin, vmax) of a plane from its (y, x) mean and std images over time.
+
+    Percentiles over pixels of the mean image, less or plus COLOR_STDS standard deviations, are
+    used, so a hot pixel or frame does not wash out the plots.
+    """
+    vmin = np.percentile(plane_mean - COLOR_STDS * plane_std, COLOR_PERCENTILES[0])
+    vmax = np.percentile(plane_mean + COLOR_STDS * plane_std, COLOR_PERCENTILES[1])
+    return vmin, vmax
+
+
+def side_by_side_comparison(
+    uncorrected, corrected, df_artefacts, num_frames=15, random_state=None, plane_mean=None, plane_std=None
+):
+    """Makes a figure showing a sample of frames with artefacts, before and after correction.
+
+    If given, the (z, y, x) `plane_mean` and `plane_std` images (as stored by preprocess in the
+    `stats` group) set the color scale of each plane (see `color_limits`).  Otherwise it is set
+    from each corrected frame.
+    """
     if random_state is not None:
         df_samples = df_artefacts.sample(num_frames, random_state=random_state).sort_values(["t", "z"])
     else:
@@ -62,10 +238,17 @@ def side_by_side_comparison(uncorrected, corrected, df_artefacts, num_frames=15,
     axes[0][1].set_title("Corrected")
 
     for idx, sample in enumerate(df_samples.itertuples()):
-        axes[idx][0].set_ylabel(f"Artefact {sample.Index}, Timepoint {sample.t}, Plane {sample.z}")
+        label = f"Timepoint {sample.t}, Plane {sample.z}"
+        # Artefact files written before the stim column was stored do not record the stim.
+        if "stim" in df_samples:
+            label = f"Stim {sample.stim}, {label}"
+        axes[idx][0].set_ylabel(label)
 
-        vmin = corrected[sample.t, sample.z].min()
-        vmax = corrected[sample.t, sample.z].max()
+        if plane_mean is not None and plane_std is not None:
+            vmin, vmax = color_limits(plane_mean[sample.z], plane_std[sample.z])
+        else:
+            vmin = corrected[sample.t, sample.z].min()
+            vmax = corrected[sample.t, sample.z].max()
 
         axes[idx][0].imshow(uncorrected[sample.t, sample.z], vmin=vmin, vmax=vmax)
         axes[idx][0].axhline(sample.row_start, c="r", lw=2)
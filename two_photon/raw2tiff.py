@@ -1,18 +1,20 @@
 """Library for running Bruker image ripping utility."""
 
-import atexit
+import json
 import logging
 import os
 import pathlib
 import platform
 import re
-import shutil
 import subprocess
 import time
+import uuid
 import xml.etree.ElementTree as ET
 
 import click
 
+from two_photon import placement
+
 logger = logging.getLogger(__name__)
 
 # Ripping process does not end cleanly, so the filesystem is polled to detect the
@@ -22,6 +24,12 @@ RIP_TOTAL_WAIT_SECS = 3600  # Total time to wait for ripping before killing it.
 RIP_EXTRA_WAIT_SECS = 10  # Extra time to wait after ripping is detected to be done.
 RIP_POLL_SECS = 10  # Time to wait between polling the filesystem.
 
+# Jobs for a rip service (see rip_service.py) move through these sub-directories of its queue.
+QUEUE_PENDING = "pending"
+QUEUE_RUNNING = "running"
+QUEUE_DONE = "done"
+QUEUE_POLL_SECS = 5  # Time to wait between checks for a submitted job to finish.
+
 
 class RippingError(Exception):
     """Error raised if problems encountered during data conversion."""
@@ -29,16 +37,44 @@ class RippingError(Exception):
 
 @click.command()
 @click.pass_obj
-def raw2tiff(layout):
+@click.option(
+    "--service",
+    "queue_path",
+    type=click.Path(file_okay=False),
+    help="Submit the rip to a rip service watching this queue directory, rather than starting the ripper here.",
+)
+def raw2tiff(layout, queue_path):
     """Convert Bruker RAW files to TIFF files via ripper."""
     raw_path = layout.path("raw")
     tiff_path = layout.path("tiff")
 
+    if queue_path is not None:
+        job_id = submit_rip(pathlib.Path(queue_path), raw_path, tiff_path)
+        wait_for_rip(pathlib.Path(queue_path), job_id)
+        return
+
+    rip(raw_path, tiff_path)
+
+
+def rip(
+    raw_path,
+    tiff_path,
+    ripper=None,
+    env=None,
+    poll_secs=RIP_POLL_SECS,
+    extra_wait_secs=RIP_EXTRA_WAIT_SECS,
+    total_wait_secs=RIP_TOTAL_WAIT_SECS,
+):
+    """Rip the RAWDATA in raw_path into TIFF files in tiff_path.
+
+    The ripper defaults to the Prairie View version which wrote the data.  It is run with the
+    given environment, such as a WINEPREFIX, and stopped once its output stops changing.
+    """
     # Bruker software appends the raw_path basename to the given output directory.
     tiff_path_bruker = tiff_path / raw_path.name
     os.makedirs(tiff_path_bruker, exist_ok=True)
 
-    ripper = determine_ripper(raw_path)
+    ripper = determine_ripper(raw_path) if ripper is None else ripper
 
     def get_filelists():
         filelists = list(sorted(raw_path.glob("*Filelist.txt")))
@@ -58,21 +94,20 @@ def raw2tiff(layout):
     def copy_back_files():
         """Copies back metadata files that Bruker copied to output directory.
 
-        This helps preserve the input directory contents.
+        This helps preserve the input directory contents.  Files are copied rather than
+        hardlinked, so the raw and tiff directories can be changed independently.
         """
         paths_to_copy = [path for path in tiff_path_bruker.iterdir() if not path.name.endswith("ome.tif")]
         logging.info("Copying back files to input directory: %s", paths_to_copy)
         for path in paths_to_copy:
             if path.is_file():
-                shutil.copy(path, raw_path)
+                placement.place(path, raw_path / path.name, link=False)
             else:
-                shutil.copytree(path, raw_path / path.name)
+                placement.place_tree(path, raw_path / path.name, link=False)
 
     def correct_tiff_directory():
         """Move the tiff directory created by Bruker up one level."""
-        for path in tiff_path_bruker.iterdir():
-            path.rename(tiff_path / path.name)
-        tiff_path_bruker.rmdir()
+        placement.place_tree(tiff_path_bruker, tiff_path, move=True)
 
     filelists = get_filelists()
     if not filelists:
@@ -92,8 +127,8 @@ def raw2tiff(layout):
         "\n ".join([str(f) for f in rawdata]),
     )
 
-    system = platform.system()
-    if system == "Linux":
+    # Windows executables run through wine on Linux.
+    if platform.system() == "Linux" and str(ripper).endswith(".exe"):
         cmd = ["wine"]
     else:
         cmd = []
@@ -115,50 +150,70 @@ def raw2tiff(layout):
     # Run a subprocess to execute the ripping.  Note this is non-blocking because the
     # ripper never exits.  (If we blocked waiting for it, we'd wait forever.)  Instead,
     # we wait for the output files to be finished.
-    process = subprocess.Popen(cmd)
-
-    # Register a cleanup function that will kill the ripping subprocess.  This handles the cases
-    # where someone hits Control-C, or the main program exits for some other reason.  Without
-    # this cleanup function, the subprocess will just continue running in the background.
-    def cleanup():
-        timeout_sec = 5
-        p_sec = 0
-        for _ in range(timeout_sec):
-            if process.poll() is None:
-                time.sleep(1)
-                p_sec += 1
-        if p_sec >= timeout_sec:
-            process.kill()
-        logger.info("cleaned up!")
-
-    atexit.register(cleanup)
-
-    # Wait for the tiff files to stop changing.
-    remaining_sec = RIP_TOTAL_WAIT_SECS
-    last_tiffs = {}
-    while remaining_sec >= 0:
-        logging.info("Watching for ripper to finish for %d more seconds", remaining_sec)
-        remaining_sec -= RIP_POLL_SECS
-        time.sleep(RIP_POLL_SECS)
-
-        tiffs = get_tiffs()
-        tiffs_changed = last_tiffs != tiffs
-        last_tiffs = tiffs
-
-        if tiffs and not tiffs_changed:
-            logging.info("Detected ripping is complete")
-            time.sleep(RIP_EXTRA_WAIT_SECS)  # Wait before terminating ripper, just to be safe.
-            logging.info("Killing ripper")
+    process = subprocess.Popen(cmd, env=env)
+
+    # The ripper is killed however this returns, including on Control-C.  Without this, the
+    # subprocess would just continue running in the background.
+    try:
+        # Wait for the tiff files to stop changing.
+        remaining_sec = total_wait_secs
+        last_tiffs = {}
+        while remaining_sec >= 0:
+            logging.info("Watching for ripper to finish for %d more seconds", remaining_sec)
+            remaining_sec -= poll_secs
+            time.sleep(poll_secs)
+
+            tiffs = get_tiffs()
+            tiffs_changed = last_tiffs != tiffs
+            last_tiffs = tiffs
+
+            if tiffs and not tiffs_changed:
+                logging.info("Detected ripping is complete")
+                time.sleep(extra_wait_secs)  # Wait before terminating ripper, just to be safe.
+                logging.info("Killing ripper")
+                process.kill()
+                logging.info("Ripper has been killed")
+
+                copy_back_files()
+                correct_tiff_directory()
+
+                logging.info("Done")
+                return
+    finally:
+        if process.poll() is None:
             process.kill()
-            logging.info("Ripper has been killed")
-
-            copy_back_files()
-            correct_tiff_directory()
-
-            logging.info("Done")
-            return
-
-    raise RippingError("Killing ripper because it did not finish within %s seconds" % RIP_TOTAL_WAIT_SECS)
+        process.wait()
+
+    raise RippingError("Killing ripper because it did not finish within %s seconds" % total_wait_secs)
+
+
+def submit_rip(queue_path, raw_path, tiff_path):
+    """Submit a rip job to the rip service watching queue_path, returning its job id."""
+    job_id = uuid.uuid4().hex
+    pending_path = queue_path / QUEUE_PENDING
+    pending_path.mkdir(parents=True, exist_ok=True)
+    job = {"raw_path": str(raw_path.resolve()), "tiff_path": str(tiff_path.resolve()), "submitted": time.time()}
+    # Written under a temporary name, then renamed, so the service never sees a partial job.
+    tmp_path = pending_path / f".{job_id}.json"
+    tmp_path.write_text(json.dumps(job))
+    tmp_path.rename(pending_path / f"{job_id}.json")
+    logger.info("Submitted rip job %s to %s", job_id, queue_path)
+    return job_id
+
+
+def wait_for_rip(queue_path, job_id, poll_secs=QUEUE_POLL_SECS, timeout_secs=None):
+    """Wait for a submitted rip job to finish, returning its result, or raising RippingError if it failed."""
+    done_path = queue_path / QUEUE_DONE / f"{job_id}.json"
+    start = time.time()
+    while not done_path.exists():
+        if timeout_secs is not None and time.time() - start > timeout_secs:
+            raise RippingError("Rip job %s did not finish within %s seconds" % (job_id, timeout_secs))
+        time.sleep(poll_secs)
+    result = json.loads(done_path.read_text())
+    if result["status"] != "done":
+        raise RippingError("Rip job %s failed: %s" % (job_id, result.get("error")))
+    logger.info("Rip job %s finished in %.1f seconds", job_id, result["secs"])
+    return result
 
 
 def determine_ripper(raw_path):
@@ -0,0 +1,250 @@
+"""Long-lived ripping service, which keeps wine prefixes ready for rip jobs.
+
+Ripping in the container normally pays a fixed cost on every run: copying a fresh wine
+prefix, starting Xvfb and starting the wineserver, before the ripper itself starts.  The
+service pays it once.  It keeps a pool of initialized wine prefixes, each with a persistent
+wineserver, and an Xvfb display, and rips jobs submitted to a queue directory (see
+`raw2tiff.submit_rip`, or `2p raw2tiff --service`) as they arrive.
+
+A job is a JSON file moving through the pending, running and done sub-directories of the
+queue.  Renaming is atomic, so several services may watch the same queue.  Each service moves
+the jobs it claims into its own directory under running, next to a heartbeat file it touches
+while it is up, and only the jobs of services whose heartbeat has gone stale are requeued.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+import click
+
+from two_photon import raw2tiff
+
+logger = logging.getLogger(__name__)
+
+WINE_TEMPLATE = "/home/wineuser/.wine"  # Initialized wine prefix of the ripping container.
+POOL_SIZE = 2  # Number of rips run at once, each in its own wine prefix.
+SERVICE_POLL_SECS = 2  # Time to wait between checks of the queue for new jobs.
+SERVICE_STALE_SECS = 120  # Age of a heartbeat after which its service is taken to be dead.
+HEARTBEAT = ".heartbeat"  # File touched by a service in its running directory while it is up.
+
+
+class PrefixPool:
+    """Pool of environments for running the ripper, each with its own initialized wine prefix.
+
+    Prefixes are copied from `template` once, when the pool starts, and a persistent wineserver
+    is started for each, so jobs start the ripper warm.  Without a template, the pool only
+    limits the number of concurrent jobs, which suits rippers that do not need wine.
+    """
+
+    def __init__(self, size, template=None, prefix_path=None, display=None):
+        self.size = size
+        self.template = template
+        self.prefix_path = prefix_path
+        self.display = display
+        self.prefixes = []
+        self._free = queue.Queue()
+
+    def start(self):
+        for num in range(self.size):
+            env = dict(os.environ)
+            if self.display is not None:
+                env["DISPLAY"] = self.display
+            if self.template is not None:
+                prefix = self.prefix_path / f"prefix{num}"
+                if not prefix.exists():
+                    logger.info("Initializing wine prefix %s from %s", prefix, self.template)
+                    shutil.copytree(self.template, prefix, symlinks=True)
+                env.update(WINEPREFIX=str(prefix), WINEARCH="win64")
+                # The wineserver daemonizes, and stays up between rips with --persistent.
+                subprocess.run(["wineserver", "--persistent"], env=env, check=True)
+                self.prefixes.append(env)
+            self._free.put(env)
+        logger.info("Started pool of %d ripper environments", self.size)
+
+    def acquire(self):
+        return self._free.get()
+
+    def release(self, env):
+        self._free.put(env)
+
+    def close(self):
+        for env in self.prefixes:
+            subprocess.run(["wineserver", "--kill"], env=env)
+
+
+class RipService:
+    """Rips jobs from a queue directory, running up to one job per environment of the pool.
+
+    Parameters
+    ----------
+    queue_path: pathlib.Path
+        Queue directory, see raw2tiff.submit_rip.
+    pool: PrefixPool
+        Environments to run the ripper in.
+    ripper: pathlib.Path, optional
+        Ripper used for every job.  Defaults to the Prairie View version which wrote each job's data.
+    poll_secs: float
+        Time to wait between checks of the queue.
+    rip_poll_secs: float
+        Time to wait between checks of the ripper output.
+    stale_secs: float
+        Age of another service's heartbeat after which its running jobs are requeued.
+    rip_kwargs:
+        Other arguments to raw2tiff.rip, such as its wait times.
+    """
+
+    def __init__(
+        self,
+        queue_path,
+        pool,
+        ripper=None,
+        poll_secs=SERVICE_POLL_SECS,
+        rip_poll_secs=raw2tiff.RIP_POLL_SECS,
+        stale_secs=SERVICE_STALE_SECS,
+        **rip_kwargs,
+    ):
+        self.queue_path = queue_path
+        self.pool = pool
+        self.ripper = ripper
+        self.poll_secs = poll_secs
+        self.stale_secs = stale_secs
+        self.rip_kwargs = dict(rip_kwargs, poll_secs=rip_poll_secs)
+        for name in [raw2tiff.QUEUE_PENDING, raw2tiff.QUEUE_RUNNING, raw2tiff.QUEUE_DONE]:
+            (queue_path / name).mkdir(parents=True, exist_ok=True)
+        service_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.running_path = queue_path / raw2tiff.QUEUE_RUNNING / service_id
+        self.running_path.mkdir()
+        self.heartbeat()
+
+    def heartbeat(self):
+        """Mark this service as up, so other services leave its running jobs alone."""
+        (self.running_path / HEARTBEAT).touch()
+
+    def requeue_running(self):
+        """Return jobs left running by services with a stale heartbeat to the pending queue."""
+        for service_path in (self.queue_path / raw2tiff.QUEUE_RUNNING).iterdir():
+            if service_path == self.running_path or not service_path.is_dir():
+                continue
+            try:
+                if time.time() - (service_path / HEARTBEAT).stat().st_mtime < self.stale_secs:
+                    continue
+            except FileNotFoundError:  # Shut down cleanly, or cleaned up by another service.
+                pass
+            for path in service_path.glob("*.json"):
+                logger.warning("Requeuing rip job %s interrupted in %s", path.stem, service_path.name)
+                try:
+                    path.rename(self.queue_path / raw2tiff.QUEUE_PENDING / path.name)
+                except FileNotFoundError:  # Requeued by another service.
+                    continue
+            shutil.rmtree(service_path, ignore_errors=True)
+
+    def claim(self):
+        """Move the oldest pending job to running, returning its (id, job), or None if there is none."""
+        pending = []
+        for path in (self.queue_path / raw2tiff.QUEUE_PENDING).glob("[!.]*.json"):
+            try:
+                pending.append((path.stat().st_mtime, path))
+            except FileNotFoundError:  # Claimed by another service since the listing.
+                continue
+        for _, path in sorted(pending):
+            running = self.running_path / path.name
+            try:
+                path.rename(running)
+            except FileNotFoundError:  # Claimed by another service.
+                continue
+            return path.stem, json.loads(running.read_text())
+        return None
+
+    def run_job(self, job_id, job):
+        logger.info("Ripping job %s: %s -> %s", job_id, job["raw_path"], job["tiff_path"])
+        env = self.pool.acquire()
+        start = time.time()
+        result = {"status": "done"}
+        try:
+            raw2tiff.rip(
+                pathlib.Path(job["raw_path"]), pathlib.Path(job["tiff_path"]), self.ripper, env, **self.rip_kwargs
+            )
+        except Exception as exc:  # Recorded for the submitter, and the service carries on.
+            logger.exception("Rip job %s failed", job_id)
+            result = {"status": "failed", "error": str(exc)}
+        finally:
+            self.pool.release(env)
+        result["secs"] = time.time() - start
+
+        done_path = self.queue_path / raw2tiff.QUEUE_DONE
+        tmp_path = done_path / f".{job_id}.json"
+        tmp_path.write_text(json.dumps({**job, **result}))
+        tmp_path.rename(done_path / f"{job_id}.json")
+        (self.running_path / f"{job_id}.json").unlink()
+        logger.info("Rip job %s %s in %.1f seconds", job_id, result["status"], result["secs"])
+
+    def serve(self, stop=None):
+        """Rip jobs as they are queued, until `stop` (a threading.Event) is set."""
+        stop = threading.Event() if stop is None else stop
+        self.requeue_running()
+        slots = threading.Semaphore(self.pool.size)
+        with concurrent.futures.ThreadPoolExecutor(self.pool.size) as executor:
+            while not stop.is_set():
+                self.heartbeat()
+                if not slots.acquire(timeout=self.poll_secs):
+                    continue
+                job = self.claim()
+                if job is None:
+                    slots.release()
+                    self.requeue_running()
+                    stop.wait(self.poll_secs)
+                    continue
+                executor.submit(self.run_job, *job).add_done_callback(lambda _: slots.release())
+            # Keep the heartbeat going while running jobs finish.
+            for _ in range(self.pool.size):
+                while not slots.acquire(timeout=self.poll_secs):
+                    self.heartbeat()
+        # Running jobs have finished, so a clean shutdown leaves nothing to requeue.
+        shutil.rmtree(self.running_path, ignore_errors=True)
+
+
+@click.command()
+@click.option("--queue-dir", type=click.Path(file_okay=False), required=True, help="Directory of the job queue.")
+@click.option("--pool-size", type=int, default=POOL_SIZE, show_default=True, help="Number of rips run at once.")
+@click.option("--wine/--no-wine", default=True, show_default=True, help="Run the ripper in a pool of wine prefixes.")
+@click.option(
+    "--wine-template", default=WINE_TEMPLATE, show_default=True, help="Initialized wine prefix copied into the pool."
+)
+@click.option("--prefix-dir", type=click.Path(file_okay=False), help="Directory for the pool of wine prefixes.")
+@click.option("--xvfb-display", help="Start Xvfb on this display (such as :99) for the ripper.")
+@click.option("--ripper", type=click.Path(exists=True), help="Ripper for all jobs, instead of the matching version.")
+def rip_service(queue_dir, pool_size, wine, wine_template, prefix_dir, xvfb_display, ripper):
+    """Rip jobs submitted with `2p raw2tiff --service QUEUE_DIR`, keeping the ripper environment warm."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(module)s:%(lineno)s %(levelname)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    xvfb = None
+    if xvfb_display is not None:
+        logger.info("Starting Xvfb on display %s", xvfb_display)
+        xvfb = subprocess.Popen(["Xvfb", xvfb_display, "-nolisten", "tcp"])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix_path = pathlib.Path(prefix_dir or tmp_dir)
+        pool = PrefixPool(pool_size, wine_template if wine else None, prefix_path, xvfb_display)
+        try:
+            pool.start()
+            service = RipService(pathlib.Path(queue_dir), pool, ripper and pathlib.Path(ripper))
+            logger.info("Watching for rip jobs in %s", queue_dir)
+            service.serve()
+        finally:
+            pool.close()
+            if xvfb is not None:
+                xvfb.terminate()
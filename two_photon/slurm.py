@@ -0,0 +1,88 @@
+"""Writes SLURM batch scripts running a pipeline command as an array job, one task per unit of work."""
+
+import logging
+import shlex
+
+logger = logging.getLogger(__name__)
+
+SBATCH_TIME = "12:00:00"
+SBATCH_CPUS_PER_TASK = 8
+SBATCH_MEM_PER_CPU = "8G"
+TASK_ID = "$SLURM_ARRAY_TASK_ID"  # Expanded by the shell to the index of each array task.
+
+ARRAY_TEMPLATE = """#!/bin/bash
+#
+# {description}
+#
+# Submit with:
+#   {submit}
+#
+#SBATCH --job-name={job_name}
+#SBATCH --array=0-{last_task}
+#SBATCH --time={time}
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cpus_per_task}
+#SBATCH --mem-per-cpu={mem_per_cpu}
+#SBATCH --output={log_path}/{job_name}-%A_%a.out
+
+{command} {task_args}
+"""
+
+
+def quote(args):
+    return " ".join(shlex.quote(str(arg)) for arg in args)
+
+
+def cli_command(layout, *args):
+    """The `2p` command line running `args` on the acquisition of `layout`, with the same stage roots.
+
+    Each task then prefetches its inputs into the stage roots and writes its outputs back, so the
+    stages must be written back to the base path before the job starts.
+    """
+    command = ["2p", "--base-path", layout.base_path, "--acquisition", layout.acquisition]
+    for stage, root in sorted(layout.stage_roots.items()):
+        command += ["--stage-root", f"{stage}={root}"]
+    return quote(command + list(args))
+
+
+def write_array_script(
+    path,
+    job_name,
+    command,
+    task_args,
+    num_tasks,
+    log_path,
+    description="",
+    then=None,
+    time=SBATCH_TIME,
+    cpus_per_task=SBATCH_CPUS_PER_TASK,
+    mem_per_cpu=SBATCH_MEM_PER_CPU,
+):
+    """Write an sbatch script running `command task_args` for each of `num_tasks` array tasks.
+
+    `task_args` may refer to the task index with TASK_ID.  If a `then` command is given, the
+    suggested submission runs it once all array tasks have succeeded.
+    """
+    submit = "sbatch %s" % shlex.quote(str(path))
+    if then is not None:
+        submit = "jobid=$(sbatch --parsable %s) && sbatch --dependency=afterok:$jobid --wrap %s" % (
+            shlex.quote(str(path)),
+            shlex.quote(then),
+        )
+    path.write_text(
+        ARRAY_TEMPLATE.format(
+            description=description,
+            submit=submit,
+            job_name=job_name,
+            last_task=num_tasks - 1,
+            time=time,
+            cpus_per_task=cpus_per_task,
+            mem_per_cpu=mem_per_cpu,
+            log_path=log_path,
+            command=command,
+            task_args=task_args,
+        )
+    )
+    path.chmod(0o755)
+    logger.info("Wrote SLURM array script %s, submit with:\n%s", path, submit)
+    return submit
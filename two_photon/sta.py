@@ -0,0 +1,181 @@
+"""Stim-triggered average movies, computed in one streaming pass over the preprocessed data.
+
+Each stim is aligned to the time point of the frame it starts in.  For every offset in a
+window of time points around the stims, the sum and sum of squares of the frames at that
+offset are accumulated per stim type, so memory is O(window x frame) however many stims there
+are.  The output holds the mean and standard error (SEM) movie of each stim type:
+
+- <type>/mean, <type>/sem: (window, z, y, x) float32, with <type>.attrs["count"] stims.
+- offsets: (window,) time point offsets from the stim of each entry of the window.
+"""
+
+import logging
+
+import click
+import h5py
+import numpy as np
+import pandas as pd
+
+from two_photon import artefact_index, storage, utils
+
+logger = logging.getLogger(__name__)
+
+BLOCK_TIMEPOINTS = 32  # Time points read at once.
+ALL_STIMS = "all"  # Stim type of every stim, when no stim types are given.
+
+
+class STAError(Exception):
+    """Error while computing stim-triggered averages."""
+
+
+@click.command()
+@click.pass_obj
+@click.option("--pre-frames", type=int, default=10, show_default=True, help="Time points in the window before stims.")
+@click.option(
+    "--post-frames", type=int, default=30, show_default=True, help="Time points in the window from stims on."
+)
+@click.option(
+    "--stim-types",
+    "stim_types_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="CSV file with a 'type' column giving the type of each stim, in order.  Default: one type for all stims.",
+)
+def sta(layout, pre_frames, post_frames, stim_types_path):
+    """Computes stim-triggered average movies of the preprocessed data."""
+    preprocess_path = storage.find(layout.preprocess_h5_path())
+    artefacts_path = layout.artefacts_path()
+    sta_path = layout.sta_h5_path()
+
+    params = artefact_index.read_params(artefacts_path)
+    if params.get("artefact_source") == "image":
+        # Artefacts detected from the images come without frame or stim windows.
+        df_artefacts = artefact_index.read_table(artefacts_path)
+    else:
+        df_frames = artefact_index.read_table(artefacts_path, "frames")
+        df_stims = artefact_index.read_table(artefacts_path, "stims")
+    stim_types = None
+    if stim_types_path is not None:
+        stim_types = pd.read_csv(stim_types_path)["type"].astype(str).values
+
+    with storage.open_store(preprocess_path, "r") as store:
+        data = store["data"]
+        if params.get("artefact_source") == "image":
+            onsets = artefact_onsets(df_artefacts)
+        else:
+            onsets = stim_onsets(df_frames, df_stims, data.shape[1], params.get("piezo_period_frames"))
+        accumulators = accumulate(data, onsets, stim_types, pre_frames, post_frames)
+
+    sta_path.parent.mkdir(parents=True, exist_ok=True)
+    write(sta_path, accumulators, pre_frames, post_frames)
+    logger.info("Stored stim-triggered averages in %s", sta_path)
+
+
+def stim_onsets(df_frames, df_stims, num_z, piezo_period_frames=None):
+    """Time point of the frame each stim starts in, or -1 for stims before the first frame."""
+    frame = np.searchsorted(df_frames["start"].values, df_stims["start"].values, side="right") - 1
+    frames_per_timepoint = num_z if piezo_period_frames is None else piezo_period_frames
+    return np.where(frame >= 0, frame // frames_per_timepoint, -1)
+
+
+def artefact_onsets(df_artefacts):
+    """Time point of the first artefact of each stim of an artefact table, for stims located without stim windows.
+
+    Only stims which left an artefact are found, so stim types must be given for these alone.
+    """
+    return df_artefacts.groupby("stim")["t"].min().values.astype(np.int64)
+
+
+class STAccumulator:
+    """Running sums and sums of squares of the frames at each offset of a window around stims.
+
+    Parameters
+    ----------
+    onsets: array of int
+        Time point of each stim, all of whose windows fit in the data.
+    num_timepoints: int
+        Number of time points of the data.
+    pre_frames, post_frames: int
+        The window spans time points [onset - pre_frames, onset + post_frames).
+    frame_shape: tuple of int
+        Shape (z, y, x) of a time point.
+    """
+
+    def __init__(self, onsets, num_timepoints, pre_frames, post_frames, frame_shape):
+        self.offsets = np.arange(-pre_frames, post_frames)
+        self.count = len(onsets)
+        self.stims_at = np.bincount(onsets, minlength=num_timepoints)  # Number of stims at each time point.
+        self.sum = np.zeros((len(self.offsets),) + tuple(frame_shape), dtype=np.float64)
+        self.sum_sq = np.zeros_like(self.sum)
+
+    def update(self, t_start, block):
+        """Add a (t, z, y, x) block of the data starting at time point t_start."""
+        # weights[o, t]: number of stims whose frame at offset o is time point t_start + t.
+        onset = t_start + np.arange(len(block))[np.newaxis, :] - self.offsets[:, np.newaxis]
+        valid = (onset >= 0) & (onset < len(self.stims_at))
+        weights = np.where(valid, self.stims_at[np.clip(onset, 0, len(self.stims_at) - 1)], 0).astype(np.float64)
+        if not weights.any():
+            return
+        used = weights.any(axis=0)
+        weights, block = weights[:, used], block[used].astype(np.float64)
+        self.sum += np.tensordot(weights, block, axes=1)
+        self.sum_sq += np.tensordot(weights, block ** 2, axes=1)
+
+    @property
+    def mean(self):
+        return self.sum / self.count
+
+    @property
+    def sem(self):
+        """Standard error of the mean, from the sample variance over stims."""
+        if self.count < 2:
+            return np.full_like(self.sum, np.nan)
+        var = np.maximum(self.sum_sq / self.count - self.mean ** 2, 0) * self.count / (self.count - 1)
+        return np.sqrt(var / self.count)
+
+
+def accumulate(data, onsets, stim_types=None, pre_frames=10, post_frames=30):
+    """Accumulate the windows around stims of (t, z, y, x) data in one pass, returning accumulators by stim type.
+
+    Stims whose windows do not fit in the data are skipped.
+    """
+    num_timepoints = data.shape[0]
+    if stim_types is None:
+        stim_types = np.full(len(onsets), ALL_STIMS)
+    if len(stim_types) != len(onsets):
+        raise STAError("Got %d stim types for %d stims" % (len(stim_types), len(onsets)))
+
+    fits = (onsets - pre_frames >= 0) & (onsets + post_frames <= num_timepoints)
+    if not fits.all():
+        logger.warning("Skipping %d of %d stims whose windows do not fit in the data", (~fits).sum(), len(onsets))
+    accumulators = {}
+    for stim_type in np.unique(stim_types[fits]):
+        type_onsets = onsets[fits & (stim_types == stim_type)]
+        accumulators[stim_type] = STAccumulator(type_onsets, num_timepoints, pre_frames, post_frames, data.shape[1:])
+        logger.info("Averaging %d stims of type %s", len(type_onsets), stim_type)
+    if not accumulators:
+        raise STAError("No stims with windows that fit in the data")
+
+    # Only the time points within a window of some stim are read.
+    t_first = int(onsets[fits].min()) - pre_frames
+    t_last = int(onsets[fits].max()) + post_frames
+    for t_start, t_stop in utils.blocks(t_last - t_first, BLOCK_TIMEPOINTS):
+        t_start, t_stop = t_start + t_first, t_stop + t_first
+        block = data[t_start:t_stop]
+        for accumulator in accumulators.values():
+            accumulator.update(t_start, block)
+        logger.info("Accumulated time points %d-%d of %d-%d", t_start, t_stop, t_first, t_last)
+    return accumulators
+
+
+def write(path, accumulators, pre_frames, post_frames):
+    """Store the mean and SEM movies of each stim type in an hdf5 file."""
+    with h5py.File(path, "w") as h5file:
+        h5file.attrs["pre_frames"] = pre_frames
+        h5file.attrs["post_frames"] = post_frames
+        h5file.create_dataset("offsets", data=np.arange(-pre_frames, post_frames))
+        for stim_type, accumulator in accumulators.items():
+            group = h5file.create_group(str(stim_type))
+            group.attrs["count"] = accumulator.count
+            chunks = (1, 1) + accumulator.sum.shape[2:]
+            group.create_dataset("mean", data=accumulator.mean.astype(np.float32), chunks=chunks)
+            group.create_dataset("sem", data=accumulator.sem.astype(np.float32), chunks=chunks)
@@ -0,0 +1,181 @@
+"""Stages kept in fast local storage, prefetched from and written back to the base path.
+
+A stage given its own root (`2p --stage-root convert=$TMPDIR`) is read and written there, such
+as on a node-local SSD, rather than under the shared base path.  Its data already under the
+base path is prefetched into the root in the background when the run starts, and commands
+wait only for the prefetch of their own inputs and outputs.  Once a command finishes, its output stages
+are copied back to the base path in the background, with each file checked against a
+checksum of its source.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+
+import h5py
+
+logger = logging.getLogger(__name__)
+
+COPY_WORKERS = 4  # Number of stages copied at once.
+COPY_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+class StagingError(Exception):
+    """Error raised if prefetching or writing back a stage fails."""
+
+
+def copy_verified(src, dst):
+    """Copy a file, then check the copy against a checksum of the source, returning the bytes copied.
+
+    The copy is written under a temporary name and renamed, so an interrupted copy is never
+    mistaken for a complete one.
+    """
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    src_hash = hashlib.blake2b()
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+        for chunk in iter(lambda: fin.read(COPY_CHUNK_BYTES), b""):
+            src_hash.update(chunk)
+            fout.write(chunk)
+
+    dst_hash = hashlib.blake2b()
+    with open(tmp, "rb") as fin:
+        for chunk in iter(lambda: fin.read(COPY_CHUNK_BYTES), b""):
+            dst_hash.update(chunk)
+    if src_hash.digest() != dst_hash.digest():
+        tmp.unlink()
+        raise StagingError("Checksum of copy %s does not match %s" % (dst, src))
+
+    shutil.copystat(src, tmp)
+    num_bytes = tmp.stat().st_size
+    tmp.rename(dst)
+    return num_bytes
+
+
+def check_vds(path, root):
+    """Raise StagingError if a virtual dataset of the hdf5 file at `path`, under `root`, would break once written back.
+
+    Sources under the root must be referred to by relative paths, which move along with the
+    file, and sources elsewhere by absolute paths, which stay put.  HDF5 reads missing sources
+    as fill values, so a broken virtual dataset would otherwise go unnoticed.
+    """
+    root = pathlib.Path(root).resolve()
+    names = []
+
+    def collect(_, obj):
+        if isinstance(obj, h5py.Dataset) and obj.is_virtual:
+            names.extend(vmap.file_name for vmap in obj.virtual_sources())
+
+    with h5py.File(path, "r") as h5file:
+        h5file.visititems(collect)
+    for name in set(names) - {"."}:  # "." is the file itself.
+        source = (path.parent / name).resolve()
+        if os.path.isabs(name) == (root in source.parents):
+            raise StagingError(
+                "Virtual dataset in %s refers to %s, which will not be found once written back" % (path, name)
+            )
+
+
+def sync_tree(src_path, dst_path, vds_root=None):
+    """Copy the files under src_path missing from dst_path, or differing in size or time, returning bytes copied.
+
+    If `vds_root` is given, hdf5 files are checked with `check_vds` before they are copied.
+    """
+    num_bytes = 0
+    for src in sorted(src_path.rglob("*")):
+        dst = dst_path / src.relative_to(src_path)
+        if src.is_dir():
+            dst.mkdir(parents=True, exist_ok=True)
+            continue
+        src_stat = src.stat()
+        if dst.exists():
+            dst_stat = dst.stat()
+            if dst_stat.st_size == src_stat.st_size and int(dst_stat.st_mtime) == int(src_stat.st_mtime):
+                continue
+        if vds_root is not None and src.suffix == ".h5" and h5py.is_hdf5(src):
+            check_vds(src, vds_root)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        num_bytes += copy_verified(src, dst)
+    return num_bytes
+
+
+class Staging:
+    """Prefetches and writes back the stages of a Layout which have their own roots.
+
+    Parameters
+    ----------
+    layout: Layout object
+        Object used to determine path naming, whose stage_roots are staged.
+    write_back: bool
+        Whether to copy finished stages back to the base path.
+    workers: int
+        Number of stages copied at once.
+    """
+
+    def __init__(self, layout, write_back=True, workers=COPY_WORKERS):
+        self.layout = layout
+        self.write_back_stages = write_back
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="staging")
+        self.prefetches = {}
+        self.write_backs = []
+        self.locks = {stage: threading.Lock() for stage in layout.stage_roots}
+
+    def prefetch(self):
+        """Start copying the stages with their own roots from the base path, where they exist there."""
+        for stage in self.layout.stage_roots:
+            base_path = self.layout.base_path_of(stage)
+            if base_path.exists():
+                logger.info("Prefetching %s from %s", stage, base_path)
+                self.prefetches[stage] = self.executor.submit(self._sync, stage, base_path, self.layout.path(stage))
+
+    def wait_for(self, stages):
+        """Wait for the prefetch of the given stages, raising StagingError if one failed."""
+        for stage in stages:
+            future = self.prefetches.get(stage)
+            if future is None:
+                continue
+            if not future.done():
+                logger.info("Waiting for prefetch of %s", stage)
+            try:
+                future.result()
+            except Exception as exc:
+                raise StagingError("Prefetch of %s failed: %s" % (stage, exc)) from exc
+
+    def write_back(self, stage):
+        """Start copying a finished stage back to the base path, if it has its own root."""
+        if stage not in self.layout.stage_roots or not self.write_back_stages:
+            return
+        logger.info("Queuing write-back of %s to %s", stage, self.layout.base_path_of(stage))
+        future = self.executor.submit(
+            self._sync, stage, self.layout.path(stage), self.layout.base_path_of(stage), self.layout.root_of(stage)
+        )
+        self.write_backs.append((stage, future))
+
+    def _sync(self, stage, src_path, dst_path, vds_root=None):
+        # Copies of the same stage run in turn, so a second write-back never races the first.
+        with self.locks[stage]:
+            start = time.time()
+            num_bytes = sync_tree(src_path, dst_path, vds_root)
+            elapsed = time.time() - start
+            logger.info("Copied %.1f MB of %s to %s in %.1f seconds", num_bytes / 1e6, stage, dst_path, elapsed)
+            return num_bytes
+
+    def wait(self):
+        """Wait for all write-backs, logging the status of each, and raise StagingError if any failed."""
+        if self.write_backs:
+            logger.info("Waiting for %d write-backs", sum(not future.done() for _, future in self.write_backs))
+        self.executor.shutdown(wait=True)
+        failed = []
+        for stage, future in self.write_backs:
+            exc = future.exception()
+            if exc is None:
+                logger.info("Write-back of %s done", stage)
+            else:
+                logger.error("Write-back of %s failed: %s", stage, exc)
+                failed.append(stage)
+        if failed:
+            raise StagingError("Write-back failed for stages: %s" % ", ".join(failed))
@@ -0,0 +1,123 @@
+"""Summary statistics accumulated while movies stream through convert and preprocess.
+
+The statistics are stored in a "stats" group alongside the "data" array, so downstream
+consumers (QA, frame server, notebooks) never need to re-scan the full movie:
+
+- stats/mean, stats/std, stats/min, stats/max: (z, y, x) images per z-plane, over time.
+- stats/frame_mean: (t, z) mean intensity of every frame.
+"""
+
+import numpy as np
+
+GROUP = "stats"
+IMAGES = ["mean", "std", "min", "max"]
+
+
+class SummaryStats:
+    """Online per-plane mean/std/min/max images and per-frame mean intensity.
+
+    The mean and variance are updated per block of time points using the parallel form of
+    Welford's algorithm (Chan et al.), which is numerically stable and needs one pass.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.frame_mean = []
+
+    def update(self, block):
+        """Add a (t, z, y, x) block of consecutive time points."""
+        block_count = block.shape[0]
+        if block_count == 0:
+            return
+        if self.count == 0:
+            shape = block.shape[1:]
+            self.mean = np.zeros(shape, dtype=np.float64)
+            self.m2 = np.zeros(shape, dtype=np.float64)
+            self.min = block.min(axis=0)
+            self.max = block.max(axis=0)
+        else:
+            self.min = np.minimum(self.min, block.min(axis=0))
+            self.max = np.maximum(self.max, block.max(axis=0))
+
+        count = self.count + block_count
+        frame_mean = np.empty(block.shape[:2], dtype=np.float32)
+        # One plane at a time, to bound the float64 temporaries to a single plane of the block.
+        for z in range(block.shape[1]):
+            plane = block[:, z].astype(np.float64)
+            frame_mean[:, z] = plane.mean(axis=(1, 2))
+            plane_mean = plane.mean(axis=0)
+            plane -= plane_mean
+            plane_m2 = np.einsum("tyx,tyx->yx", plane, plane)
+
+            delta = plane_mean - self.mean[z]
+            self.mean[z] += delta * (block_count / count)
+            self.m2[z] += plane_m2 + delta ** 2 * (self.count * block_count / count)
+        self.frame_mean.append(frame_mean)
+        self.count = count
+
+    def merge(self, other):
+        """Combine with statistics of the time points following those seen so far."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            self.min, self.max, self.frame_mean = other.min, other.max, list(other.frame_mean)
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.frame_mean = self.frame_mean + other.frame_mean
+        self.count = count
+
+    @property
+    def std(self):
+        """Population standard deviation over time, per pixel."""
+        return np.sqrt(self.m2 / self.count)
+
+    def write(self, store):
+        """Store the statistics in the `stats` group of an open storage.Store."""
+        store.delete(GROUP)
+        store.create(GROUP + "/mean", data=self.mean.astype(np.float32))
+        store.create(GROUP + "/std", data=self.std.astype(np.float32))
+        store.create(GROUP + "/min", data=self.min)
+        store.create(GROUP + "/max", data=self.max)
+        store.create(GROUP + "/frame_mean", data=np.concatenate(self.frame_mean))
+        # Zarr attributes are JSON, so use a python int.
+        store[GROUP].attrs["count"] = int(self.count)
+
+
+def read(store, name):
+    """Read one statistic from an open storage.Store, or None if it was not stored."""
+    path = GROUP + "/" + name
+    if path not in store:
+        return None
+    return store[path][...]
+
+
+def load(store):
+    """Read the statistics stored in an open storage.Store back into a SummaryStats, for merging."""
+    summary = SummaryStats()
+    summary.count = int(store[GROUP].attrs["count"])
+    summary.mean = store[GROUP + "/mean"][...].astype(np.float64)
+    summary.m2 = store[GROUP + "/std"][...].astype(np.float64) ** 2 * summary.count
+    summary.min = store[GROUP + "/min"][...]
+    summary.max = store[GROUP + "/max"][...]
+    summary.frame_mean = [store[GROUP + "/frame_mean"][...]]
+    return summary
+
+
+def copy(src, dst):
+    """Copy the statistics, if any, from one open storage.Store to another."""
+    if GROUP not in src:
+        return
+    dst.delete(GROUP)
+    for name in IMAGES + ["frame_mean"]:
+        dst.create(GROUP + "/" + name, data=src[GROUP + "/" + name][...])
+    dst[GROUP].attrs["count"] = int(src[GROUP].attrs["count"])
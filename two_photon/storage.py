@@ -0,0 +1,193 @@
+"""Storage backends for image data: single-file HDF5, or Zarr directory stores.
+
+HDF5 serializes writes to a file, so only one process can write at a time.  Zarr stores each
+chunk as a separate file, so chunks can be written independently by several processes.  Both
+hold the same named arrays ("data", and "stats/..." from the stats module) and are used through
+the same small interface.  Suite2p reads HDF5 only, so zarr outputs are exported to HDF5 for it.
+"""
+
+import abc
+import logging
+import os
+import shutil
+
+import click
+import h5py
+
+from two_photon import utils
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ["hdf5", "zarr"]
+SUFFIXES = {"hdf5": ".h5", "zarr": ".zarr"}
+EXPORT_BLOCK_TIMEPOINTS = 64  # Time points copied at once when exporting to hdf5.
+
+
+class StorageError(Exception):
+    """Error while accessing stored image data."""
+
+
+class Store(abc.ABC):
+    """Named arrays in an open hdf5 file or zarr group.
+
+    Arrays are accessed with `store[name]`, which supports numpy-style slicing in both backends.
+    """
+
+    backend = None
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.root[name]
+
+    def __contains__(self, name):
+        return name in self.root
+
+    @property
+    def attrs(self):
+        return self.root.attrs
+
+    def delete(self, name):
+        if name in self.root:
+            del self.root[name]
+
+    @abc.abstractmethod
+    def create(self, name, shape=None, dtype=None, chunks=None, data=None):
+        """Create a named array, given its shape and dtype, or its data."""
+
+    def close(self):
+        pass
+
+
+class HDF5Store(Store):
+    backend = "hdf5"
+
+    def create(self, name, shape=None, dtype=None, chunks=None, data=None):
+        return self.root.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks, data=data)
+
+    def close(self):
+        self.root.close()
+
+
+class ZarrStore(Store):
+    backend = "zarr"
+
+    def create(self, name, shape=None, dtype=None, chunks=None, data=None):
+        # zarr>=3 renamed create_dataset to create_array.
+        create = getattr(self.root, "create_array", None) or self.root.create_dataset
+        if data is not None:
+            return create(name, data=data, chunks=chunks or data.shape)
+        return create(name, shape=shape, dtype=dtype, chunks=chunks)
+
+
+def storage_option(func):
+    """Click option selecting the storage backend of a command's image outputs."""
+    return click.option(
+        "--storage",
+        "backend",
+        type=click.Choice(BACKENDS),
+        default="hdf5",
+        show_default=True,
+        help="Storage for image outputs.  Zarr writes chunks independently, allowing parallel writers.",
+    )(func)
+
+
+def backend_of(path):
+    """Name of the backend used for a path, based on its suffix."""
+    for backend, suffix in SUFFIXES.items():
+        if path.suffix == suffix:
+            return backend
+    raise StorageError("Cannot determine storage backend of %s, expected suffix in: %s" % (path, SUFFIXES))
+
+
+def with_backend(path, backend):
+    """The path for storing `path` (given with any backend's suffix) using `backend`."""
+    if backend not in SUFFIXES:
+        raise StorageError("Unknown storage backend %s, expected one of: %s" % (backend, ", ".join(BACKENDS)))
+    return path.with_suffix(SUFFIXES[backend])
+
+
+def find(path):
+    """Locate existing data stored at `path` with any backend, preferring the given suffix."""
+    candidates = [path] + [with_backend(path, backend) for backend in BACKENDS]
+    for candidate in candidates:
+        if candidate.exists():
+            return candidate
+    raise StorageError("No stored data found for %s (tried: %s)" % (path, ", ".join(str(c) for c in candidates)))
+
+
+def remove(path):
+    """Remove data stored at `path` with any backend."""
+    for backend in BACKENDS:
+        candidate = with_backend(path, backend)
+        if candidate.is_symlink() or candidate.is_file():
+            logger.warning("Removing existing image data: %s", candidate)
+            candidate.unlink()
+        elif candidate.is_dir():
+            logger.warning("Removing existing image data: %s", candidate)
+            shutil.rmtree(candidate)
+
+
+def vds_source_path(source_path, vds_path):
+    """Name of a source file as stored in the hdf5 virtual dataset (VDS) file at vds_path.
+
+    The name is relative to the directory of the VDS file, where HDF5 looks for relative
+    sources, so the files can be moved or copied together.  An absolute name would keep
+    pointing at the old location, which HDF5 reads as fill values once it is gone.
+    """
+    return os.path.relpath(os.path.abspath(source_path), os.path.dirname(os.path.abspath(vds_path)))
+
+
+def open_store(path, mode="r"):
+    """Open an hdf5 file or zarr directory store.  Mode is as for h5py.File."""
+    backend = backend_of(path)
+    if backend == "hdf5":
+        return HDF5Store(h5py.File(path, mode), path)
+
+    # Load zarr only when needed, as it is an optional dependency.
+    import zarr
+
+    return ZarrStore(zarr.open_group(str(path), mode=mode), path)
+
+
+def export_hdf5(src_path, dst_path, key="data"):
+    """Copy the `key` array (and stats) of a store into an hdf5 file, block by block."""
+    from two_photon import stats  # Imported here, as stats uses this module.
+
+    logger.info("Exporting %s to %s", src_path, dst_path)
+    with open_store(src_path, "r") as src, open_store(dst_path, "w") as dst:
+        data = src[key]
+        out = dst.create(key, shape=data.shape, dtype=data.dtype, chunks=(1, 1) + data.shape[2:])
+        for t_start, t_stop in utils.blocks(data.shape[0], EXPORT_BLOCK_TIMEPOINTS):
+            out[t_start:t_stop] = data[t_start:t_stop]
+        stats.copy(src, dst)
+
+
+@click.command()
+@click.pass_obj
+@click.option(
+    "--stage",
+    type=click.Choice(["convert", "preprocess"]),
+    default="preprocess",
+    show_default=True,
+    help="Which stage's output to export.",
+)
+def export(layout, stage):
+    """Export zarr output of a stage to the hdf5 file expected by later stages and Suite2p."""
+    h5_path = layout.orig_h5_path() if stage == "convert" else layout.preprocess_h5_path()
+    zarr_path = with_backend(h5_path, "zarr")
+    if not zarr_path.exists():
+        raise StorageError("No zarr output to export at %s" % zarr_path)
+    if h5_path.exists():
+        logger.warning("Removing existing hdf5 image file: %s", h5_path)
+        h5_path.unlink()
+    export_hdf5(zarr_path, h5_path)
+    logger.info("Done")
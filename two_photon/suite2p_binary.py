@@ -0,0 +1,168 @@
+"""Suite2p's per-plane binary movie layout, written directly by preprocess.
+
+Suite2p registers movies stored as one raw int16 binary file per z-plane, with frames of
+(Ly, Lx) pixels written one after another.  Given hdf5 input, it first converts the whole
+movie to that layout.  Writing the binaries while preprocessing skips that full read and
+write of the data, and `analyze --input-format binary` hands them to Suite2p directly.
+"""
+
+import logging
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RAW_FILE = "data_raw.bin"  # Name of Suite2p's unregistered binary, when keep_movie_raw is set.
+REG_FILE = "data.bin"  # Name of Suite2p's registered binary.
+OPS_FILE = "ops.npy"
+
+
+class Suite2pBinaryError(Exception):
+    """Error while writing or using Suite2p binary files."""
+
+
+def to_int16(frames):
+    """Convert frames to Suite2p's int16 binary type, halving uint16 data as Suite2p does."""
+    if frames.dtype == np.uint16:
+        return (frames // 2).astype(np.int16)
+    return frames.astype(np.int16)
+
+
+def plane_dir(path, z):
+    return path / f"plane{z}"
+
+
+class BinaryWriter:
+    """Writes blocks of (t, z, y, x) data into Suite2p per-plane binary files under `path`.
+
+    The files are allocated up front, and blocks are written at their offsets, so blocks can be
+    written in any order and by several processes.  The writer only holds paths, so it can be
+    sent to worker processes.
+
+    Parameters
+    ----------
+    path: pathlib.Path
+        Directory which will hold one planeN directory per z-plane.
+    shape: tuple of int
+        Shape (t, z, y, x) of the full movie.
+    """
+
+    def __init__(self, path, shape):
+        self.path = path
+        self.shape = tuple(shape)
+
+    @property
+    def frame_bytes(self):
+        return self.shape[2] * self.shape[3] * np.dtype(np.int16).itemsize
+
+    def raw_file(self, z):
+        return plane_dir(self.path, z) / RAW_FILE
+
+    def create(self):
+        """Remove any previous binaries and allocate the files."""
+        if self.path.exists():
+            logger.warning("Removing existing Suite2p binaries: %s", self.path)
+            shutil.rmtree(self.path)
+        for z in range(self.shape[1]):
+            plane_dir(self.path, z).mkdir(parents=True)
+            with open(self.raw_file(z), "wb") as fout:
+                fout.truncate(self.shape[0] * self.frame_bytes)
+
+    def write(self, t_start, block):
+        """Write a (t, z, y, x) block of consecutive time points starting at t_start."""
+        for z in range(block.shape[1]):
+            with open(self.raw_file(z), "r+b") as fout:
+                fout.seek(t_start * self.frame_bytes)
+                fout.write(to_int16(block[:, z]).tobytes())
+
+    def write_ops(self, mean_image):
+        """Write each plane's ops.npy, given the (z, y, x) mean image of the uint16 movie."""
+        num_t, num_z, num_y, num_x = self.shape
+        for z in range(num_z):
+            raw_file = str(self.raw_file(z))
+            ops = {
+                "Ly": num_y,
+                "Lx": num_x,
+                "nframes": num_t,
+                "nplanes": num_z,
+                "nchannels": 1,
+                "iplane": z,
+                "frames_per_folder": np.array([num_t]),
+                "meanImg": (mean_image[z] / 2).astype(np.float32),  # In the halved units of the binary.
+                "raw_file": raw_file,
+                "reg_file": raw_file,
+            }
+            np.save(plane_dir(self.path, z) / OPS_FILE, ops)
+
+
+def load_ops(path):
+    """Load the per-plane ops written by `BinaryWriter.write_ops`, in plane order."""
+    ops = []
+    z = 0
+    while (plane_dir(path, z) / OPS_FILE).exists():
+        ops.append(np.load(plane_dir(path, z) / OPS_FILE, allow_pickle=True).item())
+        z += 1
+    if not ops:
+        raise Suite2pBinaryError("No Suite2p binaries found in %s, run preprocess with --suite2p-binary" % path)
+    return ops
+
+
+def prepare_analysis(binary_paths, save_path, params, plane=None):
+    """Set up Suite2p plane directories so `run_s2p` with input_format "binary" uses the given binaries.
+
+    Each plane's ops point Suite2p at the preprocessed binary as the raw movie, with the
+    registered movie written to the plane directory.  With several acquisitions, their
+    binaries are concatenated into the plane directory first.
+
+    Parameters
+    ----------
+    binary_paths: list of pathlib.Path
+        Binary directories of each acquisition, in order.
+    save_path: pathlib.Path
+        Suite2p output directory, i.e. save_path0 / save_folder.
+    params: dict
+        Suite2p parameters, which override the stored ops.
+    plane: int, optional
+        Set up only this z-plane, as plane0 of `save_path`, to run Suite2p on it alone.
+    """
+    acquisitions = [load_ops(path) for path in binary_paths]
+    num_planes = len(acquisitions[0])
+    first = acquisitions[0][0]
+    for path, acq_ops in zip(binary_paths, acquisitions):
+        if len(acq_ops) != num_planes or (acq_ops[0]["Ly"], acq_ops[0]["Lx"]) != (first["Ly"], first["Lx"]):
+            raise Suite2pBinaryError("Binaries in %s do not match the shape of those in %s" % (path, binary_paths[0]))
+
+    for z in range(num_planes) if plane is None else [plane]:
+        plane_ops = [acq_ops[z] for acq_ops in acquisitions]
+        out_dir = plane_dir(save_path, z if plane is None else 0)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        frames_per_folder = np.array([o["nframes"] for o in plane_ops])
+        if len(plane_ops) == 1:
+            raw_file = plane_ops[0]["raw_file"]
+        else:
+            raw_file = str(out_dir / RAW_FILE)
+            logger.info("Concatenating binaries of plane %d into %s", z, raw_file)
+            with open(raw_file, "wb") as fout:
+                for o in plane_ops:
+                    with open(o["raw_file"], "rb") as fin:
+                        shutil.copyfileobj(fin, fout)
+
+        weights = frames_per_folder / frames_per_folder.sum()
+        ops = {
+            **plane_ops[0],
+            **params,
+            "nframes": int(frames_per_folder.sum()),
+            "frames_per_folder": frames_per_folder,
+            "meanImg": sum(w * o["meanImg"] for w, o in zip(weights, plane_ops)).astype(np.float32),
+            "raw_file": raw_file,
+            "reg_file": str(out_dir / REG_FILE),
+            "keep_movie_raw": True,  # Registration reads raw_file and writes reg_file.
+            "save_path": str(out_dir),
+            "ops_path": str(out_dir / OPS_FILE),
+        }
+        if plane is not None:
+            ops.update(iplane=0, nplanes=1)
+        np.save(out_dir / OPS_FILE, ops)
+    return num_planes
@@ -0,0 +1,194 @@
+"""Index of the individual Bruker OME TIFF files making up an acquisition.
+
+Bruker writes a master OME TIFF whose OME-XML mis-specifies the time dimension, which is why
+`correct_omexml` exists.  The acquisition XML written alongside the RAWDATA already lists,
+for each Sequence/Frame, the file (and page) holding each channel's image.  This module builds
+a (t, z) -> (file, page) index from that XML so frames can be read directly, without
+rewriting any OME-XML.
+"""
+
+import logging
+from xml.etree import ElementTree
+
+import numpy as np
+import tifffile
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+
+class TiffIndexError(Exception):
+    """Error while building or reading the TIFF frame index."""
+
+
+class TiffIndex:
+    """Mapping from (t, z) frame coordinates to the TIFF file and page storing that frame.
+
+    Attributes
+    ----------
+    files: np.ndarray of str
+        Basenames of the TIFF files, relative to the tiff directory.
+    file_index: np.ndarray of int, shape (t, z)
+        Index into `files` for each frame.
+    page: np.ndarray of int, shape (t, z)
+        Zero-based page within the file for each frame.
+    """
+
+    def __init__(self, files, file_index, page):
+        self.files = np.asarray(files, dtype=str)
+        self.file_index = np.asarray(file_index, dtype=np.int32)
+        self.page = np.asarray(page, dtype=np.int32)
+        if self.file_index.shape != self.page.shape or self.file_index.ndim != 2:
+            raise TiffIndexError(
+                "file_index and page must be 2d arrays of the same shape, got %s and %s"
+                % (self.file_index.shape, self.page.shape)
+            )
+
+    @property
+    def shape(self):
+        """Number of (time points, z planes) in the index."""
+        return self.file_index.shape
+
+    @classmethod
+    def from_xml(cls, xml_path, channel):
+        """Build the index from the Bruker acquisition XML for one channel.
+
+        Follows the same Sequence/Frame conventions as `metadata.read`: a single sequence is a
+        T-series with one z-plane, while multiple sequences are one volume each.  A final
+        sequence with fewer frames than the first is dropped.
+        """
+        root = ElementTree.parse(str(xml_path)).getroot()
+        sequences = root.findall("Sequence")
+        if not sequences:
+            raise TiffIndexError("No Sequence elements found in %s" % xml_path)
+
+        channel = str(channel)
+        files = []
+        file_ids = {}
+        entries = []  # One list of (file_id, page) per sequence.
+        for sequence in sequences:
+            seq_entries = []
+            for frame in sequence.findall("Frame"):
+                element = None
+                for candidate in frame.findall("File"):
+                    if candidate.attrib.get("channel") == channel:
+                        element = candidate
+                        break
+                if element is None:
+                    raise TiffIndexError(
+                        "Frame %s of sequence %s has no file for channel %s"
+                        % (frame.attrib.get("index"), sequence.attrib.get("cycle"), channel)
+                    )
+                fname = element.attrib["filename"]
+                if fname not in file_ids:
+                    file_ids[fname] = len(files)
+                    files.append(fname)
+                # Bruker pages are 1-based, and omitted when there is one image per file.
+                page = int(element.attrib.get("page", 1)) - 1
+                seq_entries.append((file_ids[fname], page))
+            entries.append(seq_entries)
+
+        if len(entries) == 1:
+            table = np.array(entries[0], dtype=np.int32).reshape(-1, 1, 2)
+        else:
+            num_z_planes = len(entries[0])
+            if len(entries[-1]) != num_z_planes:
+                logger.warning(
+                    "Skipping final stack because it was found with fewer z-planes (%d, expected: %d).",
+                    len(entries[-1]),
+                    num_z_planes,
+                )
+                entries = entries[:-1]
+            if any(len(seq_entries) != num_z_planes for seq_entries in entries):
+                raise TiffIndexError("Sequences in %s have inconsistent numbers of frames" % xml_path)
+            table = np.array(entries, dtype=np.int32)
+
+        logger.info("Indexed %d tiff files for %d (t, z) frames", len(files), table.shape[0] * table.shape[1])
+        return cls(files, table[..., 0], table[..., 1])
+
+    def with_piezo(self, period_frames, skip_frames):
+        """Index of a piezo z-scan, regrouped into volumes with the flyback frames dropped.
+
+        Frames are taken in acquisition order, and each `period_frames` consecutive frames make
+        up a volume whose first `skip_frames` are taken during the piezo flyback.  A final,
+        incomplete volume is dropped.  Only the index changes, so skipped frames are never read.
+        """
+        if not 0 <= skip_frames < period_frames:
+            raise TiffIndexError(
+                "Piezo skip frames (%s) must be less than the period (%s)" % (skip_frames, period_frames)
+            )
+        file_index = self.file_index.ravel()
+        page = self.page.ravel()
+        num_t = len(file_index) // period_frames
+        if num_t == 0:
+            raise TiffIndexError("Fewer frames (%d) than one piezo period (%d)" % (len(file_index), period_frames))
+        if len(file_index) != num_t * period_frames:
+            logger.warning("Skipping final %d frames of an incomplete piezo period.", len(file_index) % period_frames)
+
+        def regroup(values):
+            return values[: num_t * period_frames].reshape(num_t, period_frames)[:, skip_frames:]
+
+        return TiffIndex(self.files, regroup(file_index), regroup(page))
+
+    def save(self, path):
+        """Persist the index as a small npz file."""
+        np.savez(
+            str(path),
+            version=np.array(INDEX_VERSION),
+            files=self.files,
+            file_index=self.file_index,
+            page=self.page,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by `save`."""
+        with np.load(str(path)) as npz:
+            version = int(npz["version"])
+            if version != INDEX_VERSION:
+                raise TiffIndexError("Unsupported tiff index version %d in %s" % (version, path))
+            return cls(npz["files"], npz["file_index"], npz["page"])
+
+    def locate(self, t, z):
+        """Return the (filename, page) storing frame (t, z)."""
+        return str(self.files[self.file_index[t, z]]), int(self.page[t, z])
+
+    def read_frame(self, tiff_dir, t, z):
+        """Read a single (y, x) frame."""
+        fname, page = self.locate(t, z)
+        with tifffile.TiffFile(str(tiff_dir / fname)) as tif:
+            return tif.pages[page].asarray()
+
+    def read(self, tiff_dir, t_start=0, t_stop=None, executor=None):
+        """Read frames for time points [t_start, t_stop) into a (t, z, y, x) array.
+
+        Files are opened once each, and distinct files are read concurrently when an executor
+        is given.
+        """
+        t_stop = self.shape[0] if t_stop is None else t_stop
+        file_index = self.file_index[t_start:t_stop]
+        page = self.page[t_start:t_stop]
+
+        # Group the requested frames by file, so each file is opened only once.
+        by_file = {}
+        for (t, z), fid in np.ndenumerate(file_index):
+            by_file.setdefault(int(fid), []).append((t, z, int(page[t, z])))
+
+        def read_file(fid):
+            with tifffile.TiffFile(str(tiff_dir / self.files[fid])) as tif:
+                return [(t, z, tif.pages[p].asarray()) for t, z, p in by_file[fid]]
+
+        if executor is None:
+            results = map(read_file, by_file)
+        else:
+            results = executor.map(read_file, by_file)
+
+        data = None
+        for frames in results:
+            for t, z, frame in frames:
+                if data is None:
+                    data = np.empty(file_index.shape + frame.shape, dtype=frame.dtype)
+                data[t, z] = frame
+        return data
+
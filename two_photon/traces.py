@@ -0,0 +1,223 @@
+"""Extracts ROI traces of any acquisition with the ROIs of an existing Suite2p analysis.
+
+The ROIs of each plane (stat.npy) become sparse (ROI x pixel) weight matrices, for the cells
+and for their neuropil, so extracting the traces of a block of frames is two sparse matrix
+products.  The preprocessed movie is streamed in blocks of time points, optionally shifted
+onto the reference image of the analysis first, so a new acquisition of the same field of
+view needs no Suite2p run.  As in Suite2p, dF/F is computed from F - coeff * Fneu, with a
+baseline from a min-max filter of the smoothed trace.
+
+Outputs follow Suite2p, as traces/<acquisition>/planeN/{F,Fneu,dff,iscell}.npy.
+"""
+
+import logging
+import shutil
+
+import click
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+
+from two_photon import analyze, artefact_index, concat, storage, suite2p_binary, utils
+
+logger = logging.getLogger(__name__)
+
+BLOCK_TIMEPOINTS = 256  # Time points read at once.
+PRODUCT_TIMEPOINTS = 16  # Time points per sparse product, so the transposed frames stay in cache.
+NEUROPIL_COEFF = 0.7  # Suite2p's default neuropil coefficient.
+INNER_NEUROPIL_RADIUS = 2  # Pixels between cells and neuropil, as in Suite2p.
+MIN_NEUROPIL_PIXELS = 350  # Pixels in each neuropil mask, as in Suite2p.
+BASELINE_SECS = 60  # Window of the baseline min-max filter, Suite2p's win_baseline.
+BASELINE_SIGMA_FRAMES = 10  # Smoothing of traces before the baseline filter, Suite2p's sig_baseline.
+MAX_SHIFT_FRAC = 0.1  # Largest rigid shift, as a fraction of the frame, Suite2p's maxregshift.
+
+
+class TracesError(Exception):
+    """Error while extracting ROI traces."""
+
+
+@click.command()
+@click.pass_obj
+@click.option(
+    "--roi-acquisition", help="Acquisition whose analyze output holds the ROIs.  Default: the acquisition itself."
+)
+@click.option(
+    "--neuropil-coeff", type=float, default=NEUROPIL_COEFF, show_default=True, help="Neuropil subtracted for dF/F."
+)
+@click.option(
+    "--register/--no-register",
+    "register_frames",
+    default=True,
+    show_default=True,
+    help="Rigidly shift frames onto the reference image of the analysis before extraction.",
+)
+def traces(layout, roi_acquisition, neuropil_coeff, register_frames):
+    """Extracts ROI traces with the ROIs of a Suite2p analysis."""
+    roi_acquisition = roi_acquisition or layout.acquisition
+    roi_path = layout.path("analyze", roi_acquisition) / analyze.SAVE_FOLDER
+    preprocess_path = storage.find(layout.preprocess_h5_path())
+    traces_path = layout.path("traces")
+    info = concat.read_info(layout)
+
+    with storage.open_store(preprocess_path, "r") as store:
+        data = store["data"]
+        num_z, frame_shape = data.shape[1], data.shape[2:]
+        planes = [load_plane(suite2p_binary.plane_dir(roi_path, z), frame_shape, register_frames) for z in range(num_z)]
+        logger.info("Extracting traces of %s ROIs in %s", [len(plane["iscell"]) for plane in planes], roi_path)
+        f_cells, f_neuropil = extract(data, planes)
+
+    fs = 1.0 / (info["frame_period"] * volume_frames(layout, num_z))
+    for z, plane in enumerate(planes):
+        plane_path = suite2p_binary.plane_dir(traces_path, z)
+        plane_path.mkdir(parents=True, exist_ok=True)
+        np.save(plane_path / "F.npy", f_cells[z])
+        np.save(plane_path / "Fneu.npy", f_neuropil[z])
+        np.save(plane_path / "dff.npy", dff(f_cells[z], f_neuropil[z], fs, neuropil_coeff))
+        shutil.copy(suite2p_binary.plane_dir(roi_path, z) / "iscell.npy", plane_path / "iscell.npy")
+    logger.info("Stored traces in %s", traces_path)
+
+
+def volume_frames(layout, num_z):
+    """Frames acquired per time point: the piezo period, including skipped frames, if recorded by preprocess."""
+    artefacts_path = layout.artefacts_path()
+    if artefacts_path.exists():
+        piezo_period_frames = artefact_index.read_params(artefacts_path).get("piezo_period_frames")
+        if piezo_period_frames is not None:
+            return piezo_period_frames
+    return num_z
+
+
+def load_plane(plane_path, frame_shape, register_frames=True):
+    """Load the ROIs of one plane of a Suite2p analysis, as the sparse weights used by `extract`."""
+    stat = np.load(plane_path / "stat.npy", allow_pickle=True)
+    ops = np.load(plane_path / suite2p_binary.OPS_FILE, allow_pickle=True).item()
+    if (ops["Ly"], ops["Lx"]) != tuple(frame_shape):
+        raise TracesError(
+            "ROIs of %s are for frames of %s, not %s" % (plane_path, (ops["Ly"], ops["Lx"]), tuple(frame_shape))
+        )
+    plane = {
+        "cells": cell_weights(stat, frame_shape),
+        "neuropil": neuropil_weights(stat, frame_shape),
+        "iscell": np.load(plane_path / "iscell.npy"),
+        "ref": None,
+    }
+    if register_frames:
+        plane["ref"] = ops["refImg"]
+        plane["max_shift"] = int(ops.get("maxregshift", MAX_SHIFT_FRAC) * max(frame_shape))
+    return plane
+
+
+def cell_weights(stat, frame_shape):
+    """Sparse (ROI x pixel) matrix of normalized cell weights, leaving out pixels shared by ROIs."""
+    rows, cols, weights = [], [], []
+    for num, roi in enumerate(stat):
+        keep = ~roi["overlap"] if "overlap" in roi else slice(None)
+        lam = roi["lam"][keep]
+        rows.append(np.full(len(lam), num))
+        cols.append(np.ravel_multi_index((roi["ypix"][keep], roi["xpix"][keep]), frame_shape))
+        weights.append(lam / lam.sum())
+    return _csr(rows, cols, weights, (len(stat), np.prod(frame_shape)))
+
+
+def neuropil_weights(stat, frame_shape):
+    """Sparse (ROI x pixel) matrix averaging the neuropil around each ROI.
+
+    Masks stored by Suite2p (`neuropil_mask`) are used when present.  Otherwise each mask is the
+    MIN_NEUROPIL_PIXELS pixels nearest the ROI center which are not within INNER_NEUROPIL_RADIUS
+    of any ROI.
+    """
+    rows, cols = [], []
+    if all("neuropil_mask" in roi for roi in stat):
+        cols = [np.asarray(roi["neuropil_mask"]) for roi in stat]
+    else:
+        cell_pix = np.zeros(frame_shape, dtype=bool)
+        for roi in stat:
+            cell_pix[roi["ypix"], roi["xpix"]] = True
+        cell_pix = scipy.ndimage.binary_dilation(cell_pix, iterations=INNER_NEUROPIL_RADIUS).ravel()
+        y, x = np.indices(frame_shape).reshape(2, -1)
+        num_pixels = min(MIN_NEUROPIL_PIXELS, int((~cell_pix).sum()))
+        for roi in stat:
+            dist = (y - np.mean(roi["ypix"])) ** 2 + (x - np.mean(roi["xpix"])) ** 2
+            dist[cell_pix] = np.inf
+            cols.append(np.argpartition(dist, num_pixels - 1)[:num_pixels])
+    rows = [np.full(len(col), num) for num, col in enumerate(cols)]
+    weights = [np.full(len(col), 1.0 / max(len(col), 1)) for col in cols]
+    return _csr(rows, cols, weights, (len(stat), np.prod(frame_shape)))
+
+
+def _csr(rows, cols, weights, shape):
+    if not rows:
+        return scipy.sparse.csr_matrix(shape, dtype=np.float32)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(weights).astype(np.float32), (np.concatenate(rows), np.concatenate(cols))), shape=shape
+    )
+
+
+def rigid_shifts(frames, ref, max_shift):
+    """Integer (y, x) shift of each frame from the reference image, by phase correlation."""
+    num_y, num_x = ref.shape
+    product = np.fft.rfft2(frames) * np.conj(np.fft.rfft2(ref))
+    product /= np.abs(product) + 1e-6
+    corr = np.fft.irfft2(product, s=ref.shape)
+    # Only shifts of up to max_shift, which wrap around the ends of each axis, are allowed.
+    corr[:, max_shift + 1 : num_y - max_shift] = -np.inf
+    corr[:, :, max_shift + 1 : num_x - max_shift] = -np.inf
+    dy, dx = np.unravel_index(corr.reshape(len(frames), -1).argmax(axis=1), ref.shape)
+    return np.where(dy > num_y // 2, dy - num_y, dy), np.where(dx > num_x // 2, dx - num_x, dx)
+
+
+def register(frames, ref, max_shift):
+    """Rigidly shift (t, y, x) frames onto the reference image, returning the shifted frames and their valid pixels.
+
+    Pixels shifted in from beyond the edge of the frame are zero, and False in the boolean mask
+    of valid pixels, rather than wrapped around from the opposite edge.
+    """
+    num_y, num_x = frames.shape[1:]
+    shifted = np.zeros_like(frames)
+    valid = np.zeros(frames.shape, dtype=bool)
+    for num, (dy, dx) in enumerate(zip(*rigid_shifts(frames, ref, max_shift))):
+        dst = slice(max(-dy, 0), num_y + min(-dy, 0)), slice(max(-dx, 0), num_x + min(-dx, 0))
+        src = slice(max(dy, 0), num_y + min(dy, 0)), slice(max(dx, 0), num_x + min(dx, 0))
+        shifted[num][dst] = frames[num][src]
+        valid[num][dst] = True
+    return shifted, valid
+
+
+def extract(data, planes):
+    """Stream (t, z, y, x) data in blocks, returning per-plane (ROI, t) float32 cell and neuropil traces.
+
+    Pixels left without data by registration are left out of each ROI, with the weights of the
+    rest scaled up to match.  A trace is NaN where none of its ROI's pixels have data.
+    """
+    num_t = data.shape[0]
+    # Cell and neuropil weights stacked, so each frame is read once per product.
+    weights = [scipy.sparse.vstack([plane["cells"], plane["neuropil"]]).tocsr() for plane in planes]
+    f_all = [np.empty((w.shape[0], num_t), dtype=np.float32) for w in weights]
+    for t_start, t_stop in utils.blocks(num_t, BLOCK_TIMEPOINTS):
+        block = data[t_start:t_stop]
+        for z, plane in enumerate(planes):
+            frames, valid = block[:, z].reshape(len(block), -1), None
+            if plane["ref"] is not None:
+                frames, valid = register(block[:, z], plane["ref"], plane["max_shift"])
+                frames, valid = frames.reshape(len(block), -1), valid.reshape(len(block), -1)
+            for start, stop in utils.blocks(len(block), PRODUCT_TIMEPOINTS):
+                pixels = frames[start:stop].T.astype(np.float32, order="C")  # (pixel, t)
+                f = weights[z] @ pixels
+                if valid is not None and not valid[start:stop].all():
+                    # Weights of each ROI sum to one, so this is the weight left on valid pixels.
+                    coverage = weights[z] @ valid[start:stop].T.astype(np.float32, order="C")
+                    f = np.divide(f, coverage, out=np.full_like(f, np.nan), where=coverage > 0)
+                f_all[z][:, t_start + start : t_start + stop] = f
+        logger.info("Extracted traces of time points %d-%d of %d", t_start, t_stop, num_t)
+    num_rois = [plane["cells"].shape[0] for plane in planes]
+    return [f[:n] for f, n in zip(f_all, num_rois)], [f[n:] for f, n in zip(f_all, num_rois)]
+
+
+def dff(f_cells, f_neuropil, fs, neuropil_coeff=NEUROPIL_COEFF, baseline_secs=BASELINE_SECS):
+    """dF/F of (ROI, t) traces, against a Suite2p-style maximin baseline of the neuropil-corrected trace."""
+    corrected = f_cells - neuropil_coeff * f_neuropil
+    window = max(int(baseline_secs * fs), 1)
+    baseline = scipy.ndimage.gaussian_filter1d(corrected, BASELINE_SIGMA_FRAMES, axis=1)
+    baseline = scipy.ndimage.minimum_filter1d(baseline, window, axis=1)
+    baseline = scipy.ndimage.maximum_filter1d(baseline, window, axis=1)
+    return (corrected - baseline) / baseline
@@ -1,15 +1,28 @@
 """Library to transform data from ripped TIFF files to HDF5."""
 
+import collections
+import contextlib
+import importlib.util
 import logging
 import os
+import time
 
+import dask
 import dask.array as da
 import h5py
+import numpy as np
 from dask import diagnostics
 
+from two_photon import artefact_index, interpolate, preprocess, storage
+
 logger = logging.getLogger(__name__)
 
 HDF5_KEY = "/data"  # Default key name in Suite2P.
+ZARR_KEY = "data"  # Same array name, for zarr outputs.
+
+SCHEDULERS = ["threads", "processes", "synchronous", "distributed"]
+DEFAULT_CHUNK_FRAMES = 64  # Time points processed together for artefact removal.
+CHUNK_COPIES = 4  # Copies of a chunk held per task: input, overlap, working copy and output.
 
 
 # In python 3.8:
@@ -22,72 +35,293 @@ def unlink(fname):
         pass
 
 
-def convert(data, fname_data, df_artefacts=None, fname_uncorrected=None):
-    """Convert TIFF files from 2p dataset in HDF5.  Optionally create artefact-removed dataset."""
+def convert(
+    data,
+    fname_data,
+    df_artefacts=None,
+    fname_uncorrected=None,
+    scheduler="threads",
+    num_workers=None,
+    chunk_frames=None,
+    memory_limit=None,
+    fill_kernel=interpolate.DEFAULT_FILL_KERNEL,
+):
+    """Convert TIFF files from 2p dataset in HDF5.  Optionally create artefact-removed dataset.
+
+    Parameters
+    ----------
+    data: dask.array, shape (t, z, y, x)
+        Image data to convert.
+    fname_data: pathlib.Path
+        Output hdf5 file, or zarr store if the suffix is ".zarr".  Artefact-removed data if
+        `df_artefacts` is given.
+    df_artefacts: pd.DataFrame or artefact_index.ArtefactIndex, optional
+        Artefacts indexed by frame, with columns z_plane, y_min, y_max, or an index such as one
+        read by `artefact_index.read`.
+    fname_uncorrected: pathlib.Path, optional
+        Output hdf5 file (or zarr store) for uncorrected data, required with `df_artefacts`.
+    scheduler: str
+        One of SCHEDULERS.  "distributed" starts a dask.distributed LocalCluster.
+    num_workers: int, optional
+        Number of worker threads/processes.  Defaults to the number of CPUs.
+    chunk_frames: int, optional
+        Number of time points per chunk.  Defaults to DEFAULT_CHUNK_FRAMES, or to a size
+        derived from `memory_limit` when that is given.
+    memory_limit: int, optional
+        Memory budget in bytes, shared by all workers.
+    fill_kernel: str
+        Name of the kernel filling artefact rows, one of interpolate.FILL_KERNELS.
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError("Unknown scheduler %s, expected one of: %s" % (scheduler, ", ".join(SCHEDULERS)))
+    num_workers = num_workers or os.cpu_count()
+    if chunk_frames is None:
+        if memory_limit is None:
+            chunk_frames = DEFAULT_CHUNK_FRAMES
+        else:
+            chunk_frames = chunk_frames_for_memory(data.shape, data.dtype, memory_limit, num_workers)
+    logger.info(
+        "Converting data of shape %s with %s scheduler, %d workers, and %d time points per chunk",
+        data.shape,
+        scheduler,
+        num_workers,
+        chunk_frames,
+    )
+
     # Important: code expects no chunking in z, y, z -- need to have -1 for these dimensions.
-    # 64 frames will be processed together for artefact removal.
-    data = data.rechunk((64, -1, -1, -1))
+    data = data.rechunk((chunk_frames, -1, -1, -1))
 
-    with diagnostics.ProgressBar():
+    with Runner(scheduler, num_workers, memory_limit) as runner:
         if df_artefacts is None:
             logger.info("Writing data to %s", fname_data)
-            unlink(fname_data)
-            os.makedirs(fname_data.parent, exist_ok=True)
-            data.to_hdf5(fname_data, HDF5_KEY)
+            runner.store(data, fname_data)
         else:
             # This writes 2 hdf5 files, where the 2nd one depends on the same data being
             # written to the first.  Ideally, both would be written simultaneously, but
             # that cannot be done using dask.  Instead, the 1st file is written and then
             # read back to write the 2nd one.
             logger.info("Writing uncorrected data to %s", fname_uncorrected)
-            unlink(fname_uncorrected)
-            os.makedirs(fname_uncorrected.parent, exist_ok=True)
-            data.to_hdf5(fname_uncorrected, HDF5_KEY)
+            runner.store(data, fname_uncorrected)
 
             logger.info("Writing corrected data to %s", fname_data)
-            with h5py.File(fname_uncorrected, "r") as hfile:
-                arr = da.from_array(hfile[HDF5_KEY])
-                # Depth of 1 in the first coordinate means to bring in the frames before and after
-                # the chunk -- needed for doing diffs.
-                depth = (1, 0, 0, 0)
-                data_corrected = arr.map_overlap(
-                    remove_artefacts,
-                    depth=depth,
-                    dtype=data.dtype,
-                    df=df_artefacts,
-                    mydepth=depth,
-                )
-                unlink(fname_data)
-                os.makedirs(fname_data.parent, exist_ok=True)
-                data_corrected.to_hdf5(fname_data, HDF5_KEY)
-
-
-def remove_artefacts(chunk, df, mydepth, block_info):
-    """Remove artefacts from a chunk representing a set of frames."""
-    chunk = chunk.copy()
-    frame_min, frame_max = block_info[0]["array-location"][0]
-
-    # The array-location is not the frame number -- it is offset by depth when using map_overlap.
+            # The index is wrapped as a single delayed object so it is stored once in the graph
+            # and shared by all tasks, rather than embedded (and serialized) in each task.
+            if not isinstance(df_artefacts, artefact_index.ArtefactIndex):
+                df_artefacts = artefact_index_from_df(df_artefacts, data.shape[0])
+            index = dask.delayed(df_artefacts, pure=True)
+            arr = load(fname_uncorrected, data.chunks)
+            # The depth in the first coordinate brings in the frames before and after the chunk
+            # that the fill kernel interpolates from.  No frames are added beyond the ends of the
+            # data, so artefacts there are filled from the nearest unaffected frame, rather than
+            # from a reflected copy of themselves.
+            halo = preprocess.artefact_halo(df_artefacts, interpolate.FILL_KERNELS[fill_kernel].neighbours)
+            depth = (max(halo, 1), 0, 0, 0)
+            data_corrected = arr.map_overlap(
+                remove_artefacts,
+                depth=depth,
+                boundary="none",
+                dtype=data.dtype,
+                index=index,
+                mydepth=depth,
+                chunk_bounds=tuple(int(bound) for bound in np.cumsum((0,) + arr.chunks[0])),
+                fill_kernel=fill_kernel,
+            )
+            runner.store(data_corrected, fname_data)
+
+
+def chunk_frames_for_memory(shape, dtype, memory_limit, num_workers):
+    """Number of time points per chunk so that all workers' chunks fit in the memory budget."""
+    timepoint_bytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    chunk_frames = memory_limit // (num_workers * CHUNK_COPIES * timepoint_bytes)
+    if chunk_frames < 1:
+        logger.warning(
+            "Memory limit of %d bytes is too small for %d workers with %d bytes per time point, using 1",
+            memory_limit,
+            num_workers,
+            timepoint_bytes,
+        )
+    return int(max(1, min(chunk_frames, shape[0])))
+
+
+def load(fname, chunks):
+    """Dask array of data stored by `Runner.store`, readable from any worker."""
+    if storage.backend_of(fname) == "zarr":
+        return da.from_zarr(str(fname), component=ZARR_KEY).rechunk(chunks)
+    return da.from_array(H5Source(fname, HDF5_KEY), chunks=chunks)
+
+
+class H5Source:
+    """Picklable, array-like hdf5 dataset reader, so process/distributed workers can read chunks.
+
+    h5py datasets cannot be sent to other processes; this opens the file on each access instead.
+    """
+
+    def __init__(self, fname, key):
+        self.fname = fname
+        self.key = key
+        with h5py.File(fname, "r") as hfile:
+            dset = hfile[key]
+            self.shape = dset.shape
+            self.dtype = dset.dtype
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, item):
+        with h5py.File(self.fname, "r") as hfile:
+            return hfile[self.key][item]
+
+
+class Runner:
+    """Computes and stores dask arrays with a configurable scheduler, reporting resource usage.
+
+    Thread and synchronous schedulers write through `dask.array.to_hdf5`.  Process and
+    distributed workers cannot share an open hdf5 file, so for those the chunks are computed
+    by the workers and written in the main process as they complete, with a bounded number
+    of chunks in flight.  Zarr outputs are written by the workers directly with any scheduler.
+    """
+
+    def __init__(self, scheduler, num_workers, memory_limit=None):
+        self.scheduler = scheduler
+        self.num_workers = num_workers
+        self.memory_limit = memory_limit
+        self.client = None
+        self._stack = contextlib.ExitStack()
+        self._profiler = None
+        self._resources = None
+        self._task_stream = None
+
+    def __enter__(self):
+        self._start = time.time()
+        if self.scheduler == "distributed":
+            # Load distributed only when needed, as it is an optional dependency.
+            from dask import distributed
+
+            worker_memory = "auto" if self.memory_limit is None else self.memory_limit // self.num_workers
+            cluster = self._stack.enter_context(
+                distributed.LocalCluster(n_workers=self.num_workers, threads_per_worker=1, memory_limit=worker_memory)
+            )
+            self.client = self._stack.enter_context(distributed.Client(cluster))
+            logger.info("Started dask cluster, dashboard at: %s", self.client.dashboard_link)
+            self._task_stream = distributed.get_task_stream(self.client)
+            self._task_stream.__enter__()
+        else:
+            self._stack.enter_context(dask.config.set(scheduler=self.scheduler, num_workers=self.num_workers))
+            self._profiler = self._stack.enter_context(diagnostics.Profiler())
+            if importlib.util.find_spec("psutil") is not None:
+                self._resources = self._stack.enter_context(diagnostics.ResourceProfiler(dt=0.5))
+            else:
+                logger.info("Install psutil to report memory and cpu usage")
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self._task_stream is not None:
+                self._task_stream.__exit__(*exc)  # Collects the task stream from the scheduler.
+            self.report()
+        finally:
+            self._stack.close()
+
+    def store(self, array, fname):
+        """Compute `array` and write it to `fname` under HDF5_KEY (ZARR_KEY for a zarr store)."""
+        storage.remove(fname)
+        os.makedirs(fname.parent, exist_ok=True)
+        if storage.backend_of(fname) == "zarr":
+            with diagnostics.ProgressBar():
+                array.to_zarr(str(fname), component=ZARR_KEY)
+            return
+        if self.scheduler in ("threads", "synchronous"):
+            with diagnostics.ProgressBar():
+                array.to_hdf5(fname, HDF5_KEY)
+            return
+
+        # Chunks are only split along t, so blocks map to consecutive ranges of time points.
+        blocks = array.to_delayed().ravel()
+        bounds = np.cumsum((0,) + array.chunks[0])
+        max_in_flight = 2 * self.num_workers
+        with h5py.File(fname, "w") as hfile:
+            dset = hfile.create_dataset(HDF5_KEY, shape=array.shape, dtype=array.dtype)
+            if self.client is not None:
+                from dask import distributed
+
+                pending = distributed.as_completed()
+                block_nums = {}
+                for num, block in enumerate(blocks):
+                    future = self.client.compute(block)
+                    block_nums[future.key] = num
+                    pending.add(future)
+                    if pending.count() >= max_in_flight:
+                        self._write_next(pending, block_nums, dset, bounds)
+                while not pending.is_empty():
+                    self._write_next(pending, block_nums, dset, bounds)
+            else:
+                for batch_start in range(0, len(blocks), max_in_flight):
+                    batch = blocks[batch_start : batch_start + max_in_flight]
+                    for num, result in enumerate(dask.compute(*batch), start=batch_start):
+                        dset[bounds[num] : bounds[num + 1]] = result
+                    logger.info("Wrote %d of %d chunks", min(batch_start + max_in_flight, len(blocks)), len(blocks))
+
+    @staticmethod
+    def _write_next(pending, block_nums, dset, bounds):
+        future = next(pending)
+        num = block_nums.pop(future.key)
+        dset[bounds[num] : bounds[num + 1]] = future.result()
+        future.release()
+
+    def report(self):
+        """Log wall time, task timings, and (when available) memory and cpu usage."""
+        wall_secs = time.time() - self._start
+        durations = collections.Counter()
+        counts = collections.Counter()
+        if self._profiler is not None:
+            for task in self._profiler.results:
+                name = dask.utils.key_split(task.key)
+                durations[name] += task.end_time - task.start_time
+                counts[name] += 1
+        if self._task_stream is not None:
+            for task in self._task_stream.data:
+                name = dask.utils.key_split(task["key"])
+                for span in task["startstops"]:
+                    if span["action"] == "compute":
+                        durations[name] += span["stop"] - span["start"]
+                counts[name] += 1
+
+        logger.info(
+            "Dask %s scheduler: %.1f secs wall time, %d tasks, %.1f task-secs",
+            self.scheduler,
+            wall_secs,
+            sum(counts.values()),
+            sum(durations.values()),
+        )
+        for name, secs in durations.most_common(5):
+            logger.info("  %-30s %6d tasks %10.1f secs", name, counts[name], secs)
+        if self._resources is not None and self._resources.results:
+            mem_mb = max(r.mem for r in self._resources.results)
+            cpu = np.mean([r.cpu for r in self._resources.results])
+            logger.info("  peak memory %.0f MB, mean cpu %.0f%%", mem_mb, cpu)
+
+
+def artefact_index_from_df(df, num_frames):
+    """Build an ArtefactIndex from a dataframe indexed by frame, with z_plane/y_min/y_max columns."""
+    return artefact_index.ArtefactIndex.from_arrays(
+        df.index.values, df["z_plane"].values, df["y_min"].values, df["y_max"].values + 1, num_frames
+    )
+
+
+def remove_artefacts(chunk, index, mydepth, chunk_bounds, block_info, fill_kernel=interpolate.DEFAULT_FILL_KERNEL):
+    """Remove artefacts from a chunk representing a set of frames.
+
+    Artefact rows are filled by the named kernel, from the frames pulled in around the chunk or
+    from neighbouring rows.  `chunk_bounds` are the first frames of the chunks before overlap, and
+    the number of frames.
+    """
+    # The array-location is not the frame number when using map_overlap, so the frames are found
+    # from the chunk number.  The first and last chunks have no frames pulled in beyond the data.
     frame_chunk = block_info[0]["chunk-location"][0]
-    frame_offset = mydepth[0] * (1 + 2 * frame_chunk)
-    frame_min -= frame_offset
-    frame_max -= frame_offset
-
-    for index, frame in enumerate(range(frame_min, frame_max)):
-        # Skip first/last frames, which are just the edge frames pulled in to allow
-        # computation using before/after.
-        if index in (0, chunk.shape[0] - 1):
-            continue
-
-        # Skip if the frame does not have an artefact.
-        if frame not in df.index:
-            continue
-
-        # Use `frame:frame` so the following slice always returns a frame.  Using just `frame`
-        # would lead to a series being returned if there was only one present.
-        for row in df.loc[frame:frame].itertuples():
-            y_slice = slice(int(row.y_min), int(row.y_max) + 1)
-            before = chunk[index - 1, row.z_plane, y_slice]
-            after = chunk[index + 1, row.z_plane, y_slice]
-            chunk[index, row.z_plane, y_slice] = (before + after) / 2
-    return chunk
+    core_min, core_max = chunk_bounds[frame_chunk], chunk_bounds[frame_chunk + 1]
+    frame_min = max(core_min - mydepth[0], 0)
+    frame_max = min(core_max + mydepth[0], chunk_bounds[-1])
+    assert frame_max - frame_min == chunk.shape[0]
+
+    mask = index.mask(frame_min, frame_max, chunk.shape[1], chunk.shape[2])
+    # The frames around the core are just the edge frames pulled in to fill from.
+    core = (core_min - frame_min, core_max - frame_min)
+    return interpolate.fill_block(chunk, mask, fill_kernel, core)
@@ -2,8 +2,14 @@
 from xml.etree import ElementTree
 
 
-def frame_period(layout):
-    xml_path = layout.raw_xml_path()
+def frame_period(layout, acquisition=None):
+    xml_path = layout.raw_xml_path(acquisition)
     mdata_root = ElementTree.parse(xml_path).getroot()
     element = mdata_root.find('.//PVStateValue[@key="framePeriod"]')
     return float(element.attrib["value"])
+
+
+def blocks(length, block_size):
+    """Yield (start, stop) bounds splitting range(length) into consecutive blocks."""
+    for start in range(0, length, block_size):
+        yield start, min(start + block_size, length)